@@ -1,18 +1,53 @@
 #!/usr/bin/env python
+"""Lays out the plugin from the files in src/:
+
+    ftplugin/python_pyunit.vim  settings, commands and mappings, read for every
+                                Python buffer
+    autoload/pyunit.vim         the functions behind them, loaded on first use
+    pythonx/pyunit/core.py      the Python side, imported on first use
+    pythonx/pyunit/worker.py    the worker, which runs as a separate process
+
+"""
 import os
 
 source_dir = 'src'
-output_dir = 'ftplugin'
 
+outputs = [
+    ('ftplugin.vim', os.path.join('ftplugin', 'python_pyunit.vim')),
+    ('autoload.vim', os.path.join('autoload', 'pyunit.vim')),
+    ('python_unittests.py', os.path.join('pythonx', 'pyunit', 'core.py')),
+    ('pyunit_worker.py', os.path.join('pythonx', 'pyunit', 'worker.py')),
+]
 
-def build():
-    py_src = file(os.path.join(source_dir, 'python_unittests.py')).read()
-    vim_src = file(os.path.join(source_dir, 'base.vim')).read()
-    combined_src = vim_src.replace('__PYTHON_SOURCE__', py_src)
+package_init = '"""The Python side of vim-pyunit (see core.py)."""\n'
+
+
+def copy(source, output_path):
+    output_dir = os.path.dirname(output_path)
     if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-    output_path = os.path.join(output_dir, 'python_pyunit.vim')
-    file(output_path, 'w').write(combined_src)
+        os.makedirs(output_dir)
+    f = open(source)
+    try:
+        contents = f.read()
+    finally:
+        f.close()
+    f = open(output_path, 'w')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+
+
+def build():
+    for source, output_path in outputs:
+        copy(os.path.join(source_dir, source), output_path)
+
+    init_path = os.path.join('pythonx', 'pyunit', '__init__.py')
+    f = open(init_path, 'w')
+    try:
+        f.write(package_init)
+    finally:
+        f.close()
 
 if __name__ == '__main__':
     build()
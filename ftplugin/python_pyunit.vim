@@ -1,8 +1,8 @@
 "
-" Python filetype plugin for unit testing (currently with nose)
+" Python filetype plugin for unit testing (with nose, pytest, unittest or nose2)
 " Language:     Python (ft=python)
 " Maintainer:   Vincent Driessen <vincent@datafox.nl>
-" Version:      Vim 7 (may work with lower Vim versions, but not tested)
+" Version:      Vim 7.4 or Neovim, with +python3 (or +python)
 " URL:          http://github.com/nvie/vim-pyunit
 "
 " Very inspired by Gary Bernhart's work:
@@ -19,16 +19,136 @@ endif
 let loaded_python_unittests_ftplugin = 1
 
 " Configuration of the test tool {{{
-" Set the PyUnitCmd to whatever is your testing tool (default: nosetests)
+" The test runner to use: "nose", "pytest", "unittest" or "nose2"
+" (default: nose)
+if !exists("g:PyUnitRunner")
+    let PyUnitRunner = "nose"
+endif
+
+" Set the PyUnitCmd to whatever is your testing tool (default: nosetests).
+" It's only used with the nose runner, and must report in machineout format.
 if !exists("g:PyUnitCmd")
     let PyUnitCmd = "nosetests -q --with-machineout"
 endif
 
+" The commands of the pytest and nose2 runners, with any options of your own
+" (default: pytest, nose2)
+if !exists("g:PyUnitPytestCmd")
+    let PyUnitPytestCmd = "pytest"
+endif
+
+if !exists("g:PyUnitNose2Cmd")
+    let PyUnitNose2Cmd = "nose2"
+endif
+
 " Set PyUnitShowTests to 1 if you want to show the tests (default: 1)
 if !exists("g:PyUnitShowTests")       " TODO: Use this one!
     let PyUnitShowTests = 1
 endif
 
+" Set PyUnitAsync to 1 to run the tests in the background (requires Vim 8 or
+" Neovim), so that you can keep editing while the tests run (default: 0)
+if !exists("g:PyUnitAsync")
+    let PyUnitAsync = 0
+endif
+
+" Number of milliseconds :PyUnitWatch waits after a file is written before it
+" runs the tests, so that saving several files in a row gives a single run
+" (default: 300)
+if !exists("g:PyUnitWatchDelay")
+    let PyUnitWatchDelay = 300
+endif
+
+" Maximum number of failures to put in the quickfix list.  Identical
+" failures are only listed once.  (default: 1000)
+if !exists("g:PyUnitMaxQuickfixEntries")
+    let PyUnitMaxQuickfixEntries = 1000
+endif
+
+" Run the tests that failed last time first, when running the tests of a
+" single file.  Only when those pass, the whole file is run.  (default: 1)
+if !exists("g:PyUnitFailedFirst")
+    let PyUnitFailedFirst = 1
+endif
+
+" Set this to 1 to run only the tests that failed last time, if any.
+" (default: 0)
+if !exists("g:PyUnitFailedOnly")
+    let PyUnitFailedOnly = 0
+endif
+
+" Set this to 1 to stop a test run at the first failure.  (default: 0)
+if !exists("g:PyUnitStopOnFailure")
+    let PyUnitStopOnFailure = 0
+endif
+
+" Set PyUnitWorker to 1 to run the tests in a long-lived worker process, which
+" keeps the modules the tests import loaded between runs (default: 0).  The
+" worker runs the tests with unittest (see pythonx/pyunit/worker.py), not
+" PyUnitCmd.
+if !exists("g:PyUnitWorker")
+    let PyUnitWorker = 0
+endif
+
+" The Python interpreter that runs the worker; use the one of your project's
+" virtualenv, if it has one
+if !exists("g:PyUnitWorkerPython")
+    let PyUnitWorkerPython = "python"
+endif
+
+" Modules the worker imports up front, e.g. [ "django", "numpy" ]
+if !exists("g:PyUnitWorkerPreload")
+    let PyUnitWorkerPreload = []
+endif
+
+" Set PyUnitWorkerFork to 1 to have the worker fork a fresh process for every
+" run, instead of reloading changed modules in place.  Unless PyUnitWorkerPreload
+" is set, it preloads everything the project imports from outside of itself,
+" and it restarts when any of that changes on disk.  (default: 0)
+if !exists("g:PyUnitWorkerFork")
+    let PyUnitWorkerFork = 0
+endif
+
+if !exists("g:PyUnitWorkerScript")
+    let PyUnitWorkerScript = expand("<sfile>:p:h:h") . "/pythonx/pyunit/worker.py"
+endif
+
+" Directories (by name, with wildcards) that are never searched for Python
+" files, e.g. for the untested files or the test files of a project.  Hidden
+" directories and virtualenvs are always skipped.
+if !exists("g:PyUnitExcludeDirs")
+    let PyUnitExcludeDirs = ["build", "dist", "*.egg-info", "__pycache__", "node_modules"]
+endif
+
+" Set PyUnitFuzzyCounterparts to 0 to only ever switch to the counterpart the
+" test layout prescribes.  Otherwise, when the source file of a test doesn't
+" exist (or the layout doesn't know the test file of a source file), the file
+" with the expected name whose path resembles the expected path most is used
+" instead.  Missing test files are still offered to be created.  (default: 1)
+if !exists("g:PyUnitFuzzyCounterparts")
+    let PyUnitFuzzyCounterparts = 1
+endif
+
+" Number of parallel test processes used to run all tests.  Set this to 0 to
+" use one process per CPU core.  (default: 1, i.e. a single process)
+if !exists("g:PyUnitShards")
+    let PyUnitShards = 1
+endif
+
+" Set PyUnitResultCache to 1 to have running all tests skip the test files that
+" passed before, as long as neither they nor any of the project files they
+" import have changed since.  Only the files the test layout takes for test
+" files are run then, rather than whatever the runner finds.  (default: 0)
+if !exists("g:PyUnitResultCache")
+    let PyUnitResultCache = 0
+endif
+
+" Number of recent runs of each test file that are kept to compute its
+" average duration (see :PyUnitSlowest)  (default: 10)
+if !exists("g:PyUnitDurationWindow")
+    let PyUnitDurationWindow = 10
+endif
+
 "}}}
 " Configuration for autodetecting project root {{{
 " Configure what files indicate a project root
@@ -43,6 +163,12 @@ endif
 if !exists("g:ProjRootStopAtHomeDir")
     let ProjRootStopAtHomeDir = 1
 endif
+
+" Directory (relative to the project root) where the plugin keeps its caches,
+" such as the import graph of the project
+if !exists("g:PyUnitCacheDir")
+    let PyUnitCacheDir = ".pyunit"
+endif
 " }}}
 " Configuration for tests organisation {{{
 " Prefix used for all path components of the test file
@@ -107,483 +233,114 @@ if !exists("g:PyUnitTestsSplitWindow")
 endif
 " }}}
 
-python << endpython
-import vim
-import os
-import os.path
-from vim_bridge import bridged
-
-
-#
-# General helper functions
-#
-
-def _relpath(path, start='.', try_stdlib=True):
-    """Returns the relative version of the path.  This is a backport of
-    Python's stdlib routine os.path.relpath(), which is not yet available in
-    Python 2.4.
-
-    """
-    # Fall back onto stdlib version of it, if available
-    if try_stdlib:
-        try:
-            return os.path.relpath(path, start)
-        except AttributeError:
-            # Python versions below 2.6 don't have the relpath function
-            # It's ok, we fall back onto our own implementation
-            pass
-
-    fullp = os.path.abspath(path)
-    fulls = os.path.abspath(start)
-    matchs = os.path.normpath(start)
-    if not matchs.endswith(os.sep):
-        matchs += os.sep
-
-    if fullp == fulls:
-        return '.'
-    elif fullp.startswith(matchs):
-        return fullp[len(matchs):]
-    else:
-        # Strip dirs off of fulls until it is a prefix of fullp
-        path_prefixes = []
-        while True:
-            path_prefixes.append(os.path.pardir)
-            fulls = os.path.dirname(fulls)
-            if fullp.startswith(fulls):
-                break
-        remainder = fullp[len(fulls):]
-        if remainder.startswith(os.sep):
-            remainder = remainder[len(os.sep):]
-        path_prefix = os.sep.join(path_prefixes)
-        return os.path.join(path_prefix, remainder)
-
-
-def strip_prefix(s, prefix):
-    if prefix != "" and s.startswith(prefix):
-        return s[len(prefix):]
-    else:
-        return s
-
-
-def is_home_dir(path):
-    return os.path.realpath(path) == os.path.expandvars("$HOME")
-
-
-def is_fs_root(path):
-    return os.path.realpath(path) == "/" or \
-           (int(vim.eval("g:ProjRootStopAtHomeDir")) and is_home_dir(path))
-
-
-def find_project_root(path='.'):
-    if not os.path.isdir(path):
-        return find_project_root(os.path.dirname(os.path.realpath(path)))
-
-    indicators = vim.eval("g:ProjRootIndicators")
-    while not is_fs_root(path):
-        for i in indicators:
-            if os.path.exists(os.path.join(path, i)):
-                return os.path.realpath(path)
-        path = os.path.join(path, os.path.pardir)
-    raise Exception("Could not find project root")
-
-
-#
-# Classes that implement TestLayouts
-#
-
-class BaseTestLayout(object):
-    def __init__(self):
-        self.source_root = vim.eval('g:PyUnitSourceRoot')
-        self.test_root = vim.eval('g:PyUnitTestsRoot')
-        self.prefix = vim.eval('g:PyUnitTestPrefix')
-
-
-    # Helper methods, to be used in subclasses
-    def break_down(self, path):
-        parts = path.split(os.sep)
-        if len(parts) > 0:
-            if parts[-1] == '__init__.py':
-                del parts[-1]
-            elif parts[-1].endswith(".py"):
-                parts[-1] = parts[-1][:-len(".py")]
-        return parts
-
-    def glue_parts(self, parts, use_under_under_init=False):
-        if use_under_under_init:
-            parts = parts + ['__init__.py']
-        else:
-            parts = parts[:-1] + [parts[-1] + '.py']
-        return os.sep.join(parts)
-
-    def relatize(self, path):
-        return _relpath(path, find_project_root())
-
-    def absolutify(self, path):
-        if os.path.isabs(path):
-            return path
-        return os.sep.join([find_project_root(), path])
-
-
-    # The actual BaseTestLayout methods that need implementation
-    def is_test_file(self, some_file):
-        raise NotImplemented("Implement this method in a subclass.")
-
-    def get_test_file(self, source_file):
-        raise NotImplemented("Implement this method in a subclass.")
-
-    def get_source_candidates(self, test_file):
-        raise NotImplemented("Implement this method in a subclass.")
-
-    def get_source_file(self, test_file):
-        for candidate in self.get_source_candidates(test_file):
-            if os.path.exists(candidate):
-                return candidate
-        raise RuntimeError("Source file not found.")
-
-
-class SideBySideLayout(BaseTestLayout):
-    def is_test_file(self, some_file):
-        some_file = self.relatize(some_file)
-        parts = self.break_down(some_file)
-        filepart = parts[-1]
-        return filepart.startswith(self.prefix)
-
-    def get_test_file(self, source_file):
-        source_file = self.relatize(source_file)
-        parts = self.break_down(source_file)
-        parts[-1] = self.prefix + parts[-1]
-        return self.glue_parts(parts)
-
-    def get_source_candidates(self, test_file):
-        test_file = self.relatize(test_file)
-        parts = self.break_down(test_file)
-        filepart = parts[-1]
-        if not filepart.startswith(self.prefix):
-            raise RuntimeError("Not a test file.")
-        parts[-1] = filepart[len(self.prefix):]
-        return [self.glue_parts(parts)]
-
-
-class FlatLayout(BaseTestLayout):
-    def is_test_file(self, some_file):
-        some_file = self.relatize(some_file)
-        if not some_file.startswith(self.test_root):
-            return False
-
-        some_file = _relpath(some_file, self.test_root)
-
-        parts = self.break_down(some_file)
-        if len(parts) != 1:
-            return False
-        return parts[0].startswith(self.prefix)
-
-    def get_test_file(self, source_file):
-        source_file = self.relatize(source_file)
-        if not source_file.startswith(self.source_root):
-            raise RuntimeError("File %s is not under the source root." % source_file)
-
-        source_file = _relpath(source_file, self.source_root)
-        parts = self.break_down(source_file)
-        flat_file_name = "_".join(parts)
-        parts = [self.test_root] + [self.prefix + flat_file_name]
-        return self.glue_parts(parts)
-
-    def get_source_candidates(self, test_file):
-        test_file = self.relatize(test_file)
-        if not test_file.startswith(self.test_root):
-            raise RuntimeError("File %s is not under the test root." % test_file)
-
-        test_file = _relpath(test_file, self.test_root)
-        parts = self.break_down(test_file)
-        if len(parts) != 1:
-            raise RuntimeError("Flat tests layout does not allow tests to be more than one directory deep.")
-        file_name = strip_prefix(parts[0], self.prefix)
-        parts = file_name.split("_")
-        parts = [self.source_root] + parts
-        return [self.glue_parts(parts, x) for x in (False, True)]
-
-
-class FollowHierarchyLayout(BaseTestLayout):
-    def is_test_file(self, some_file):
-        some_file = self.relatize(some_file)
-        if not some_file.startswith(self.test_root):
-            return False
-
-        some_file = _relpath(some_file, self.test_root)
-
-        parts = self.break_down(some_file)
-        for p in parts:
-            if not p.startswith(self.prefix):
-                return False
-        return True
-
-    def get_test_file(self, source_file):
-        source_file = self.relatize(source_file)
-        if not source_file.startswith(self.source_root):
-            raise RuntimeError("File %s is not under the source root." % source_file)
-
-        source_file = _relpath(source_file, self.source_root)
-        parts = self.break_down(source_file)
-        parts = map(lambda p: self.prefix + p, parts)
-        parts = [self.test_root] + parts
-        return self.glue_parts(parts)
-
-    def get_source_candidates(self, test_file):
-        test_file = self.relatize(test_file)
-        if not test_file.startswith(self.test_root):
-            raise RuntimeError("File %s is not under the test root." % test_file)
-
-        test_file = _relpath(test_file, self.test_root)
-        parts = self.break_down(test_file)
-        parts = [strip_prefix(p, self.prefix) for p in parts]
-        if self.source_root:
-            parts = [self.source_root] + parts
-        result = [self.glue_parts(parts, x) for x in (False, True)]
-        return result
-
-
-class NoseLayout(BaseTestLayout):
-    def is_test_file(self, some_file):
-        some_file = self.relatize(some_file)
-        if not some_file.startswith(self.test_root):
-            return False
-
-        some_file = _relpath(some_file, self.test_root)
-
-        parts = self.break_down(some_file)
-        return parts[-1].startswith(self.prefix)
-
-    def get_test_file(self, source_file):
-        source_file = self.relatize(source_file)
-        if not source_file.startswith(self.source_root):
-            raise RuntimeError("File %s is not under the source root." % source_file)
-
-        source_file = _relpath(source_file, self.source_root)
-        parts = self.break_down(source_file)
-        parts[-1] = self.prefix + parts[-1]
-        parts = [self.test_root] + parts
-        return self.glue_parts(parts)
-
-    def get_source_candidates(self, test_file):
-        test_file = self.relatize(test_file)
-        if not test_file.startswith(self.test_root):
-            raise RuntimeError("File %s is not under the test root." % test_file)
-
-        test_file = _relpath(test_file, self.test_root)
-        parts = self.break_down(test_file)
-        parts = [strip_prefix(p, self.prefix) for p in parts]
-        if self.source_root:
-            parts = [self.source_root] + parts
-        result = [self.glue_parts(parts, x) for x in (False, True)]
-        return result
-
-
-def get_implementing_class():
-    implementations = {
-        'flat': FlatLayout,
-        'follow-hierarchy': FollowHierarchyLayout,
-        'side-by-side': SideBySideLayout,
-        'nose': NoseLayout,
-    }
-    test_layout = vim.eval('g:PyUnitTestsStructure')
-    try:
-        return implementations[test_layout]
-    except KeyError:
-        raise RuntimeError('No such test layout: %s' % test_layout)
-
-
-#
-# The main functions
-#
-
-def get_test_file_for_source_file(path):
-    impl = get_implementing_class()()
-    return impl.get_test_file(path)
-
-
-def find_source_file_for_test_file(path):
-    impl = get_implementing_class()()
-    for f in impl.get_source_candidates(path):
-        if os.path.exists(f):
-            return f
-    raise Exception("Source file not found.")
-
-
-def is_test_file(path):
-    impl = get_implementing_class()()
-    return impl.is_test_file(path)
-
-
-def _vim_split_cmd(inverted=False):
-    invert = {'top': 'bottom', 'left': 'right',
-              'right': 'left', 'bottom': 'top', 'no': 'no'}
-    mapping = {'top': 'lefta', 'left': 'vert lefta',
-               'right': 'vert rightb', 'bottom': 'rightb', 'no': ''}
-    splitoff_direction = vim.eval("g:PyUnitTestsSplitWindow")
-    if inverted:
-        return mapping[invert[splitoff_direction]]
-    else:
-        return mapping[splitoff_direction]
-
-
-def _open_buffer_cmd(path, opposite=False):
-    splitopts = _vim_split_cmd(opposite)
-    if not splitopts:
-        splitcmd = 'edit'
-    elif int(vim.eval('bufexists("%s")' % path)):
-        splitcmd = splitopts + ' sbuffer'
-    else:
-        splitcmd = splitopts + ' split'
-    command = "%s %s" % (splitcmd, path)
-    return command
-
-
-def lcd_to_project_root(path):
-    vim.command("lcd %s" % find_project_root(path))
-
-
-def switch_to_test_file_for_source_file(path):
-    testfile = get_test_file_for_source_file(path)
-    testdir = os.path.dirname(testfile)
-    if not os.path.isfile(testfile):
-        if int(vim.eval('g:PyUnitConfirmTestCreation')):
-            # Ask the user for confirmation
-            rel_testfile = _relpath(testfile, find_project_root(path))
-            msg = 'confirm("Test file does not exist yet. Create %s now?", "&Yes\n&No")' % rel_testfile
-            if int(vim.eval(msg)) != 1:
-                return
-
-        # Create the directory up until the file (if it doesn't exist yet)
-        if not os.path.exists(testdir):
-            os.makedirs(testdir)
-
-    vim.command(_open_buffer_cmd(testfile))
-    lcd_to_project_root(path)
-
-
-def switch_to_source_file_for_test_file(path):
-    sourcefile = find_source_file_for_test_file(path)
-    vim.command(_open_buffer_cmd(sourcefile, opposite=True))
-    lcd_to_project_root(path)
-
-
-@bridged
-def PyUnitSwitchToCounterpartOfFile(path):
-    if is_test_file(path):
-        switch_to_source_file_for_test_file(path)
-    else:
-        switch_to_test_file_for_source_file(path)
-
-
-@bridged
-def PyUnitRunTestsForFile(path):
-    if not is_test_file(path):
-        path = get_test_file_for_source_file(path)
-    relpath = _relpath(path, '.')
-    vim.command('call PyUnitRunTestsForTestFile("%s")' % relpath)
-
-endpython
-
-fun! PyUnitRunTestsForTestFile(path) " {{{
-    silent write
-    call PyUnitRunNose(a:path)
-endf " }}}
-
-fun! PyUnitRunNose(path) " {{{
-    " TODO: fix this hard-coded "nosetests" string!
-    if !executable("nosetests")
-        echoerr "File " . "nosetests" . " not found. Please install it first."
-        return
-    endif
-
-    set lazyredraw   " delay redrawing
-    cclose           " close any existing cwindows
-
-    " store old grep settings (to restore later)
-    let old_gfm=&grepformat
-    let old_gp=&grepprg
-
-    " write any changes before continuing
-    if !&readonly
-        update
-    endif
-
-    " perform the grep itself
-    let &grepformat = "%f:%l: fail: %m,%f:%l: error: %m"
-    if g:PyUnitSourceRoot != ""
-        let &grepprg = "PYTHONPATH=".g:PyUnitSourceRoot." ".g:PyUnitCmd
-    else
-        let &grepprg = g:PyUnitCmd
-    endif
-    execute "silent! grep! ".a:path
-
-    " restore grep settings
-    let &grepformat=old_gfm
-    let &grepprg=old_gp
-
-    " open cwindow
-    let has_errors=getqflist() != []
-    if has_errors
-        " first, open the alternate window, too
-        call PyUnitSwitchToCounterpart()
-        execute 'belowright copen'
-        setlocal wrap
-        nnoremap <buffer> <silent> c :cclose<CR>
-        nnoremap <buffer> <silent> q :cclose<CR>
-    endif
-
-    set nolazyredraw
-    redraw!
-
-    if !has_errors
-        " Show OK status
-        call s:GreenBar()
-        echo ""
-        hi Green ctermfg=green
-        echohl Green
-        echon "All tests passed."
-        echohl
-    else
-        call s:RedBar()
-        echo ""
-        hi Red ctermfg=red
-        echohl Red
-        let numfail = len(getqflist())
-        if numfail == 1
-            echon "1 test failed."
-        else
-            echon numfail." tests failed."
-        endif
-    endif
-endf # }}}
-
-fun! s:RedBar() " {{{
-    hi RedBar ctermfg=white ctermbg=red guibg=red
-    echohl RedBar
-    echon repeat(" ", &columns - 1)
-    echohl
+" Functions for your own mappings (see below) {{{
+fun! PyUnitRunTests() " {{{
+    call pyunit#RunTests()
 endf " }}}
 
-fun! s:GreenBar() " {{{
-    hi GreenBar ctermfg=white ctermbg=green guibg=green
-    echohl GreenBar
-    echon repeat(" ", &columns - 1)
-    echohl
+fun! PyUnitRunAllTests() " {{{
+    call pyunit#RunAllTests()
 endf " }}}
 
 fun! PyUnitSwitchToCounterpart() " {{{
-    call PyUnitSwitchToCounterpartOfFile(@%)
+    call pyunit#SwitchToCounterpart()
 endf " }}}
 
-fun! PyUnitRunTests() " {{{
-    call PyUnitRunTestsForFile(@%)
+" The timings that :PyUnitProfile shows, as a dict
+fun! PyUnitProfileData() " {{{
+    return pyunit#ProfileData()
 endf " }}}
+" }}}
 
-fun! PyUnitRunAllTests() " {{{
-    silent w
-    call PyUnitRunNose('')
-endf " }}}
+" Commands {{{
+
+" Forget any cached project roots, e.g. after moving indicator files around
+command! PyUnitClearCache call pyunit#Call('PyUnitClearCache')
+
+" List the source files that have no test file yet, for the whole project or
+" just the given directory
+command! -nargs=? -complete=dir PyUnitUntested call pyunit#ShowUntested(<q-args>)
+
+" Re-read the g:PyUnit* and g:ProjRoot* settings (which are otherwise only
+" read once).  Changing them with :let or :unlet on the command line does this
+" automatically.  Scripts that change them can trigger it with
+" :doautocmd User PyUnitConfigChanged
+command! PyUnitReloadConfig call pyunit#Call('PyUnitReloadConfig')
+
+" Until the functions of autoload/pyunit.vim are used, there is nothing to
+" reload, and no reason to load them
+augroup PyUnitConfig
+    autocmd!
+    autocmd User PyUnitConfigChanged
+                \ if exists('*pyunit#ReloadConfig') |
+                \     call pyunit#ReloadConfig() |
+                \ endif
+    " Only commands that assign settings count: this also fires for the
+    " commands of mappings, like the plugin's own
+    if exists('##CmdlineLeave')
+        autocmd CmdlineLeave :
+                    \ if getcmdline() =~# '^\s*\(let\|unl\%[et]\)!\=\s.*\<\([gb]:\)\=\(PyUnit\|ProjRoot\)' &&
+                    \    exists('*pyunit#ReloadConfig') |
+                    \     call pyunit#ReloadConfig() |
+                    \ endif
+    endif
+augroup END
+
+" Run only the tests affected by the changes since the given git ref, or by
+" the Python files written since the last test run if no ref is given
+command! -nargs=? PyUnitRunImpacted
+            \ call pyunit#Call('PyUnitProfileStart', 'run impacted') |
+            \ call pyunit#Call('PyUnitRunImpactedTests', <q-args>)
+
+augroup PyUnitWrittenFiles
+    autocmd!
+    autocmd BufWritePost *.py call pyunit#NoteWrittenFile(expand('<afile>:p'))
+augroup END
+
+" Show the slowest test files (and tests), based on the recorded durations
+command! -nargs=? PyUnitSlowest call pyunit#Call('PyUnitShowSlowest', <q-args>)
+
+" Stop the worker process of the current project (see PyUnitWorker)
+command! PyUnitStopWorker call pyunit#Call('PyUnitStopWorker')
+
+" Run only the test under the cursor (or the whole test file when the cursor
+" isn't inside a test, or when the current file is not a test file)
+command! PyUnitRunNearest
+            \ call pyunit#Call('PyUnitProfileStart', 'run nearest') |
+            \ call pyunit#Call('PyUnitRunNearestTest', @%)
+
+" Load the results in a JUnit XML report (by default the one written by the
+" last pytest or nose2 run) into the quickfix list
+command! -nargs=? -complete=file PyUnitLoadJUnit call pyunit#LoadJUnit(<q-args>)
+
+" Run the tests under coverage.py, to record which tests execute which code.
+" Afterwards, only test files that changed are run again
+command! PyUnitCoverageIndex call pyunit#UpdateCoverageIndex()
+
+" Run the tests that executed the function under the cursor, according to the
+" index built by :PyUnitCoverageIndex
+command! PyUnitRunCovering
+            \ call pyunit#Call('PyUnitProfileStart', 'run covering') |
+            \ call pyunit#Call('PyUnitRunCoveringTests', @%)
+
+" Stop a test run that is running in the background
+command! PyUnitCancel call pyunit#CancelTests()
+
+" Show the full traceback of the current quickfix entry (or of entry N) in the
+" preview window.  In the quickfix window, p does the same for the entry under
+" the cursor, and <CR> jumps to the entry and shows its traceback
+command! -nargs=? PyUnitTraceback call pyunit#PreviewTraceback(<q-args>)
+
+" Show how long the phases of the last switches and test runs took (as
+" percentiles); :PyUnitProfile! forgets them.  PyUnitProfileData() returns the
+" same numbers as a dict
+command! -bang PyUnitProfile call pyunit#Call('PyUnitShowProfile', <bang>0)
+
+" Run the tests of every Python file you write, in the background; use
+" :PyUnitWatch! to stop
+command! -bang PyUnitWatch call pyunit#Watch(<bang>1)
 
+" }}}
 " Keyboard mappings {{{
 
 " Add mappings, unless the user didn't want this.
@@ -0,0 +1 @@
+"""The Python side of vim-pyunit (see core.py)."""
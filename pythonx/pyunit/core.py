@@ -0,0 +1,3689 @@
+import vim
+import os
+import os.path
+import re
+import json
+import time
+import socket
+import subprocess
+import shlex
+import ast
+import heapq
+import hashlib
+import math
+import mmap
+import zlib
+import sqlite3
+import difflib
+import fnmatch
+import threading
+import multiprocessing
+from collections import deque, namedtuple
+from xml.etree import ElementTree
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from shlex import quote as _shell_quote
+except ImportError:
+    from pipes import quote as _shell_quote
+
+
+#
+# Calls from Vim
+#
+
+# The functions Vim can call (through pyunit#Call()), by name
+_vim_functions = {}
+
+
+def bridged(func):
+    """Makes the function callable from Vim, as pyunit#Call('Name', ...)."""
+    _vim_functions[func.__name__] = func
+    return func
+
+
+def call_from_vim(name):
+    """Calls the named function with the arguments that were passed to
+    pyunit#Call().  Like any value that comes from Vim, these are strings (or
+    lists or dicts of them).  The result is handed back as a string, or as an
+    empty string for None.
+
+    """
+    result = _vim_functions[name](*vim.eval('a:000'))
+    if result is None:
+        return ''
+    if isinstance(result, bool):
+        result = int(result)
+    return str(result)
+
+
+#
+# Timing the phases of the plugin's work
+#
+
+class Profiler(object):
+    """Records how long the phases (reading the settings, finding the project
+    root, running the tests, ...) of the most recent invocations took.  An
+    invocation is what a single key press or command does, e.g. a switch to
+    the counterpart of a file, or a test run up to showing its results.
+    Phases can be part of other phases (finding the project root is part of
+    mapping a file to its counterpart), so they don't add up to the total.
+
+    """
+    def __init__(self, size=100):
+        self.invocations = deque(maxlen=size)
+        self.current = None
+        self._active = set()
+
+    def start(self, name):
+        """Starts a new invocation.  One that was never finished (e.g. a test
+        run that was cancelled) is dropped.
+
+        """
+        self.current = {'name': name, 'started': time.time(), 'phases': {}}
+
+    def finish(self):
+        if self.current is None:
+            return
+        invocation = self.current
+        invocation['secs'] = time.time() - invocation.pop('started')
+        self.invocations.append(invocation)
+        self.current = None
+
+    def add(self, phase, secs):
+        if self.current is not None:
+            phases = self.current['phases']
+            phases[phase] = phases.get(phase, 0) + secs
+
+    def timed(self, phase):
+        """Decorates a function to add the time spent in it to the given
+        phase.  Recursive calls are only counted once.
+
+        """
+        def decorate(func):
+            def timed_func(*args, **kwargs):
+                if phase in self._active:
+                    return func(*args, **kwargs)
+                self._active.add(phase)
+                started = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._active.discard(phase)
+                    self.add(phase, time.time() - started)
+            timed_func.__name__ = func.__name__
+            timed_func.__doc__ = func.__doc__
+            return timed_func
+        return decorate
+
+    def clear(self):
+        self.invocations.clear()
+        self.current = None
+
+    def summary(self):
+        """Returns, for each kind of invocation, the percentiles of its total
+        time and of the time of each of its phases (in seconds):
+
+            {'switch': {'count': 12,
+                        'total': {'p50': ..., 'p90': ..., 'p99': ...,
+                                  'max': ...},
+                        'phases': {'project root': {...}, ...}}}
+
+        """
+        by_name = {}
+        for invocation in self.invocations:
+            by_name.setdefault(invocation['name'], []).append(invocation)
+        summary = {}
+        for name, invocations in by_name.items():
+            phases = {}
+            for invocation in invocations:
+                for phase, secs in invocation['phases'].items():
+                    phases.setdefault(phase, []).append(secs)
+            summary[name] = {
+                'count': len(invocations),
+                'total': percentiles([i['secs'] for i in invocations]),
+                'phases': dict((phase, percentiles(times))
+                               for phase, times in phases.items()),
+            }
+        return summary
+
+    def report(self):
+        lines = []
+        header = '%-24s %9s %9s %9s %9s'
+        row = '%-24s %7.1fms %7.1fms %7.1fms %7.1fms'
+        for name, stats in sorted(self.summary().items()):
+            if lines:
+                lines.append('')
+            lines.append(header % ('%s (%d)' % (name, stats['count']),
+                                   'p50', 'p90', 'p99', 'max'))
+            rows = [('total', stats['total'])]
+            rows.extend(sorted(stats['phases'].items(),
+                               key=lambda item: -item[1]['p50']))
+            for label, p in rows:
+                lines.append(row % (('  ' + label,) +
+                                    tuple(p[k] * 1000 for k in
+                                          ('p50', 'p90', 'p99', 'max'))))
+        return lines or ['Nothing recorded yet.']
+
+
+def percentiles(values):
+    """Returns the 50th, 90th and 99th percentile (nearest rank) and the
+    maximum of the given values.
+
+    """
+    values = sorted(values)
+    def rank(p):
+        return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+    return {'p50': rank(50), 'p90': rank(90), 'p99': rank(99),
+            'max': values[-1]}
+
+
+profiler = Profiler()
+
+
+#
+# Configuration
+#
+
+class Config(object):
+    """A snapshot of the plugin's settings.  All settings are read from Vim at
+    once, on first use, and are then kept until invalidate() is called (which
+    Vim does whenever the settings might have changed).
+
+    """
+    settings = {
+        'cmd': ('g:PyUnitCmd', str),
+        'pytest_cmd': ('g:PyUnitPytestCmd', str),
+        'nose2_cmd': ('g:PyUnitNose2Cmd', str),
+        'runner': ('g:PyUnitRunner', str),
+        'indicators': ('g:ProjRootIndicators', tuple),
+        'stop_at_home_dir': ('g:ProjRootStopAtHomeDir', int),
+        'prefix': ('g:PyUnitTestPrefix', str),
+        'source_root': ('g:PyUnitSourceRoot', str),
+        'test_root': ('g:PyUnitTestsRoot', str),
+        'tests_structure': ('g:PyUnitTestsStructure', str),
+        'confirm_test_creation': ('g:PyUnitConfirmTestCreation', int),
+        'split_window': ('g:PyUnitTestsSplitWindow', str),
+        'fuzzy_counterparts': ('g:PyUnitFuzzyCounterparts', int),
+        'max_quickfix_entries': ('g:PyUnitMaxQuickfixEntries', int),
+        'cache_dir': ('g:PyUnitCacheDir', str),
+        'shards': ('g:PyUnitShards', int),
+        'duration_window': ('g:PyUnitDurationWindow', int),
+        'failed_first': ('g:PyUnitFailedFirst', int),
+        'worker_python': ('g:PyUnitWorkerPython', str),
+        'worker_script': ('g:PyUnitWorkerScript', str),
+        'worker_preload': ('g:PyUnitWorkerPreload', list),
+        'exclude_dirs': ('g:PyUnitExcludeDirs', list),
+        'worker_fork': ('g:PyUnitWorkerFork', int),
+        'result_cache': ('g:PyUnitResultCache', int),
+    }
+
+    # The settings a buffer can override with a b: variable of the same name
+    buffer_settings = ('tests_structure', 'source_root', 'test_root')
+
+    def __init__(self):
+        self._values = None
+        # Bumped whenever the settings are read again, so that whatever was
+        # derived from them can tell it's outdated
+        self.generation = 0
+
+    def invalidate(self):
+        self._values = None
+        self.generation += 1
+
+    @profiler.timed('config')
+    def buffer_overrides(self):
+        """Returns the values of the settings that the current buffer
+        overrides, e.g. with b:PyUnitSourceRoot.
+
+        """
+        buffer_vars = vim.eval('b:')
+        overrides = {}
+        for name in self.buffer_settings:
+            var, convert = self.settings[name]
+            buffer_var = var[len('g:'):]
+            if buffer_var in buffer_vars:
+                overrides[name] = convert(buffer_vars[buffer_var])
+        return overrides
+
+    @profiler.timed('config')
+    def load(self):
+        values = {}
+        for name, (var, convert) in self.settings.items():
+            values[name] = convert(vim.eval(var))
+        self._values = values
+
+    def __getattr__(self, name):
+        if name not in self.settings:
+            raise AttributeError(name)
+        if self._values is None:
+            self.load()
+        return self._values[name]
+
+
+config = Config()
+
+
+#
+# General helper functions
+#
+
+def _relpath(path, start='.', try_stdlib=True):
+    """Returns the relative version of the path.  This is a backport of
+    Python's stdlib routine os.path.relpath(), which is not yet available in
+    Python 2.4.
+
+    """
+    # Fall back onto stdlib version of it, if available
+    if try_stdlib:
+        try:
+            return os.path.relpath(path, start)
+        except AttributeError:
+            # Python versions below 2.6 don't have the relpath function
+            # It's ok, we fall back onto our own implementation
+            pass
+
+    fullp = os.path.abspath(path)
+    fulls = os.path.abspath(start)
+    matchs = os.path.normpath(start)
+    if not matchs.endswith(os.sep):
+        matchs += os.sep
+
+    if fullp == fulls:
+        return '.'
+    elif fullp.startswith(matchs):
+        return fullp[len(matchs):]
+    else:
+        # Strip dirs off of fulls until it is a prefix of fullp
+        path_prefixes = []
+        while True:
+            path_prefixes.append(os.path.pardir)
+            fulls = os.path.dirname(fulls)
+            if fullp.startswith(fulls):
+                break
+        remainder = fullp[len(fulls):]
+        if remainder.startswith(os.sep):
+            remainder = remainder[len(os.sep):]
+        path_prefix = os.sep.join(path_prefixes)
+        return os.path.join(path_prefix, remainder)
+
+
+def _vim_literal(value):
+    # JSON happens to be valid Vim expression syntax for the values we need
+    # (lists, dicts, strings and numbers), except for floats: Vim wants a
+    # "." in every one of them (5.0e-6, not 5e-06)
+    if isinstance(value, float):
+        mantissa, e, exponent = repr(value).partition('e')
+        if '.' not in mantissa:
+            mantissa += '.0'
+        return mantissa + e + exponent
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (json.dumps(k), _vim_literal(v))
+                                  for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_vim_literal(v) for v in value)
+    return json.dumps(value)
+
+
+def _to_text(line):
+    if isinstance(line, bytes):
+        return line.decode('utf-8', 'replace')
+    return line
+
+
+def strip_prefix(s, prefix):
+    if prefix != "" and s.startswith(prefix):
+        return s[len(prefix):]
+    else:
+        return s
+
+
+def is_home_dir(path):
+    return os.path.realpath(path) == os.path.expandvars("$HOME")
+
+
+def is_fs_root(path):
+    return os.path.realpath(path) == "/" or \
+           (config.stop_at_home_dir and is_home_dir(path))
+
+
+# Maps (real) directory paths to the project root they live under, along with
+# the signature of that root's indicator files at the time it was discovered.
+# Every directory visited while walking up is recorded, so that sibling files
+# resolve without touching the filesystem again.  The (absolute) paths that
+# were asked about are recorded as well, so that asking again doesn't need to
+# resolve their symlinks first.
+_project_roots = {}
+
+
+def _root_signature(root, indicators):
+    signature = []
+    for i in indicators:
+        try:
+            signature.append(os.stat(os.path.join(root, i)).st_mtime)
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _cached_project_root(path, indicators):
+    try:
+        root, cached_indicators, signature = _project_roots[path]
+    except KeyError:
+        return None
+    if cached_indicators != indicators or \
+       _root_signature(root, indicators) != signature:
+        # The indicator files have changed since we last looked, so every
+        # entry pointing at this root is suspect
+        for key, value in list(_project_roots.items()):
+            if value[0] == root:
+                del _project_roots[key]
+        return None
+    return root
+
+
+@profiler.timed('project root')
+def find_project_root(path='.'):
+    indicators = config.indicators
+    abspath = os.path.abspath(path)
+    root = _cached_project_root(abspath, indicators)
+    if root is not None:
+        return root
+    if os.path.isdir(path):
+        path = os.path.realpath(path)
+    else:
+        path = os.path.dirname(os.path.realpath(path))
+    root = _find_project_root(path, indicators)
+    _project_roots[abspath] = _project_roots[path]
+    return root
+
+
+def _find_project_root(path, indicators):
+    root = _cached_project_root(path, indicators)
+    if root is not None:
+        return root
+
+    visited = []
+    while not is_fs_root(path):
+        visited.append(path)
+        for i in indicators:
+            if os.path.exists(os.path.join(path, i)):
+                signature = _root_signature(path, indicators)
+                for d in visited:
+                    _project_roots[d] = (path, indicators, signature)
+                return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+        root = _cached_project_root(path, indicators)
+        if root is not None:
+            for d in visited:
+                _project_roots[d] = _project_roots[path]
+            return root
+    raise Exception("Could not find project root")
+
+
+def find_project_root_or_none(path='.'):
+    try:
+        return find_project_root(path)
+    except Exception:
+        return None
+
+
+class DirCache(object):
+    """Answers whether paths exist from directory listings, which are kept
+    until the mtime of the directory changes.  Checking any number of paths
+    in a directory costs a single stat of that directory, instead of a stat
+    for every path.
+
+    """
+    # Directories changed this recently may change again within the
+    # resolution of their mtime, so their listings are not kept
+    racy_secs = 2
+
+    def __init__(self):
+        self.listings = {}
+
+    def clear(self):
+        self.listings.clear()
+
+    def entries(self, directory):
+        """Maps each name in the given directory to whether it's a directory
+        (or to None if that is not known yet).  Returns None if the directory
+        can't be listed.
+
+        """
+        directory = os.path.abspath(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            self.listings.pop(directory, None)
+            return None
+        cached = self.listings.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            if hasattr(os, 'scandir'):
+                entries = dict((entry.name, entry.is_dir())
+                               for entry in os.scandir(directory))
+            else:
+                entries = dict.fromkeys(os.listdir(directory))
+        except OSError:
+            return None
+        if time.time() - mtime > self.racy_secs:
+            self.listings[directory] = (mtime, entries)
+        return entries
+
+    def _lookup(self, path):
+        path = os.path.abspath(path)
+        entries = self.entries(os.path.dirname(path))
+        if not entries or os.path.basename(path) not in entries:
+            return False
+        is_dir = entries[os.path.basename(path)]
+        if is_dir is None:
+            is_dir = entries[os.path.basename(path)] = os.path.isdir(path)
+        return is_dir and 'dir' or 'file'
+
+    @profiler.timed('file probes')
+    def exists(self, path):
+        return bool(self._lookup(path))
+
+    @profiler.timed('file probes')
+    def isfile(self, path):
+        return self._lookup(path) == 'file'
+
+    @profiler.timed('file probes')
+    def isdir(self, path):
+        return self._lookup(path) == 'dir'
+
+
+_dir_cache = DirCache()
+
+
+def cache_path(project_root, name):
+    """Returns the path of the named cache file under the project root,
+    creating the cache directory if needed.
+
+    """
+    cache_dir = os.path.join(project_root, config.cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, name)
+
+
+def _load_json(path, default):
+    try:
+        return json.load(open(path))
+    except (IOError, ValueError):
+        return default
+
+
+def _save_json(path, data):
+    # Write to a temporary file first, so readers never see half a file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'w')
+    try:
+        json.dump(data, f)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def clear_caches():
+    config.invalidate()
+    _project_roots.clear()
+    _import_graphs.clear()
+    _buffer_test_indexes.clear()
+    _dir_cache.clear()
+    _filename_indexes.clear()
+    _layouts.clear()
+
+
+#
+# Classes that implement TestLayouts
+#
+
+class BaseTestLayout(object):
+    def __init__(self, project_root=None, overrides=None):
+        overrides = overrides or {}
+        self.source_root = overrides.get('source_root', config.source_root)
+        self.test_root = overrides.get('test_root', config.test_root)
+        self.prefix = config.prefix
+        self._project_root = project_root
+
+    @property
+    def project_root(self):
+        # Looked up only once for each layout instance
+        if self._project_root is None:
+            self._project_root = find_project_root()
+        return self._project_root
+
+
+    # Helper methods, to be used in subclasses
+    def break_down(self, path):
+        parts = path.split(os.sep)
+        if len(parts) > 0:
+            if parts[-1] == '__init__.py':
+                del parts[-1]
+            elif parts[-1].endswith(".py"):
+                parts[-1] = parts[-1][:-len(".py")]
+        return parts
+
+    def glue_parts(self, parts, use_under_under_init=False):
+        if use_under_under_init:
+            parts = parts + ['__init__.py']
+        else:
+            parts = parts[:-1] + [parts[-1] + '.py']
+        return os.sep.join(parts)
+
+    def relatize(self, path):
+        return _relpath(path, self.project_root)
+
+    def absolutify(self, path):
+        if os.path.isabs(path):
+            return path
+        return os.sep.join([self.project_root, path])
+
+
+    def get_import_graph(self):
+        return load_import_graph(self.project_root, self.source_root)
+
+    def get_dependent_test_files(self, path):
+        """Returns the test files that (transitively) import the given
+        file.
+
+        """
+        dependents = self.get_import_graph().dependents([self.absolutify(path)])
+        return sorted(p for p in dependents if self.is_test_file(p))
+
+
+    # The actual BaseTestLayout methods that need implementation
+    def is_test_file(self, some_file):
+        raise NotImplemented("Implement this method in a subclass.")
+
+    def get_test_file(self, source_file):
+        raise NotImplemented("Implement this method in a subclass.")
+
+    def get_source_candidates(self, test_file):
+        raise NotImplemented("Implement this method in a subclass.")
+
+    def get_source_file(self, test_file):
+        for candidate in self.get_source_candidates(test_file):
+            if _dir_cache.exists(self.absolutify(candidate)):
+                return candidate
+        raise RuntimeError("Source file not found.")
+
+
+class SideBySideLayout(BaseTestLayout):
+    def is_test_file(self, some_file):
+        some_file = self.relatize(some_file)
+        parts = self.break_down(some_file)
+        filepart = parts[-1]
+        return filepart.startswith(self.prefix)
+
+    def get_test_file(self, source_file):
+        source_file = self.relatize(source_file)
+        parts = self.break_down(source_file)
+        parts[-1] = self.prefix + parts[-1]
+        return self.glue_parts(parts)
+
+    def get_source_candidates(self, test_file):
+        test_file = self.relatize(test_file)
+        parts = self.break_down(test_file)
+        filepart = parts[-1]
+        if not filepart.startswith(self.prefix):
+            raise RuntimeError("Not a test file.")
+        parts[-1] = filepart[len(self.prefix):]
+        return [self.glue_parts(parts)]
+
+
+class FlatLayout(BaseTestLayout):
+    def is_test_file(self, some_file):
+        some_file = self.relatize(some_file)
+        if not some_file.startswith(self.test_root):
+            return False
+
+        some_file = _relpath(some_file, self.test_root)
+
+        parts = self.break_down(some_file)
+        if len(parts) != 1:
+            return False
+        return parts[0].startswith(self.prefix)
+
+    def get_test_file(self, source_file):
+        source_file = self.relatize(source_file)
+        if not source_file.startswith(self.source_root):
+            raise RuntimeError("File %s is not under the source root." % source_file)
+
+        source_file = _relpath(source_file, self.source_root)
+        parts = self.break_down(source_file)
+        flat_file_name = "_".join(parts)
+        parts = [self.test_root] + [self.prefix + flat_file_name]
+        return self.glue_parts(parts)
+
+    def get_source_candidates(self, test_file):
+        test_file = self.relatize(test_file)
+        if not test_file.startswith(self.test_root):
+            raise RuntimeError("File %s is not under the test root." % test_file)
+
+        test_file = _relpath(test_file, self.test_root)
+        parts = self.break_down(test_file)
+        if len(parts) != 1:
+            raise RuntimeError("Flat tests layout does not allow tests to be more than one directory deep.")
+        file_name = strip_prefix(parts[0], self.prefix)
+        parts = file_name.split("_")
+        parts = [self.source_root] + parts
+        return [self.glue_parts(parts, x) for x in (False, True)]
+
+
+class FollowHierarchyLayout(BaseTestLayout):
+    def is_test_file(self, some_file):
+        some_file = self.relatize(some_file)
+        if not some_file.startswith(self.test_root):
+            return False
+
+        some_file = _relpath(some_file, self.test_root)
+
+        parts = self.break_down(some_file)
+        for p in parts:
+            if not p.startswith(self.prefix):
+                return False
+        return True
+
+    def get_test_file(self, source_file):
+        source_file = self.relatize(source_file)
+        if not source_file.startswith(self.source_root):
+            raise RuntimeError("File %s is not under the source root." % source_file)
+
+        source_file = _relpath(source_file, self.source_root)
+        parts = self.break_down(source_file)
+        parts = [self.test_root] + [self.prefix + p for p in parts]
+        return self.glue_parts(parts)
+
+    def get_source_candidates(self, test_file):
+        test_file = self.relatize(test_file)
+        if not test_file.startswith(self.test_root):
+            raise RuntimeError("File %s is not under the test root." % test_file)
+
+        test_file = _relpath(test_file, self.test_root)
+        parts = self.break_down(test_file)
+        parts = [strip_prefix(p, self.prefix) for p in parts]
+        if self.source_root:
+            parts = [self.source_root] + parts
+        result = [self.glue_parts(parts, x) for x in (False, True)]
+        return result
+
+
+class NoseLayout(BaseTestLayout):
+    def is_test_file(self, some_file):
+        some_file = self.relatize(some_file)
+        if not some_file.startswith(self.test_root):
+            return False
+
+        some_file = _relpath(some_file, self.test_root)
+
+        parts = self.break_down(some_file)
+        return parts[-1].startswith(self.prefix)
+
+    def get_test_file(self, source_file):
+        source_file = self.relatize(source_file)
+        if not source_file.startswith(self.source_root):
+            raise RuntimeError("File %s is not under the source root." % source_file)
+
+        source_file = _relpath(source_file, self.source_root)
+        parts = self.break_down(source_file)
+        parts[-1] = self.prefix + parts[-1]
+        parts = [self.test_root] + parts
+        return self.glue_parts(parts)
+
+    def get_source_candidates(self, test_file):
+        test_file = self.relatize(test_file)
+        if not test_file.startswith(self.test_root):
+            raise RuntimeError("File %s is not under the test root." % test_file)
+
+        test_file = _relpath(test_file, self.test_root)
+        parts = self.break_down(test_file)
+        parts = [strip_prefix(p, self.prefix) for p in parts]
+        if self.source_root:
+            parts = [self.source_root] + parts
+        result = [self.glue_parts(parts, x) for x in (False, True)]
+        return result
+
+
+def get_implementing_class(test_layout=None):
+    implementations = {
+        'flat': FlatLayout,
+        'follow-hierarchy': FollowHierarchyLayout,
+        'side-by-side': SideBySideLayout,
+        'nose': NoseLayout,
+    }
+    if test_layout is None:
+        test_layout = config.tests_structure
+    try:
+        return implementations[test_layout]
+    except KeyError:
+        raise RuntimeError('No such test layout: %s' % test_layout)
+
+
+class LayoutRegistry(object):
+    """The test layout of each project root that has been worked in this
+    session.  A root's layout is built once, from the settings (and the b:
+    overrides) of the buffer it was first needed for, so that buffers of
+    several projects can be open side by side without each of them
+    rediscovering its layout over and over.
+
+    """
+    def __init__(self):
+        self.layouts = {}
+        self.generation = None
+
+    def get(self, path='.'):
+        if self.generation != config.generation:
+            self.clear()
+            self.generation = config.generation
+        project_root = find_project_root(path)
+        layout = self.layouts.get(project_root)
+        if layout is None:
+            overrides = config.buffer_overrides()
+            cls = get_implementing_class(overrides.get('tests_structure'))
+            layout = cls(project_root, overrides)
+            self.layouts[project_root] = layout
+        return layout
+
+    def clear(self):
+        self.layouts.clear()
+
+
+_layouts = LayoutRegistry()
+
+
+@profiler.timed('layout')
+def get_layout(path='.'):
+    """Returns the test layout of the project the given path is in."""
+    return _layouts.get(path)
+
+
+#
+# Resolving many counterparts at once
+#
+
+def is_excluded_dir(name):
+    """Whether the directory with the given name is never searched for Python
+    files: hidden ones, and those matching g:PyUnitExcludeDirs.
+
+    """
+    if name.startswith('.'):
+        return True
+    for pattern in config.exclude_dirs:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def is_environment(dirnames, filenames):
+    """Whether the directory with the given contents is a virtualenv (or a
+    conda environment), whatever it's called.
+
+    """
+    return 'pyvenv.cfg' in filenames or 'conda-meta' in dirnames
+
+
+def find_python_files(path):
+    """Yields all Python files under the given directory, skipping excluded
+    directories and Python environments.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        if dirpath != path and is_environment(dirnames, filenames):
+            dirnames[:] = []
+            continue
+        dirnames[:] = sorted(d for d in dirnames if not is_excluded_dir(d))
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                yield os.path.join(dirpath, filename)
+
+
+def _existing_files(paths):
+    """Returns the subset of the given (absolute) paths that exist as files,
+    listing each directory only once instead of stat'ing every path.
+
+    """
+    by_dir = {}
+    for path in paths:
+        by_dir.setdefault(os.path.dirname(path), []).append(path)
+
+    existing = set()
+    for directory, candidates in by_dir.items():
+        names = _dir_cache.entries(directory)
+        if not names:
+            continue
+        for path in candidates:
+            if os.path.basename(path) in names:
+                existing.add(path)
+    return existing
+
+
+class CounterpartResolver(object):
+    """Maps many source files to their test files (and back) using a single
+    layout instance and a single project root lookup.
+
+    """
+    def __init__(self, layout=None):
+        if layout is None:
+            layout = get_layout()
+        self.layout = layout
+
+    def _expand(self, paths):
+        if isinstance(paths, str) and os.path.isdir(paths):
+            paths = find_python_files(paths)
+        return [os.path.abspath(p) for p in paths]
+
+    def test_files_for(self, paths):
+        """Returns a dict mapping each source file to its (absolute) test
+        file.  Test files and files outside of the source root are left out.
+
+        """
+        result = {}
+        for path in self._expand(paths):
+            if self.layout.is_test_file(path):
+                continue
+            try:
+                test_file = self.layout.get_test_file(path)
+            except RuntimeError:
+                continue
+            result[path] = self.layout.absolutify(test_file)
+        return result
+
+    def source_files_for(self, paths):
+        """Returns a dict mapping each test file to its (absolute) source
+        file, or to None if none of the source candidates exist.
+
+        """
+        candidates = {}
+        for path in self._expand(paths):
+            try:
+                found = self.layout.get_source_candidates(path)
+            except RuntimeError:
+                continue
+            candidates[path] = [self.layout.absolutify(c) for c in found]
+
+        existing = _existing_files(c for cs in candidates.values() for c in cs)
+        result = {}
+        for path, cs in candidates.items():
+            result[path] = None
+            for c in cs:
+                if c in existing:
+                    result[path] = c
+                    break
+        return result
+
+    def untested_files(self, paths):
+        """Returns the sorted list of source files that have no test file.
+        Empty __init__.py files are not considered to need tests.
+
+        """
+        mapping = self.test_files_for(paths)
+        existing = _existing_files(mapping.values())
+        untested = []
+        for source, test_file in mapping.items():
+            if test_file in existing:
+                continue
+            if os.path.basename(source) == '__init__.py' and \
+               os.path.getsize(source) == 0:
+                continue
+            untested.append(source)
+        return sorted(untested)
+
+
+#
+# Finding counterparts of files that don't follow the layout
+#
+
+class FilenameIndex(object):
+    """All Python files under the project root, by file name.  The index is
+    built once; after that, only directories whose mtime changed are read
+    again.
+
+    """
+    def __init__(self, project_root):
+        self.project_root = project_root
+        self.files = {}
+        # The mtime of each directory, and the Python files in it
+        self.dirs = {}
+
+    def build(self):
+        self.files = {}
+        self.dirs = {}
+        self._walk(self.project_root)
+        return self
+
+    def _walk(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            if dirpath != self.project_root and \
+               is_environment(dirnames, filenames):
+                dirnames[:] = []
+                continue
+            dirnames[:] = [d for d in dirnames if not is_excluded_dir(d)]
+            self._read_dir(dirpath, filenames)
+
+    def _read_dir(self, dirpath, filenames):
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            return
+        if time.time() - mtime <= DirCache.racy_secs:
+            # Read it again next time, it may still be changing
+            mtime = None
+        new = set(os.path.join(dirpath, f) for f in filenames
+                  if f.endswith('.py'))
+        old = self.dirs.get(dirpath, (None, set()))[1]
+        for path in old - new:
+            self.discard(path)
+        for path in new - old:
+            self.add(path)
+        self.dirs[dirpath] = (mtime, new)
+
+    def add(self, path):
+        self.files.setdefault(os.path.basename(path), set()).add(path)
+        if os.path.dirname(path) in self.dirs:
+            self.dirs[os.path.dirname(path)][1].add(path)
+
+    def discard(self, path):
+        self.files.get(os.path.basename(path), set()).discard(path)
+
+    def update(self):
+        """Brings the index up to date with the directories on disk."""
+        for dirpath, (mtime, paths) in list(self.dirs.items()):
+            try:
+                current = os.stat(dirpath).st_mtime
+            except OSError:
+                for path in paths:
+                    self.discard(path)
+                del self.dirs[dirpath]
+                continue
+            if current == mtime:
+                continue
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                continue
+            self._read_dir(dirpath, names)
+            for name in names:
+                subdir = os.path.join(dirpath, name)
+                if not is_excluded_dir(name) and subdir not in self.dirs and \
+                   os.path.isdir(subdir):
+                    self._walk(subdir)
+
+    def lookup(self, name):
+        """Returns the sorted (absolute) paths of the files with the given
+        name.
+
+        """
+        if not self.files.get(name):
+            self.update()
+        return sorted(p for p in self.files.get(name, ())
+                      if _dir_cache.isfile(p))
+
+
+# Filename indexes that have been built this session, by project root
+_filename_indexes = {}
+
+
+def get_filename_index(project_root):
+    index = _filename_indexes.get(project_root)
+    if index is None:
+        index = _filename_indexes[project_root] = \
+                FilenameIndex(project_root).build()
+    return index
+
+
+def _path_parts(path, prefix):
+    # Test directories and test prefixes say nothing about where the
+    # counterpart of a file lives
+    parts = []
+    for part in path.split(os.sep):
+        if part in ('test', 'tests'):
+            continue
+        if prefix and part.startswith(prefix):
+            part = part[len(prefix):]
+        parts.append(part)
+    return parts
+
+
+def path_similarity(a, b, prefix=''):
+    """Scores how alike the given relative paths are: first by the number of
+    trailing path components they have in common, then by the overall
+    similarity of their components.
+
+    """
+    a, b = _path_parts(a, prefix), _path_parts(b, prefix)
+    common = 0
+    for x, y in zip(reversed(a), reversed(b)):
+        if x != y:
+            break
+        common += 1
+    return (common, difflib.SequenceMatcher(None, a, b).ratio())
+
+
+def looks_like_test_file(layout, path):
+    """Whether the given file is a test file, either according to the layout,
+    or just by its name.
+
+    """
+    return layout.is_test_file(path) or \
+           os.path.basename(path).startswith(layout.prefix)
+
+
+def _expected_counterparts(layout, path, want_test):
+    try:
+        if want_test:
+            return [layout.get_test_file(path)]
+        return layout.get_source_candidates(path)
+    except RuntimeError:
+        # Just guess by the file name
+        relpath = layout.relatize(path)
+        directory, filename = os.path.split(relpath)
+        if want_test:
+            filename = layout.prefix + filename
+        else:
+            filename = strip_prefix(filename, layout.prefix)
+        return [os.path.join(directory, filename)]
+
+
+def find_fuzzy_counterpart(path, layout=None):
+    """Returns the (absolute) file that is most likely the counterpart of the
+    given file, when it doesn't follow the layout, or None.  Candidates are
+    the files with the expected name anywhere in the project, ranked by how
+    much their paths look like the expected one.
+
+    """
+    if layout is None:
+        layout = get_layout(path)
+    path = os.path.abspath(path)
+    want_test = not looks_like_test_file(layout, path)
+    index = get_filename_index(layout.project_root)
+    best = None
+    for expected in _expected_counterparts(layout, path, want_test):
+        expected = layout.relatize(layout.absolutify(expected))
+        for candidate in index.lookup(os.path.basename(expected)):
+            if candidate == path or \
+               looks_like_test_file(layout, candidate) != want_test:
+                continue
+            score = path_similarity(expected, layout.relatize(candidate),
+                                    layout.prefix)
+            if best is None or score > best[0]:
+                best = (score, candidate)
+    return best and best[1]
+
+
+#
+# Static import graph of a project
+#
+
+def _parse_imports(path):
+    """Returns the imports in the given file as (module, names, level) tuples,
+    where names are the names imported with "from module import names".
+
+    """
+    try:
+        source = open(path).read()
+        tree = ast.parse(source, path)
+    except (IOError, SyntaxError, TypeError, ValueError):
+        return []
+
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append((alias.name, (), 0))
+        elif isinstance(node, ast.ImportFrom):
+            names = tuple(alias.name for alias in node.names)
+            imports.append((node.module or '', names, node.level or 0))
+    return imports
+
+
+class ImportGraph(object):
+    """Which project modules import which.  Files are identified by their
+    absolute path, and module names are derived from their location relative
+    to the project root (and to the source root, if there is one).
+
+    """
+    def __init__(self, project_root, source_root=''):
+        self.project_root = project_root
+        self.bases = [project_root]
+        if source_root:
+            self.bases.insert(0, os.path.join(project_root, source_root))
+        self.imports = {}
+        # (mtime, size) of each file at the time its imports were parsed
+        self.stats = {}
+        self._modules = None
+        self._importers = None
+
+    def module_names(self, path):
+        names = []
+        for base in self.bases:
+            if not path.startswith(base + os.sep):
+                continue
+            parts = path[len(base) + 1:].split(os.sep)
+            if parts[-1] == '__init__.py':
+                del parts[-1]
+            else:
+                parts[-1] = parts[-1][:-len('.py')]
+            if parts:
+                names.append('.'.join(parts))
+        return names
+
+    def add_file(self, path, imports=None):
+        if imports is None:
+            imports = _parse_imports(path)
+        self.imports[path] = imports
+        self._modules = self._importers = None
+
+    def build(self, paths=None):
+        if paths is None:
+            paths = find_python_files(self.project_root)
+        for path in paths:
+            self.add_file(path)
+        return self
+
+    def update(self):
+        """Brings the graph up to date with the files on disk, re-parsing only
+        the files that changed.  Returns whether anything changed.
+
+        """
+        changed = False
+        present = set()
+        for path in find_python_files(self.project_root):
+            present.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stat = (st.st_mtime, st.st_size)
+            if self.stats.get(path) != stat:
+                self.add_file(path)
+                self.stats[path] = stat
+                changed = True
+        for path in list(self.imports):
+            if path not in present:
+                del self.imports[path]
+                self.stats.pop(path, None)
+                self._modules = self._importers = None
+                changed = True
+        return changed
+
+    @property
+    def modules(self):
+        if self._modules is None:
+            self._modules = {}
+            for path in self.imports:
+                for name in self.module_names(path):
+                    self._modules.setdefault(name, path)
+        return self._modules
+
+    def _resolve(self, path, module, names, level):
+        if level:
+            # Relative import: strip the module (and parent packages) off
+            # the importing module's name
+            own = self.module_names(path)
+            if not own:
+                return []
+            package = own[0].split('.')
+            if os.path.basename(path) != '__init__.py':
+                package = package[:-1]
+            if level > 1:
+                package = package[:-(level - 1)]
+            module = '.'.join([p for p in package + [module] if p])
+
+        # Only the most specific module counts: "from foo import bar" depends
+        # on foo/bar.py if that exists, and on foo/__init__.py otherwise
+        resolved = []
+        if module:
+            for n in names:
+                if module + '.' + n in self.modules:
+                    resolved.append(self.modules[module + '.' + n])
+            if resolved:
+                return resolved
+            candidates = [module]
+        else:
+            candidates = [n for n in names if n != '*']
+
+        for name in candidates:
+            # "import foo.bar.baz" falls back onto foo.bar or foo, if baz is
+            # not a module within the project
+            while name:
+                if name in self.modules:
+                    resolved.append(self.modules[name])
+                    break
+                name = name.rpartition('.')[0]
+        return resolved
+
+    def dependencies(self, path):
+        """Returns the project files the given file imports directly."""
+        result = set()
+        for module, names, level in self.imports.get(path, ()):
+            result.update(self._resolve(path, module, names, level))
+        result.discard(path)
+        return result
+
+    def all_dependencies(self, path):
+        """Returns all project files the given file (transitively) imports."""
+        seen = set()
+        todo = [path]
+        while todo:
+            for dep in self.dependencies(todo.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    todo.append(dep)
+        seen.discard(path)
+        return seen
+
+    @property
+    def importers(self):
+        if self._importers is None:
+            self._importers = {}
+            for path in self.imports:
+                for dep in self.dependencies(path):
+                    self._importers.setdefault(dep, set()).add(path)
+        return self._importers
+
+    def dependents(self, paths):
+        """Returns all files that (transitively) import any of the given
+        files.
+
+        """
+        seen = set()
+        todo = list(paths)
+        while todo:
+            for importer in self.importers.get(todo.pop(), ()):
+                if importer not in seen:
+                    seen.add(importer)
+                    todo.append(importer)
+        return seen
+
+    def external_modules(self):
+        """Returns the sorted top-level names of the modules the project
+        imports from outside of itself (the standard library and third-party
+        packages).
+
+        """
+        result = set()
+        for path, imports in self.imports.items():
+            for module, names, level in imports:
+                if level or not module or module == '__future__':
+                    continue
+                if not self._resolve(path, module, names, level):
+                    result.add(module.split('.')[0])
+        return sorted(result)
+
+
+# Import graphs that have been loaded (and brought up to date) this session,
+# by project root
+_import_graphs = {}
+
+IMPORT_INDEX_VERSION = 1
+
+
+def load_import_graph(project_root, source_root=''):
+    """Returns the import graph of the project.  The graph is kept on disk
+    under the project root; only files whose mtime or size changed since it
+    was last saved are parsed again.
+
+    """
+    index_path = cache_path(project_root, 'imports.json')
+    graph = _import_graphs.get((project_root, source_root))
+    if graph is None:
+        graph = ImportGraph(project_root, source_root)
+        index = _load_json(index_path, {})
+        if index.get('version') == IMPORT_INDEX_VERSION:
+            for relpath, (mtime, size, imports) in index['files'].items():
+                path = os.path.join(project_root, relpath)
+                graph.add_file(path, [(m, tuple(n), l) for m, n, l in imports])
+                graph.stats[path] = (mtime, size)
+        _import_graphs[(project_root, source_root)] = graph
+
+    if graph.update():
+        files = {}
+        for path, imports in graph.imports.items():
+            mtime, size = graph.stats[path]
+            files[_relpath(path, project_root)] = [mtime, size, imports]
+        _save_json(index_path, {'version': IMPORT_INDEX_VERSION,
+                                'files': files})
+    return graph
+
+
+#
+# Selecting the tests affected by a change
+#
+
+# Files written from within Vim since the last test run
+_written_files = set()
+
+
+def note_written_file(path):
+    path = os.path.abspath(path)
+    _written_files.add(path)
+    for root, index in _filename_indexes.items():
+        if path.startswith(root + os.sep):
+            index.add(path)
+
+
+def changed_files_since(ref, project_root):
+    """Returns the (absolute) paths of all Python files that differ from the
+    given git ref, including untracked files.
+
+    """
+    cmds = [['git', 'diff', '--name-only', '--relative', ref, '--'],
+            ['git', 'ls-files', '--others', '--exclude-standard']]
+    changed = set()
+    for cmd in cmds:
+        proc = subprocess.Popen(cmd, cwd=project_root, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("git failed: %s" % _to_text(err).strip())
+        for line in _to_text(out).splitlines():
+            if line.endswith('.py'):
+                changed.add(os.path.join(project_root, line))
+    return changed
+
+
+def find_impacted_test_files(changed, layout, graph):
+    """Returns the sorted list of existing test files that may be affected by
+    changes to the given files: the changed test files themselves, the test
+    files of the changed sources, and all test files that (transitively)
+    import any of them.
+
+    """
+    changed = set(changed)
+    candidates = set()
+    for path in changed | graph.dependents(changed):
+        if layout.is_test_file(path):
+            candidates.add(path)
+        elif path in changed:
+            try:
+                candidates.add(layout.absolutify(layout.get_test_file(path)))
+            except RuntimeError:
+                pass
+    return sorted(_existing_files(candidates))
+
+
+#
+# Test runners
+#
+
+# The outcome of a single test, as reported by a runner.  path is the
+# (absolute) test file, test_id is "Class.method" (or "function"), status is
+# one of "passed", "failure", "error" or "skipped", and filename and lnum
+# locate the failure, if any.  text is a one-line summary of the failure, and
+# details its full traceback, along with any output the test captured.
+TestResult = namedtuple('TestResult',
+                        'path test_id status secs filename lnum text details')
+
+
+def _which(executable):
+    if os.sep in executable:
+        return os.access(executable, os.X_OK)
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(directory, executable), os.X_OK):
+            return True
+    return False
+
+
+def find_dotted_name(name, project_root):
+    """Splits a dotted name (like "tests.test_foo.TestFoo.test_bar") into the
+    (absolute) module file it lives in and the name within that module.
+    Returns (None, name) if there is no such module in the project.
+
+    """
+    bases = [project_root]
+    source_root = get_layout(project_root).source_root
+    if source_root:
+        bases.append(os.path.join(project_root, source_root))
+    parts = name.split('.')
+    for i in range(len(parts), 0, -1):
+        paths = [os.path.join(base, *parts[:i]) + '.py' for base in bases]
+        existing = [path for path in paths if _dir_cache.isfile(path)]
+        if existing:
+            return existing[0], '.'.join(parts[i:])
+    return None, name
+
+
+class BaseRunner(object):
+    """Knows how to build the command line of a test runner, and how to read
+    its results.  Runners without a report_name print their results in nose's
+    machineout format; all others write a report file, which is read once the
+    run has finished.
+
+    """
+    report_name = None
+    stop_option = None
+
+    def __init__(self, project_root=None):
+        self._project_root = project_root
+
+    @property
+    def project_root(self):
+        if self._project_root is None:
+            self._project_root = find_project_root()
+        return self._project_root
+
+    @property
+    def source_root(self):
+        return get_layout(self.project_root).source_root
+
+    @property
+    def executable(self):
+        return shlex.split(self.base_command())[0]
+
+    def report_path(self, index=0):
+        name = self.report_name
+        if index:
+            base, ext = os.path.splitext(name)
+            name = '%s-%d%s' % (base, index, ext)
+        return cache_path(self.project_root, name)
+
+    def coverage_command(self, rcfile):
+        return ' '.join([_shell_quote(config.worker_python), '-m', 'coverage',
+                         'run', '--rcfile=%s' % _shell_quote(rcfile),
+                         self.python_command()])
+
+    def command(self, args, stop=False, report=None, coverage=None):
+        """Returns the command that runs the given tests.  With a coverage
+        rcfile, the tests are run under coverage.py.
+
+        """
+        if coverage is not None:
+            parts = [self.coverage_command(coverage)]
+        else:
+            parts = [self.base_command()]
+        if stop and self.stop_option:
+            parts.append(self.stop_option)
+        if report is not None:
+            parts.extend(self.report_options(report))
+        parts.extend(_shell_quote(self.translate_arg(arg))
+                     for arg in shlex.split(args))
+        cmd = ' '.join(parts)
+        if self.source_root:
+            cmd = 'PYTHONPATH=%s %s' % (self.source_root, cmd)
+        return cmd
+
+    # The actual BaseRunner methods that need implementation
+    def base_command(self):
+        raise NotImplementedError("Implement this method in a subclass.")
+
+    def python_command(self):
+        """Returns the command as arguments to the Python interpreter, which
+        is how it's run under coverage.py.
+
+        """
+        raise NotImplementedError("Implement this method in a subclass.")
+
+    def report_options(self, report):
+        return []
+
+    def translate_arg(self, arg):
+        """Turns a test file, or a path:Class.method selector, into the
+        runner's own syntax.
+
+        """
+        return arg
+
+    def read_report(self, report):
+        """Returns the TestResults in the given report, or None if there is
+        no (readable) report.
+
+        """
+        return None
+
+
+class NoseRunner(BaseRunner):
+    stop_option = '--stop'
+
+    def base_command(self):
+        return config.cmd
+
+    def python_command(self):
+        options = shlex.split(config.cmd)[1:]
+        return ' '.join(['-m', 'nose'] + [_shell_quote(o) for o in options])
+
+
+# The frames of a Python traceback
+traceback_frame_re = re.compile(r'^\s*File "(.+?)", line (\d+)', re.M)
+
+
+class JUnitRunner(BaseRunner):
+    """A runner that writes its results to a JUnit XML report."""
+    report_name = 'junit.xml'
+
+    traceback_res = [
+        # Python's own tracebacks
+        traceback_frame_re,
+        # pytest's
+        re.compile(r'^(\S+?\.py):(\d+): ', re.M),
+    ]
+
+    def __init__(self, project_root=None):
+        super(JUnitRunner, self).__init__(project_root)
+        self._test_files = {}
+        self._test_indexes = {}
+        self._local_files = {}
+
+    def test_file(self, classname):
+        """Returns the test file of the given (dotted) class name, along with
+        the class name within that file.
+
+        """
+        if classname not in self._test_files:
+            self._test_files[classname] = find_dotted_name(classname,
+                                                           self.project_root)
+        return self._test_files[classname]
+
+    def local_file(self, filename):
+        """Returns the file within the project that the given file (from a
+        traceback) refers to, or None.  Reports from elsewhere (e.g. a CI
+        server) have the project at some other location, so the longest
+        trailing part of the path that exists within the project is used.
+
+        """
+        if filename not in self._local_files:
+            found = None
+            if os.sep + 'site-packages' + os.sep not in filename:
+                path = os.path.join(self.project_root, filename)
+                if path.startswith(self.project_root + os.sep):
+                    found = path
+                elif os.path.isabs(filename):
+                    parts = filename.split(os.sep)
+                    for i in range(1, len(parts)):
+                        path = os.path.join(self.project_root, *parts[i:])
+                        if _dir_cache.isfile(path):
+                            found = path
+                            break
+            self._local_files[filename] = found
+        return self._local_files[filename]
+
+    def failure_location(self, text):
+        """Returns the innermost location within the project in the given
+        traceback.
+
+        """
+        found = (-1, None, 0)
+        for regex in self.traceback_res:
+            for match in regex.finditer(text):
+                filename = self.local_file(match.group(1))
+                if filename is not None and match.start() > found[0]:
+                    found = (match.start(), filename, int(match.group(2)))
+        return found[1:]
+
+    def test_index(self, path):
+        if path not in self._test_indexes:
+            try:
+                self._test_indexes[path] = index_tests(open(path).read())
+            except IOError:
+                self._test_indexes[path] = []
+        return self._test_indexes[path]
+
+    def read_testcase(self, case):
+        path, class_name = self.test_file(case.get('classname', ''))
+        if path is None and case.get('file'):
+            path = os.path.join(self.project_root, case.get('file'))
+        # Parametrized tests count as one
+        name = re.sub(r'\[.*\]$', '', case.get('name', ''))
+        test_id = '.'.join([p for p in [class_name, name] if p])
+
+        status, filename, lnum, text = 'passed', None, 0, ''
+        details = []
+        for child in case:
+            if child.tag in ('failure', 'error'):
+                status = child.tag
+                body = child.text or ''
+                text = child.get('message') or body.strip()
+                text = ' '.join(line.strip() for line in text.splitlines()
+                                if line.strip())
+                filename, lnum = self.failure_location(body)
+                details.insert(0, body.strip('\n') or text)
+            elif child.tag == 'skipped' and status == 'passed':
+                status = 'skipped'
+            elif child.tag in ('system-out', 'system-err') and child.text:
+                details.append('Captured %s:\n%s' % (
+                    child.tag[len('system-'):], child.text.strip('\n')))
+        if status in ('failure', 'error') and filename is None and path:
+            filename = path
+            for first, last, found_id in self.test_index(path):
+                if found_id == test_id:
+                    lnum = first
+        if filename is not None:
+            filename = _relpath(filename, '.')
+        try:
+            secs = float(case.get('time') or 0)
+        except ValueError:
+            secs = 0.0
+        if status not in ('failure', 'error'):
+            details = []
+        return TestResult(path, test_id, status, secs, filename, lnum, text,
+                          '\n\n'.join(details))
+
+    def iter_report(self, report):
+        """Yields the TestResults in the given report, one by one.  Reports
+        can be huge, so they are never held in memory as a whole: each
+        testcase is dropped from the tree as soon as it has been read.
+
+        """
+        parents = []
+        for event, elem in ElementTree.iterparse(report, ('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag == 'testcase':
+                yield self.read_testcase(elem)
+            # The children of a testcase are needed until it ends; anything
+            # else (testcases, suites, their output) can go right away
+            if parents and parents[-1].tag != 'testcase':
+                parents[-1].remove(elem)
+                elem.clear()
+
+    def read_report(self, report):
+        try:
+            return list(self.iter_report(report))
+        except (IOError, OSError, SyntaxError):
+            return None
+
+
+class JUnitSummary(object):
+    """The aggregate counts of a JUnit report, plus its failures and errors
+    (but none of the tests that passed or were skipped).
+
+    """
+    statuses = ('passed', 'failure', 'error', 'skipped')
+
+    def __init__(self):
+        self.counts = dict((status, 0) for status in self.statuses)
+        self.secs = 0.0
+        self.failures = []
+
+    def add(self, result):
+        self.counts[result.status] += 1
+        self.secs += result.secs
+        if result.status in ('failure', 'error'):
+            self.failures.append(result)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def describe(self):
+        return '%d tests, %d failures, %d errors, %d skipped in %.2fs' % (
+            self.total, self.counts['failure'], self.counts['error'],
+            self.counts['skipped'], self.secs)
+
+
+class UnittestRunner(JUnitRunner):
+    """The standard library's unittest, driven by pyunit_worker.py for a
+    single run, which writes a JUnit report.
+
+    """
+    stop_option = '--failfast'
+
+    def base_command(self):
+        return '%s %s' % (_shell_quote(config.worker_python),
+                          self.python_command())
+
+    def python_command(self):
+        cmd = [config.worker_script, '--once']
+        if self.source_root:
+            cmd.extend(['--path', self.source_root])
+        cmd.append(self.project_root)
+        return ' '.join(_shell_quote(part) for part in cmd)
+
+    def report_options(self, report):
+        return ['--junit-xml', _shell_quote(report)]
+
+    def translate_arg(self, arg):
+        path, sep, selector = arg.partition(':')
+        return os.path.abspath(path) + sep + selector
+
+
+def load_junit_report(path, project_root=None):
+    """Reads the given JUnit report (written by any runner), and returns its
+    JUnitSummary.
+
+    """
+    summary = JUnitSummary()
+    for result in JUnitRunner(project_root).iter_report(path):
+        summary.add(result)
+    return summary
+
+
+class PytestRunner(JUnitRunner):
+    stop_option = '-x'
+
+    def base_command(self):
+        return config.pytest_cmd
+
+    def python_command(self):
+        options = shlex.split(config.pytest_cmd)[1:]
+        return ' '.join(['-m', 'pytest'] + [_shell_quote(o) for o in options])
+
+    def report_options(self, report):
+        # The xunit1 flavour has the file of each test
+        return ['--junitxml=%s' % _shell_quote(report),
+                '-o', 'junit_family=xunit1']
+
+    def translate_arg(self, arg):
+        path, _, selector = arg.partition(':')
+        return '::'.join([path] + [p for p in selector.split('.') if p])
+
+
+class Nose2Runner(JUnitRunner):
+    stop_option = '--fail-fast'
+
+    def base_command(self):
+        return config.nose2_cmd
+
+    def python_command(self):
+        options = shlex.split(config.nose2_cmd)[1:]
+        return ' '.join(['-m', 'nose2'] + [_shell_quote(o) for o in options])
+
+    def report_options(self, report):
+        return ['--plugin', 'nose2.plugins.junitxml', '--junit-xml',
+                '--junit-xml-path', _shell_quote(report)]
+
+    def translate_arg(self, arg):
+        # nose2 selects tests by their dotted names only
+        path, _, selector = arg.partition(':')
+        if not path.endswith('.py'):
+            return arg
+        graph = ImportGraph(self.project_root, self.source_root)
+        names = graph.module_names(os.path.abspath(path))
+        if not names:
+            return arg
+        return '.'.join([p for p in [names[0], selector] if p])
+
+
+def get_runner():
+    runners = {
+        'nose': NoseRunner,
+        'pytest': PytestRunner,
+        'unittest': UnittestRunner,
+        'nose2': Nose2Runner,
+    }
+    try:
+        return runners[config.runner]
+    except KeyError:
+        raise RuntimeError('No such test runner: %s' % config.runner)
+
+
+#
+# Parsing test output into the quickfix list
+#
+
+class MachineOutParser(object):
+    """Incrementally parses the output of nose's machineout plugin.  Each line
+    is turned into a quickfix entry as soon as it arrives.  Repeated failures
+    (e.g. the same broken setUp() hit by hundreds of tests) are only reported
+    once, and no more than max_entries entries are ever kept.
+
+    """
+    line_re = re.compile(r'^(.*?):(\d+): (?:fail|error): (.*)$')
+
+    def __init__(self, max_entries=1000, max_text_length=200, tail_size=20):
+        self.max_entries = max_entries
+        self.max_text_length = max_text_length
+        self.failures = 0
+        self.entries = 0
+        self.duplicates = 0
+        self.seen = set()
+        # Unparseable lines, kept in case the test command itself crashes
+        self.tail = deque(maxlen=tail_size)
+
+    def feed(self, line):
+        line = _to_text(line).rstrip('\r\n')
+        match = self.line_re.match(line)
+        if match is None:
+            self.keep(line)
+            return None
+        filename, lnum, text = match.groups()
+        return self.add(filename, lnum, text)
+
+    def keep(self, line):
+        line = _to_text(line).rstrip('\r\n')
+        if line.strip():
+            self.tail.append(line[:self.max_text_length])
+
+    def add(self, filename, lnum, text):
+        """Returns the quickfix entry for the given failure, or None if it
+        should not be added.
+
+        """
+        self.failures += 1
+        key = (filename, lnum, text)
+        if key in self.seen:
+            self.duplicates += 1
+            return None
+        if self.entries >= self.max_entries:
+            return None
+        self.seen.add(key)
+        self.entries += 1
+        return {'filename': filename, 'lnum': int(lnum),
+                'text': text[:self.max_text_length]}
+
+
+class QuickfixWriter(object):
+    """Appends entries to the quickfix list in bounded chunks, rather than
+    one at a time or all at once at the end.
+
+    """
+    def __init__(self, chunk_size=200, interval=0.2):
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.pending = []
+        # Number of entries added, i.e. the number of the last one
+        self.count = 0
+        self.last_flush = time.time()
+
+    def add(self, entry):
+        self.pending.append(entry)
+        self.count += 1
+        if len(self.pending) >= self.chunk_size or \
+           time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    @profiler.timed('quickfix')
+    def flush(self):
+        if self.pending:
+            vim.command('call setqflist(%s, "a")' % _vim_literal(self.pending))
+            self.pending = []
+        self.last_flush = time.time()
+
+
+class TracebackSpill(object):
+    """The full tracebacks (and captured output) of the failures in the
+    quickfix list, by entry number.  Vim only gets the one-line summary of
+    each failure; the tracebacks are appended to a file, compressed, as they
+    come in, and one is only read back (through a memory map) when its entry
+    is previewed.
+
+    """
+    # Tells the quickfix lists of different spills apart
+    tokens = 0
+
+    def __init__(self, path):
+        TracebackSpill.tokens += 1
+        self.token = TracebackSpill.tokens
+        self.path = path
+        self.index = {}
+        self.size = 0
+        self.file = open(path, 'wb')
+        self.map = None
+
+    def add(self, nr, text):
+        if not text:
+            return
+        data = zlib.compress(text.encode('utf-8', 'replace'))
+        self.file.write(data)
+        self.index[nr] = (self.size, len(data))
+        self.size += len(data)
+
+    def get(self, nr):
+        """Returns the traceback of the given entry, or None."""
+        if nr not in self.index:
+            return None
+        offset, length = self.index[nr]
+        if self.map is None or len(self.map) < offset + length:
+            # Map what has been written since the last time, too
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            f = open(self.path, 'rb')
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        data = self.map[offset:offset + length]
+        return zlib.decompress(data).decode('utf-8')
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+# The spill of the quickfix list that was filled last
+_traceback_spill = None
+
+
+def close_traceback_spill():
+    """Drops the tracebacks of the current quickfix list.  Emptying the list
+    keeps its context, so this must be done whenever it is filled with
+    anything but test results.
+
+    """
+    global _traceback_spill
+    if _traceback_spill is not None:
+        _traceback_spill.close()
+        _traceback_spill = None
+
+
+def start_traceback_spill():
+    """Replaces the spill of the previous quickfix list with a new one, and
+    tags the (just emptied) quickfix list with its token.  Returns the spill,
+    or None if there is no project to keep it in, or if this Vim can't tag
+    quickfix lists.
+
+    """
+    global _traceback_spill
+    close_traceback_spill()
+    if not int(vim.eval('pyunit#HasQuickfixContext()')):
+        return None
+    project_root = find_project_root_or_none()
+    if project_root is None:
+        return None
+    try:
+        _traceback_spill = TracebackSpill(cache_path(project_root,
+                                                     'tracebacks'))
+    except (IOError, OSError):
+        return None
+    vim.command('call setqflist([], "a", %s)' % _vim_literal(
+        {'context': {'pyunit': _traceback_spill.token}}))
+    return _traceback_spill
+
+
+class RunOutput(object):
+    """Collects the results of a test run.  Without report files, the output
+    of the runner is parsed as it comes in; otherwise the output is only kept
+    in case the runner crashes, and the reports are read at the end.
+
+    """
+    def __init__(self, args='', runner=None, reports=(), spill=None):
+        self.parser = MachineOutParser(max_entries=config.max_quickfix_entries)
+        self.writer = QuickfixWriter()
+        self.spill = spill
+        # The number of the entry that the next traceback belongs to
+        self.last_entry = None
+        self.runner = runner
+        self.reports = list(reports)
+        self.test_files = test_files_in_args(args)
+        self.selected_files = test_files_in_args(args, selectors=True)
+        self.failed = []
+        # Where the tracebacks of the failures pass through test files, which
+        # finds their tests when they are reported in the code under test
+        self.test_frames = []
+        # Keys of the test files that run in full, for the result cache
+        self.result_keys = {}
+        if runner is not None and self.test_files and config.result_cache:
+            self.result_keys = result_keys(self.test_files, runner)
+        self.started = time.time()
+
+    @profiler.timed('parse')
+    def feed(self, lines):
+        for line in lines:
+            if self.reports:
+                self.parser.keep(line)
+                continue
+            line = _to_text(line)
+            if line.startswith('\t') and self.add_details(line):
+                continue
+            failures = self.parser.failures
+            entry = self.parser.feed(line)
+            if self.parser.failures != failures:
+                # Tracebacks of failures that aren't listed are dropped
+                self.last_entry = None
+            if entry is not None:
+                self.failed.append((entry['filename'], entry['lnum']))
+                self.writer.add(entry)
+                self.last_entry = self.writer.count
+
+    def add_details(self, line):
+        """Spills the traceback on the given line (see pyunit_worker.py) for
+        the entry before it.  Returns whether the line held one.
+
+        """
+        try:
+            details = json.loads(line[1:])
+        except ValueError:
+            return False
+        if not isinstance(details, type(u'')):
+            return False
+        self.add_test_frames(details)
+        if self.spill is not None and self.last_entry is not None:
+            self.spill.add(self.last_entry, details)
+        return True
+
+    def add_test_frames(self, details):
+        project_root = find_project_root_or_none()
+        if project_root is None:
+            return
+        layout = get_layout(project_root)
+        for match in traceback_frame_re.finditer(details):
+            path = os.path.abspath(match.group(1))
+            if path.startswith(project_root + os.sep) and \
+               layout.is_test_file(path):
+                self.test_frames.append((path, int(match.group(2))))
+
+    def read_reports(self):
+        results = None
+        for report in self.reports:
+            found = self.runner.read_report(report)
+            if found is not None:
+                results = (results or []) + found
+        return results
+
+    @profiler.timed('parse')
+    def finish(self, status):
+        """Flushes any pending entries and returns the number of failed tests,
+        or -1 if the test command failed without reporting any test results.
+
+        """
+        profiler.add('tests', time.time() - self.started)
+        results = None
+        if self.reports:
+            results = self.read_reports() or []
+            for result in results:
+                if result.status not in ('failure', 'error'):
+                    continue
+                entry = self.parser.add(result.filename or '', result.lnum,
+                                        result.text)
+                if entry is not None:
+                    self.writer.add(entry)
+                    if self.spill is not None:
+                        self.spill.add(self.writer.count, result.details)
+        if status != 0 and self.parser.failures == 0:
+            self.writer.add({'text': 'Test command exited with status %d:' % status})
+            for line in self.parser.tail:
+                self.writer.add({'text': line})
+            self.writer.flush()
+            return -1
+        self.writer.flush()
+        if results is not None:
+            # Files of which only some tests ran say nothing about how long
+            # the whole file takes
+            partial = set(self.selected_files) - set(self.test_files)
+            record_results(results, self.selected_files, partial)
+            locations = [(r.path or r.filename, r.lnum) for r in results
+                         if r.status in ('failure', 'error')]
+        else:
+            if self.test_files:
+                record_durations(self.test_files, time.time() - self.started)
+            record_failures(self.failed + self.test_frames,
+                            self.selected_files)
+            locations = list(self.failed)
+        if self.result_keys:
+            # Failures beyond the quickfix limit weren't located
+            if len(locations) < self.parser.failures:
+                locations.append((None, 0))
+            record_passes(self.result_keys, locations, self.runner)
+        return self.parser.failures
+
+
+_test_output = None
+
+
+def test_files_in_args(args, selectors=False):
+    """Returns the (absolute) paths of the test files named in the given
+    test command arguments.  Unless selectors is set, files of which only
+    some tests are run (path:Class.method) are left out.
+
+    """
+    paths = []
+    for arg in shlex.split(args):
+        path, _, selector = arg.partition(':')
+        if selector and not selectors:
+            continue
+        if path.endswith('.py') and _dir_cache.isfile(path):
+            path = os.path.abspath(path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def start_test_output(args='', runner=None, reports=()):
+    global _test_output
+    _written_files.clear()
+    # Never mistake the report of an earlier run for that of this one
+    for report in reports:
+        if os.path.exists(report):
+            os.remove(report)
+    vim.command('call setqflist([], "r")')
+    _test_output = RunOutput(args, runner, reports, start_traceback_spill())
+    return _test_output
+
+
+def start_test_run(args='', stop=False, runner=None, coverage=None):
+    """Prepares for a run of the given tests.  Returns the RunOutput to feed
+    the output of the run to, and the command to run.
+
+    """
+    if runner is None:
+        runner = get_runner()()
+    report = runner.report_name and runner.report_path() or None
+    output = start_test_output(args, runner, report and [report] or [])
+    return output, runner.command(args, stop, report, coverage)
+
+
+def run_tests_to_quickfix(args='', stop=False, runner=None, coverage=None):
+    output, cmd = start_test_run(args, stop, runner, coverage)
+    started = time.time()
+    proc = subprocess.Popen(cmd, shell=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    profiler.add('spawn', time.time() - started)
+    for line in iter(proc.stdout.readline, b''):
+        output.feed([line])
+    proc.stdout.close()
+    return output.finish(proc.wait())
+
+
+#
+# Test duration history
+#
+
+class DurationStore(object):
+    """Keeps the most recent run times of each test file (and of each single
+    test, if the runner reports those) in an append-only log under the
+    project root.  Keys are paths relative to the project root, optionally
+    followed by ":Class.method" for single tests.
+
+    """
+    def __init__(self, project_root, window=None):
+        self.project_root = project_root
+        self.window = window or config.duration_window
+        self.path = cache_path(project_root, 'durations.log')
+        self._samples = None
+        self._lines = 0
+
+    @property
+    def samples(self):
+        """Maps each key to its most recent (timestamp, seconds) samples."""
+        if self._samples is None:
+            self.load()
+        return self._samples
+
+    def load(self):
+        self._samples = {}
+        self._lines = 0
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        try:
+            for line in f:
+                try:
+                    key, secs, when = json.loads(line)
+                except (ValueError, TypeError):
+                    continue
+                self._add(key, when, secs)
+                self._lines += 1
+        finally:
+            f.close()
+
+    def _add(self, key, when, secs):
+        if key not in self._samples:
+            self._samples[key] = deque(maxlen=self.window)
+        self._samples[key].append((when, secs))
+
+    def record(self, durations, when=None):
+        """Records the given dict of key => seconds."""
+        samples = self.samples
+        if when is None:
+            when = int(time.time())
+        f = open(self.path, 'a')
+        try:
+            for key, secs in sorted(durations.items()):
+                f.write(json.dumps([key, round(secs, 3), when]) + '\n')
+                self._add(key, when, secs)
+                self._lines += 1
+        finally:
+            f.close()
+
+        # Every now and then, rewrite the log to drop the samples that have
+        # fallen out of the window
+        kept = sum(len(d) for d in samples.values())
+        if self._lines > max(1000, 2 * kept):
+            self.compact()
+
+    def compact(self):
+        rows = []
+        for key, samples in self.samples.items():
+            rows.extend((when, key, secs) for when, secs in samples)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        f = open(tmp_path, 'w')
+        try:
+            for when, key, secs in sorted(rows):
+                f.write(json.dumps([key, secs, when]) + '\n')
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+        self._lines = len(rows)
+
+    def mean(self, key):
+        samples = self.samples.get(key)
+        if not samples:
+            return None
+        return sum(secs for when, secs in samples) / len(samples)
+
+    def trend(self, key):
+        """Returns the relative change of the last run time compared to the
+        mean of the ones before it, or None if there's too little data.
+
+        """
+        samples = list(self.samples.get(key, ()))
+        if len(samples) < 2:
+            return None
+        earlier = sum(secs for when, secs in samples[:-1]) / (len(samples) - 1)
+        if earlier <= 0:
+            return None
+        return samples[-1][1] / earlier - 1
+
+    def slowest(self, count, tests=False):
+        """Returns the count slowest test files (or single tests) as (mean,
+        key) tuples.
+
+        """
+        keys = [k for k in self.samples if (':' in k) == tests]
+        return sorted(((self.mean(k), k) for k in keys), reverse=True)[:count]
+
+    def report(self, count):
+        lines = []
+        for tests, title in ((False, 'Slowest test files'),
+                             (True, 'Slowest tests')):
+            slowest = self.slowest(count, tests)
+            if not slowest:
+                continue
+            lines.append('%s (mean of the last %d runs):' % (title, self.window))
+            for mean, key in slowest:
+                samples = self.samples[key]
+                trend = self.trend(key)
+                if trend is None:
+                    trend = 'n/a'
+                else:
+                    trend = '%+d%%' % round(trend * 100)
+                lines.append('%8.2fs  %s  (last %.2fs, %s, %d runs)' % (
+                    mean, key, samples[-1][1], trend, len(samples)))
+        if not lines:
+            lines.append('No test durations recorded yet.')
+        return lines
+
+    def estimator(self):
+        """Returns a cost function for make_shards() that uses the recorded
+        durations.  Files without any history get a duration guessed from
+        their size, scaled by how long the known files take per byte.
+
+        """
+        means = {}
+        known_secs = known_size = 0
+        for key in self.samples:
+            if ':' in key:
+                continue
+            path = os.path.join(self.project_root, key)
+            means[path] = self.mean(key)
+            size = estimate_test_cost(path)
+            if size:
+                known_secs += means[path]
+                known_size += size
+        secs_per_byte = known_size and float(known_secs) / known_size or 1.0
+
+        def cost(path):
+            if path in means:
+                return means[path]
+            return estimate_test_cost(path) * secs_per_byte
+        return cost
+
+
+def apportion_duration(paths, elapsed, cost):
+    """Divides the time a run of multiple files took over those files,
+    proportionally to their expected cost.
+
+    """
+    costs = dict((path, cost(path)) for path in paths)
+    total = sum(costs.values())
+    if total <= 0:
+        return dict((path, float(elapsed) / len(paths)) for path in paths)
+    return dict((path, elapsed * c / total) for path, c in costs.items())
+
+
+def record_durations(paths, elapsed, store=None):
+    project_root = find_project_root_or_none(paths[0])
+    if store is None and project_root is None:
+        return
+    try:
+        if store is None:
+            store = DurationStore(project_root)
+        if len(paths) == 1:
+            durations = {paths[0]: elapsed}
+        else:
+            durations = apportion_duration(paths, elapsed, store.estimator())
+        store.record(dict((_relpath(p, store.project_root), secs)
+                          for p, secs in durations.items()))
+    except (IOError, OSError):
+        # Not being able to keep history should never break a test run
+        pass
+
+
+def record_results(results, run_files, partial_files=()):
+    """Records the durations of the tests (and of their files, unless only
+    some of their tests ran) and the failures in the given TestResults.
+
+    """
+    project_root = find_project_root_or_none()
+    if project_root is None:
+        return
+    durations = {}
+    failures = {}
+    for result in results:
+        if result.path is None:
+            continue
+        relpath = _relpath(result.path, project_root)
+        keys = ['%s:%s' % (relpath, result.test_id)]
+        if result.path not in partial_files:
+            keys.append(relpath)
+        for key in keys:
+            durations[key] = durations.get(key, 0) + result.secs
+        if result.status in ('failure', 'error'):
+            ids = failures.setdefault(result.path, [])
+            if result.test_id not in ids:
+                ids.append(result.test_id)
+    try:
+        if durations:
+            DurationStore(project_root).record(durations)
+        FailureStore(project_root).update(failures, run_files)
+    except (IOError, OSError):
+        pass
+
+
+#
+# Remembering which tests failed
+#
+
+def _node_start(node):
+    # Decorators belong to the function or class they decorate
+    decorators = getattr(node, 'decorator_list', None) or []
+    return min([node.lineno] + [d.lineno for d in decorators])
+
+
+def _node_ends(nodes, end):
+    """Returns the last line of each of the given sibling nodes, given the
+    last line of their parent.
+
+    """
+    ends = []
+    for i, node in enumerate(nodes):
+        if getattr(node, 'end_lineno', None):
+            ends.append(node.end_lineno)
+        elif i + 1 < len(nodes):
+            ends.append(_node_start(nodes[i + 1]) - 1)
+        else:
+            ends.append(end)
+    return ends
+
+
+def _is_test_class(node):
+    if node.name.startswith('Test'):
+        return True
+    for base in node.bases:
+        name = getattr(base, 'id', None) or getattr(base, 'attr', '')
+        if name.endswith('TestCase'):
+            return True
+    return False
+
+
+def index_tests(source):
+    """Returns the test classes, methods and functions in the given source,
+    as (first line, last line, test id) tuples, where the test id is either
+    "Class", "Class.method" or "function".
+
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, TypeError, ValueError):
+        return []
+    last_line = len(source.splitlines())
+
+    index = []
+    for node, end in zip(tree.body, _node_ends(tree.body, last_line)):
+        if isinstance(node, ast.ClassDef) and _is_test_class(node):
+            index.append((_node_start(node), end, node.name))
+            for item, item_end in zip(node.body, _node_ends(node.body, end)):
+                if isinstance(item, ast.FunctionDef) and \
+                   item.name.startswith('test'):
+                    index.append((_node_start(item), item_end,
+                                  '%s.%s' % (node.name, item.name)))
+        elif isinstance(node, ast.FunctionDef) and node.name.startswith('test'):
+            index.append((_node_start(node), end, node.name))
+    return index
+
+
+def index_definitions(source):
+    """Returns all classes and functions in the given source, nested ones
+    included, as (first line, last line, qualified name) tuples.
+
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, TypeError, ValueError):
+        return []
+    index = []
+    def visit(body, end, prefix):
+        for node, node_end in zip(body, _node_ends(body, end)):
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef)):
+                name = prefix + node.name
+                index.append((_node_start(node), node_end, name))
+                visit(node.body, node_end, name + '.')
+    visit(tree.body, len(source.splitlines()), '')
+    return index
+
+
+def find_test_at(index, lnum):
+    """Returns the id of the innermost test in the index that contains the
+    given line, or None.
+
+    """
+    found = None
+    for first, last, test_id in index:
+        if first <= lnum <= last:
+            if found is None or first >= found[0]:
+                found = (first, test_id)
+    return found and found[1]
+
+
+# Test indexes of buffers, by buffer number, along with the changedtick of the
+# buffer they were built from
+_buffer_test_indexes = {}
+
+
+def buffer_test_index(bufnr, changedtick, lines):
+    """Returns the test index of the given buffer, which is only built again
+    after the buffer changed.
+
+    """
+    cached = _buffer_test_indexes.get(bufnr)
+    if cached is None or cached[0] != changedtick:
+        cached = (changedtick, index_tests('\n'.join(lines)))
+        _buffer_test_indexes[bufnr] = cached
+    return cached[1]
+
+
+def _failed_test_ids(failed):
+    """Maps each file in the given (filename, lnum) failure locations to the
+    ids of the tests the failures occurred in.
+
+    """
+    indexes = {}
+    result = {}
+    for filename, lnum in failed:
+        path = os.path.abspath(filename)
+        if path not in indexes:
+            try:
+                indexes[path] = index_tests(open(path).read())
+            except IOError:
+                indexes[path] = []
+        test_id = find_test_at(indexes[path], lnum)
+        if test_id is not None:
+            ids = result.setdefault(path, [])
+            if test_id not in ids:
+                ids.append(test_id)
+    return result
+
+
+class FailureStore(object):
+    """The ids of the tests that failed the last time they ran, per test file
+    (relative to the project root).
+
+    """
+    def __init__(self, project_root):
+        self.project_root = project_root
+        self.path = cache_path(project_root, 'failures.json')
+        self.failures = _load_json(self.path, {})
+
+    def get(self, path):
+        return self.failures.get(_relpath(path, self.project_root), [])
+
+    def update(self, failures, run_files):
+        """Replaces the failures of the files that were run (or all of them,
+        if run_files is empty) with the given failures.
+
+        """
+        if run_files:
+            for path in run_files:
+                self.failures.pop(_relpath(path, self.project_root), None)
+        else:
+            self.failures = {}
+        for path, ids in failures.items():
+            self.failures[_relpath(path, self.project_root)] = ids
+        _save_json(self.path, self.failures)
+
+
+def record_failures(failed, run_files):
+    project_root = find_project_root_or_none()
+    if project_root is None:
+        return
+    try:
+        FailureStore(project_root).update(_failed_test_ids(failed), run_files)
+    except (IOError, OSError):
+        pass
+
+
+def last_failed_selectors(path):
+    """Returns the path:Class.method selectors for the tests in the given test
+    file that failed last time.
+
+    """
+    store = FailureStore(find_project_root(path))
+    relpath = _relpath(path, '.')
+    return ['%s:%s' % (relpath, test_id) for test_id in store.get(path)]
+
+
+#
+# Skipping test files that passed before
+#
+
+RESULT_CACHE_VERSION = 1
+
+# Besides the files a test file imports, its outcome depends on the packages
+# it lives in, on pytest's conftest.py files along the way, and on the
+# configuration of the runners in the project root
+PACKAGE_FILES = ('__init__.py', 'conftest.py')
+RUNNER_CONFIG_FILES = ('setup.cfg', 'tox.ini', 'pytest.ini', 'pyproject.toml',
+                       '.noserc', 'nose.cfg')
+
+
+class FileHashes(object):
+    """Content hashes of project files, each kept with the size and mtime the
+    file had when it was hashed, so that a file is only read again once
+    either of them changes.
+
+    """
+    def __init__(self, project_root):
+        self.project_root = project_root
+        self.path = cache_path(project_root, 'hashes.json')
+        self.hashes = _load_json(self.path, {})
+        self.changed = False
+
+    def digest(self, path):
+        """Returns the SHA-1 of the contents of the given file, or None if
+        there is no such file.
+
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        relpath = _relpath(path, self.project_root)
+        stat = [st.st_size, st.st_mtime]
+        known = self.hashes.get(relpath)
+        if known is not None and known[:2] == stat:
+            return known[2]
+        try:
+            f = open(path, 'rb')
+            try:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        # A file that changed this recently may change again without its
+        # mtime changing, so its hash is only good for this run
+        if time.time() - st.st_mtime > DirCache.racy_secs:
+            self.hashes[relpath] = stat + [digest]
+            self.changed = True
+        return digest
+
+    def save(self):
+        if self.changed:
+            _save_json(self.path, self.hashes)
+            self.changed = False
+
+
+def runner_signature(runner):
+    """Returns what, besides the files, decides the outcome of the tests the
+    given runner runs: its command line and the environment of Python.
+
+    """
+    env = sorted((name, value) for name, value in os.environ.items()
+                 if name.startswith('PYTHON') or
+                 name in ('PATH', 'VIRTUAL_ENV', 'CONDA_PREFIX'))
+    return json.dumps([type(runner).__name__, runner.command(''), env])
+
+
+class ResultCache(object):
+    """The test files (relative to the project root) that passed the last time
+    they ran, each with the key it had then: a hash of the runner's signature,
+    of the test file and of every project file it (transitively) imports.  As
+    long as its key stays the same, a test file that passed needs not run
+    again.
+
+    """
+    def __init__(self, layout, runner):
+        self.layout = layout
+        self.project_root = layout.project_root
+        self.runner = runner
+        self.path = cache_path(self.project_root, 'results.json')
+        data = _load_json(self.path, {})
+        if data.get('version') != RESULT_CACHE_VERSION:
+            data = {'passed': {}}
+        self.passed = data['passed']
+        self.hashes = FileHashes(self.project_root)
+        self._graph = None
+        self._signature = None
+
+    def inputs(self, path):
+        """Returns the (absolute) paths of the files the outcome of the given
+        test file depends on.  Files that don't exist are left out.
+
+        """
+        if self._graph is None:
+            self._graph = self.layout.get_import_graph()
+        files = set([path])
+        files.update(self._graph.all_dependencies(path))
+        for f in list(files):
+            directory = os.path.dirname(f)
+            while directory.startswith(self.project_root + os.sep):
+                for name in PACKAGE_FILES:
+                    files.add(os.path.join(directory, name))
+                directory = os.path.dirname(directory)
+        for name in PACKAGE_FILES + RUNNER_CONFIG_FILES:
+            files.add(os.path.join(self.project_root, name))
+        return set(f for f in files if _dir_cache.isfile(f))
+
+    def key(self, path):
+        if self._signature is None:
+            self._signature = runner_signature(self.runner)
+        sha = hashlib.sha1(self._signature.encode('utf-8'))
+        for f in sorted(self.inputs(path)):
+            line = '%s %s\n' % (_relpath(f, self.project_root),
+                                self.hashes.digest(f))
+            sha.update(line.encode('utf-8'))
+        return sha.hexdigest()
+
+    def keys(self, test_files):
+        """Returns the current key of each of the given test files."""
+        keys = dict((path, self.key(path)) for path in test_files)
+        self.hashes.save()
+        return keys
+
+    def partition(self, test_files):
+        """Splits the given test files into those that have to run, and those
+        that passed before and haven't changed since.
+
+        """
+        to_run = []
+        cached = []
+        keys = self.keys(test_files)
+        for path in test_files:
+            relpath = _relpath(path, self.project_root)
+            if self.passed.get(relpath) == keys[path]:
+                cached.append(path)
+            else:
+                to_run.append(path)
+        return to_run, cached
+
+    def update(self, keys, failed):
+        """Records the test files with the given keys (taken when they
+        started running) as passed, except for the failed ones.
+
+        """
+        for path, key in keys.items():
+            relpath = _relpath(path, self.project_root)
+            if path in failed:
+                self.passed.pop(relpath, None)
+            else:
+                self.passed[relpath] = key
+        _save_json(self.path, {'version': RESULT_CACHE_VERSION,
+                               'passed': self.passed})
+
+
+def failed_test_files(test_files, locations, graph):
+    """Returns which of the given test files failed, from the (filename,
+    lnum) locations of the failures.  A failure in any other project file is
+    blamed on all of the test files that (transitively) import it, and one
+    that can't be located on all of them.
+
+    """
+    test_files = set(test_files)
+    failed = set()
+    for filename, lnum in locations:
+        path = filename and os.path.abspath(filename)
+        if path in test_files:
+            failed.add(path)
+        elif path and path in graph.imports:
+            failed.update(test_files & graph.dependents([path]))
+        else:
+            return test_files
+    return failed
+
+
+def result_keys(test_files, runner):
+    """Returns the keys of the given test files when a run of them starts, to
+    record those that pass with once it's done.
+
+    """
+    layout = get_layout(runner.project_root)
+    try:
+        return ResultCache(layout, runner).keys(test_files)
+    except (IOError, OSError):
+        return {}
+
+
+def record_passes(keys, locations, runner):
+    layout = get_layout(runner.project_root)
+    try:
+        failed = failed_test_files(list(keys), locations,
+                                   layout.get_import_graph())
+        ResultCache(layout, runner).update(keys, failed)
+    except (IOError, OSError):
+        # Not being able to keep results should never break a test run
+        pass
+
+
+#
+# Running tests in a warm worker process
+#
+
+class WorkerClient(object):
+    """Talks to the long-lived worker process (see pyunit_worker.py) of a
+    project, starting it when it's not running yet.
+
+    """
+    startup_timeout = 30
+
+    def __init__(self, project_root, source_root=''):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise RuntimeError("The test worker requires unix sockets.")
+        self.project_root = project_root
+        self.source_root = source_root
+        self.socket_path = cache_path(project_root, 'worker.sock')
+        if len(self.socket_path) > 100:
+            raise RuntimeError("Path too long for the test worker socket: %s"
+                               % self.socket_path)
+
+    def preload_modules(self):
+        if config.worker_preload or not config.worker_fork:
+            return config.worker_preload
+        # A forking worker can't reload anything, so by default it preloads
+        # all the (stable) dependencies from outside of the project
+        graph = load_import_graph(self.project_root, self.source_root)
+        return graph.external_modules()
+
+    def command(self):
+        cmd = [config.worker_python, config.worker_script]
+        if config.worker_fork:
+            cmd.append('--fork')
+        for module in self.preload_modules():
+            cmd.extend(['--preload', module])
+        if self.source_root:
+            cmd.extend(['--path', self.source_root])
+        return cmd + [self.project_root, self.socket_path]
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def start(self):
+        log = open(cache_path(self.project_root, 'worker.log'), 'a')
+        subprocess.Popen(self.command(), cwd=self.project_root,
+                         stdin=open(os.devnull), stdout=log, stderr=log,
+                         close_fds=True)
+        log.close()
+        deadline = time.time() + self.startup_timeout
+        while time.time() < deadline:
+            sock = self.connect()
+            if sock is not None:
+                return sock
+            time.sleep(0.05)
+        raise RuntimeError("The test worker did not start; see %s" %
+                           cache_path(self.project_root, 'worker.log'))
+
+    def request(self, request):
+        sock = self.connect() or self.start()
+        f = sock.makefile('rwb')
+        try:
+            f.write((json.dumps(request) + '\n').encode('utf-8'))
+            f.flush()
+            for line in iter(f.readline, b''):
+                yield _to_text(line).rstrip('\n')
+        finally:
+            f.close()
+            sock.close()
+
+    def run(self, args, stop=False):
+        """Yields the output lines of the given test run.  The last item is
+        the exit status (an int) of the run.
+
+        """
+        status = 1
+        for attempt in range(2):
+            restart = False
+            for line in self.request({'args': args, 'stop': stop}):
+                if line.startswith('o '):
+                    yield line[2:]
+                elif line.startswith('s '):
+                    status = int(line[2:])
+                elif line == 'r':
+                    # A forking worker whose preloaded modules changed has
+                    # exited; the next request starts a fresh one
+                    restart = True
+            if not restart:
+                break
+        yield status
+
+    def stop(self):
+        sock = self.connect()
+        if sock is not None:
+            sock.close()
+            for line in self.request({'cmd': 'quit'}):
+                pass
+
+
+def run_worker_to_quickfix(args, stop=False):
+    layout = get_layout()
+    client = WorkerClient(layout.project_root, layout.source_root)
+    output = start_test_output(args)
+    # The worker runs from the project root, Vim may not
+    worker_args = [_relpath(os.path.abspath(a.partition(':')[0]),
+                            layout.project_root) +
+                   (a.partition(':')[1] + a.partition(':')[2])
+                   for a in shlex.split(args)]
+    status = 1
+    for line in client.run(worker_args, stop):
+        if isinstance(line, int):
+            status = line
+        else:
+            output.feed([_worker_line_from_root(line, layout.project_root)])
+    return output.finish(status)
+
+
+def _worker_line_from_root(line, project_root):
+    # The files in results are relative to the project root, too; the
+    # message after them, and the tracebacks (which may well contain
+    # something that looks like a result), are left alone
+    if line.startswith('\t'):
+        return line
+    match = MachineOutParser.line_re.match(line)
+    if match is None or os.path.isabs(match.group(1)):
+        return line
+    filename = _relpath(os.path.join(project_root, match.group(1)), '.')
+    return filename + line[match.end(1):]
+
+
+#
+# Running all tests in parallel shards
+#
+
+def find_test_files(layout):
+    # Packages of tests aren't test files themselves
+    return [path for path in find_python_files(layout.project_root)
+            if layout.is_test_file(path) and
+            os.path.basename(path) != '__init__.py']
+
+
+def estimate_test_cost(path):
+    # Without anything better to go on, bigger test files are assumed to take
+    # longer to run
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def make_shards(paths, count, cost=estimate_test_cost):
+    """Splits the given test files into at most count shards of roughly equal
+    total cost, by handing out the most expensive files first, each to the
+    currently cheapest shard.
+
+    """
+    costs = dict((path, cost(path)) for path in paths)
+    heap = [(0, i, []) for i in range(max(count, 1))]
+    for path in sorted(paths, key=lambda p: (-costs[p], p)):
+        total, i, shard = heapq.heappop(heap)
+        shard.append(path)
+        heapq.heappush(heap, (total + costs[path], i, shard))
+    return [sorted(shard) for total, i, shard in sorted(heap) if shard]
+
+
+def shard_count():
+    if config.shards > 0:
+        return config.shards
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _pump_lines(stream, lines, index):
+    for line in iter(stream.readline, b''):
+        lines.put((index, line))
+    stream.close()
+    lines.put((index, None))
+
+
+def run_shards_to_quickfix(shards, stop=False, runner=None, store=None):
+    """Runs the tests of each shard concurrently, and merges their results
+    into a single quickfix list.  Returns the total number of failed tests,
+    like run_tests_to_quickfix().
+
+    """
+    if runner is None:
+        runner = get_runner()()
+    reports = [None] * len(shards)
+    if runner.report_name:
+        reports = [runner.report_path(i) for i in range(len(shards))]
+    output = start_test_output('', runner, [r for r in reports if r])
+    if config.result_cache:
+        test_files = [path for shard in shards for path in shard]
+        output.result_keys = result_keys(test_files, runner)
+    lines = queue.Queue()
+    procs = []
+    started = time.time()
+    for index, shard in enumerate(shards):
+        args = ' '.join(_shell_quote(_relpath(path, '.')) for path in shard)
+        cmd = runner.command(args, stop, reports[index])
+        proc = subprocess.Popen(cmd, shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        # Reader threads only collect the lines; all parsing (and talking to
+        # Vim) happens on this thread
+        reader = threading.Thread(target=_pump_lines,
+                                  args=(proc.stdout, lines, index))
+        reader.daemon = True
+        reader.start()
+        procs.append(proc)
+
+    running = len(procs)
+    elapsed = {}
+    while running:
+        index, line = lines.get()
+        if line is None:
+            running -= 1
+            elapsed[index] = time.time() - started
+        else:
+            output.feed([line])
+
+    status = 0
+    for proc in procs:
+        status = proc.wait() or status
+    numfail = output.finish(status)
+    # Runners with reports have the durations of each test recorded already
+    if numfail >= 0 and not runner.report_name:
+        for index, shard in enumerate(shards):
+            record_durations(shard, elapsed[index], store)
+    return numfail
+
+
+#
+# Which tests cover which code
+#
+
+COVERAGE_INDEX_VERSION = 1
+
+
+def numbits_to_lines(numbits):
+    """Decodes coverage.py's numbits (a bitmap in which bit j of byte i stands
+    for line i * 8 + j) into a sorted list of line numbers.
+
+    """
+    lines = []
+    for i, byte in enumerate(bytearray(numbits)):
+        for j in range(8):
+            if byte & (1 << j):
+                lines.append(i * 8 + j)
+    return lines
+
+
+def line_ranges(lines):
+    """Compacts the sorted line numbers into [first, last] ranges."""
+    ranges = []
+    for lnum in lines:
+        if ranges and ranges[-1][1] == lnum - 1:
+            ranges[-1][1] = lnum
+        else:
+            ranges.append([lnum, lnum])
+    return ranges
+
+
+def read_coverage_data(data_file):
+    """Yields (source file, context, lines) for everything measured by a
+    dynamic context in the given coverage.py data file.  The data is read
+    straight from its SQLite database, so coverage.py does not need to be
+    importable from within Vim.
+
+    """
+    conn = sqlite3.connect(data_file)
+    try:
+        rows = conn.execute('SELECT file.path, context.context, '
+                            'line_bits.numbits FROM line_bits '
+                            'JOIN file ON file.id = line_bits.file_id '
+                            'JOIN context ON context.id = line_bits.context_id')
+        for path, context, numbits in rows:
+            if context:
+                yield path, context, numbits_to_lines(numbits)
+    finally:
+        conn.close()
+
+
+def coverage_context_test(context, project_root):
+    """Returns the (absolute) test file and the test id that the given dynamic
+    context names, or (None, None).  Contexts are either dotted names
+    ("tests.test_foo.TestFoo.test_bar", as recorded with
+    dynamic_context = test_function), or pytest-cov's
+    "tests/test_foo.py::TestFoo::test_bar|run".
+
+    """
+    if '::' in context:
+        path, _, test_id = context.partition('|')[0].partition('::')
+        return (os.path.join(project_root, path),
+                '.'.join(test_id.split('::')))
+    path, test_id = find_dotted_name(context, project_root)
+    if path is None:
+        path, test_id = find_test_module(context, project_root)
+    if path is None or not test_id:
+        return None, None
+    return path, test_id
+
+
+def find_test_module(name, project_root):
+    """Like find_dotted_name(), for test modules that were imported without
+    their package prefix (from a test directory that isn't a package, like
+    "test_foo.TestFoo.test_bar").  The module is looked up by its file name
+    among the project's test files, and only used if that is unambiguous.
+
+    """
+    layout = get_layout(project_root)
+    index = get_filename_index(project_root)
+    parts = name.split('.')
+    for i in range(len(parts), 0, -1):
+        suffix = os.sep + os.path.join(*parts[:i]) + '.py'
+        found = [path for path in index.lookup(parts[i - 1] + '.py')
+                 if path.endswith(suffix) and
+                    looks_like_test_file(layout, path)]
+        if len(found) == 1:
+            return found[0], '.'.join(parts[i:])
+        if found:
+            break
+    return None, name
+
+
+class CoverageIndex(object):
+    """The tests that executed each source file (relative to the project
+    root), along with the ranges of lines each of them executed there.  Tests
+    are stored by number, as "path:Class.method" keys into a shared list.
+    The test files that were measured are kept with their size and mtime, so
+    that only those that changed have to be measured again.
+
+    """
+    def __init__(self, project_root):
+        self.project_root = project_root
+        self.path = cache_path(project_root, 'coverage.json')
+        data = _load_json(self.path, {})
+        if data.get('version') != COVERAGE_INDEX_VERSION:
+            data = {}
+        self.test_files = data.get('test_files', {})
+        tests = data.get('tests', [])
+        self.covered = {}
+        for source, entries in data.get('files', {}).items():
+            self.covered[source] = dict((tests[int(i)], ranges)
+                                        for i, ranges in entries.items())
+
+    def _signature(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def stale_test_files(self, test_files):
+        """Returns those of the given test files that changed since they were
+        measured, or were never measured.
+
+        """
+        return [path for path in test_files
+                if self.test_files.get(_relpath(path, self.project_root)) !=
+                   self._signature(path)]
+
+    def forget(self, test_files):
+        """Drops everything recorded for the tests in the given files."""
+        relpaths = set(_relpath(path, self.project_root) for path in test_files)
+        for relpath in relpaths:
+            self.test_files.pop(relpath, None)
+        for source, tests in list(self.covered.items()):
+            for key in list(tests):
+                if key.partition(':')[0] in relpaths:
+                    del tests[key]
+            if not tests:
+                del self.covered[source]
+
+    def add(self, data, test_files):
+        """Adds the (source file, context, lines) coverage data of a run of
+        the given test files.
+
+        """
+        for path in test_files:
+            relpath = _relpath(path, self.project_root)
+            self.test_files[relpath] = self._signature(path)
+        for source, context, lines in data:
+            test_file, test_id = coverage_context_test(context,
+                                                       self.project_root)
+            if test_file is None:
+                continue
+            key = '%s:%s' % (_relpath(test_file, self.project_root), test_id)
+            tests = self.covered.setdefault(
+                _relpath(source, self.project_root), {})
+            merged = sorted(set(lnum for first, last in tests.get(key, [])
+                                for lnum in range(first, last + 1)) |
+                            set(lines))
+            tests[key] = line_ranges(merged)
+
+    def tests_covering(self, path, first, last):
+        """Returns the keys of the tests that executed any of the given lines
+        of the given source file.
+
+        """
+        tests = self.covered.get(_relpath(path, self.project_root), {})
+        return sorted(key for key, ranges in tests.items()
+                      if any(a <= last and b >= first for a, b in ranges))
+
+    def save(self):
+        tests = sorted(set(key for tests in self.covered.values()
+                           for key in tests))
+        numbers = dict((key, i) for i, key in enumerate(tests))
+        files = {}
+        for source, entries in self.covered.items():
+            files[source] = dict((str(numbers[key]), ranges)
+                                 for key, ranges in entries.items())
+        _save_json(self.path, {'version': COVERAGE_INDEX_VERSION,
+                               'test_files': self.test_files,
+                               'tests': tests, 'files': files})
+
+
+def write_coverage_rcfile(project_root):
+    """Writes the coverage.py configuration for measuring the project's tests
+    into the cache directory, and returns its path.
+
+    """
+    rcfile = cache_path(project_root, 'coveragerc')
+    f = open(rcfile, 'w')
+    try:
+        f.write('[run]\n'
+                'data_file = %s\n'
+                'dynamic_context = test_function\n'
+                'include = %s\n' % (cache_path(project_root, 'coverage.db'),
+                                     os.path.join(project_root, '*')))
+    finally:
+        f.close()
+    return rcfile
+
+
+def update_coverage_index(layout, runner=None):
+    """Runs the test files that changed since they were last measured (or
+    all of them, the first time) under coverage.py, and updates the coverage
+    index with the results.  Returns the number of failures (as
+    run_tests_to_quickfix does), or None if the index was up to date.
+
+    """
+    index = CoverageIndex(layout.project_root)
+    test_files = find_test_files(layout)
+    current = set(_relpath(path, layout.project_root) for path in test_files)
+    removed = [os.path.join(layout.project_root, relpath)
+               for relpath in index.test_files if relpath not in current]
+    stale = index.stale_test_files(test_files)
+    index.forget(removed)
+    if not stale:
+        index.save()
+        return None
+
+    data_file = cache_path(layout.project_root, 'coverage.db')
+    if os.path.exists(data_file):
+        os.remove(data_file)
+    rcfile = write_coverage_rcfile(layout.project_root)
+    if len(stale) == len(test_files):
+        # Let the runner discover the whole suite itself
+        args = ''
+    else:
+        args = ' '.join(_shell_quote(_relpath(path, '.')) for path in stale)
+    numfail = run_tests_to_quickfix(args, runner=runner, coverage=rcfile)
+    if numfail >= 0 and os.path.exists(data_file):
+        index.forget(stale)
+        index.add(read_coverage_data(data_file), stale)
+    index.save()
+    return numfail
+
+
+def tests_covering_line(path, source, lnum):
+    """Returns the path:Class.method selectors of the tests that cover the
+    function around the given line of the source file (or the line itself,
+    outside of any function), relative to the current directory.  Returns
+    None if nothing was measured for the file.
+
+    """
+    project_root = find_project_root(path)
+    index = CoverageIndex(project_root)
+    if _relpath(path, project_root) not in index.covered:
+        return None
+    definitions = index_definitions(source)
+    enclosing = [(first, last) for first, last, name in definitions
+                 if first <= lnum <= last]
+    first, last = enclosing and max(enclosing) or (lnum, lnum)
+    selectors = []
+    for key in index.tests_covering(path, first, last):
+        relpath, _, test_id = key.partition(':')
+        selectors.append('%s:%s' % (
+            _relpath(os.path.join(project_root, relpath), '.'), test_id))
+    return selectors
+
+
+#
+# The main functions
+#
+
+# The layouts work relative to the root of the file's project, which need not
+# be the current directory; these return paths relative to the latter
+
+@profiler.timed('layout')
+def get_test_file_for_source_file(path):
+    impl = get_layout(path)
+    return _relpath(impl.absolutify(impl.get_test_file(path)), '.')
+
+
+@profiler.timed('layout')
+def find_source_file_for_test_file(path):
+    impl = get_layout(path)
+    try:
+        candidates = [_relpath(impl.absolutify(f), '.')
+                      for f in impl.get_source_candidates(path)]
+    except RuntimeError:
+        if not config.fuzzy_counterparts:
+            raise
+        candidates = []
+    for f in candidates:
+        if _dir_cache.exists(f):
+            return f
+    if config.fuzzy_counterparts:
+        found = find_fuzzy_counterpart(path, impl)
+        if found is not None:
+            return _relpath(found, '.')
+    raise Exception("Source file not found.")
+
+
+@profiler.timed('layout')
+def is_test_file(path):
+    impl = get_layout(path)
+    return impl.is_test_file(path)
+
+
+@profiler.timed('layout')
+def test_file_to_watch(path):
+    """Returns the (absolute) test file to run when the given file is written,
+    or None if it has no test file.
+
+    """
+    layout = get_layout(path)
+    if not layout.is_test_file(path):
+        try:
+            path = layout.get_test_file(path)
+        except RuntimeError:
+            return None
+    path = layout.absolutify(path)
+    if not _dir_cache.isfile(path):
+        return None
+    return path
+
+
+def _vim_split_cmd(inverted=False):
+    invert = {'top': 'bottom', 'left': 'right',
+              'right': 'left', 'bottom': 'top', 'no': 'no'}
+    mapping = {'top': 'lefta', 'left': 'vert lefta',
+               'right': 'vert rightb', 'bottom': 'rightb', 'no': ''}
+    splitoff_direction = config.split_window
+    if inverted:
+        return mapping[invert[splitoff_direction]]
+    else:
+        return mapping[splitoff_direction]
+
+
+def _open_buffer_cmd(path, opposite=False):
+    splitopts = _vim_split_cmd(opposite)
+    if not splitopts:
+        splitcmd = 'edit'
+    elif int(vim.eval('bufexists("%s")' % path)):
+        splitcmd = splitopts + ' sbuffer'
+    else:
+        splitcmd = splitopts + ' split'
+    command = "%s %s" % (splitcmd, path)
+    return command
+
+
+def lcd_to_project_root(path):
+    vim.command("lcd %s" % find_project_root(path))
+
+
+def switch_to_test_file_for_source_file(path):
+    try:
+        testfile = get_test_file_for_source_file(path)
+    except RuntimeError:
+        # Only guess when the layout can't say where the tests go; otherwise
+        # a missing test file is to be created, not swapped for a test file
+        # of some other module that happens to have the same name
+        if not config.fuzzy_counterparts:
+            raise
+        found = find_fuzzy_counterpart(path)
+        if found is None:
+            raise RuntimeError("Test file not found.")
+        testfile = _relpath(found, '.')
+    testdir = os.path.dirname(testfile)
+    if not _dir_cache.isfile(testfile):
+        if config.confirm_test_creation:
+            # Ask the user for confirmation
+            rel_testfile = _relpath(testfile, find_project_root(path))
+            msg = 'confirm("Test file does not exist yet. Create %s now?", "&Yes\n&No")' % rel_testfile
+            if int(vim.eval(msg)) != 1:
+                return
+
+        # Create the directory up until the file (if it doesn't exist yet)
+        if not _dir_cache.exists(testdir):
+            os.makedirs(testdir)
+
+    vim.command(_open_buffer_cmd(testfile))
+    lcd_to_project_root(path)
+
+
+def switch_to_source_file_for_test_file(path):
+    sourcefile = find_source_file_for_test_file(path)
+    vim.command(_open_buffer_cmd(sourcefile, opposite=True))
+    lcd_to_project_root(path)
+
+
+@bridged
+def PyUnitSwitchToCounterpartOfFile(path):
+    layout = get_layout(path)
+    if config.fuzzy_counterparts:
+        is_test = looks_like_test_file(layout, path)
+    else:
+        is_test = layout.is_test_file(path)
+    if is_test:
+        switch_to_source_file_for_test_file(path)
+    else:
+        switch_to_test_file_for_source_file(path)
+
+
+@bridged
+def PyUnitProfileStart(name):
+    profiler.start(name)
+
+
+@bridged
+def PyUnitProfileFinish():
+    profiler.finish()
+
+
+@bridged
+def PyUnitProfileAdd(phase, secs):
+    profiler.add(phase, float(secs))
+
+
+@bridged
+def PyUnitShowProfile(clear):
+    if int(clear):
+        profiler.clear()
+        vim.command('echo "Cleared the recorded timings."')
+        return
+    vim.command('echo %s' % _vim_literal('\n'.join(profiler.report())))
+
+
+@bridged
+def PyUnitSendProfileData():
+    vim.command('call pyunit#SetProfileData(%s)' % _vim_literal({
+        'summary': profiler.summary(),
+        'invocations': list(profiler.invocations),
+    }))
+
+
+@bridged
+def PyUnitClearCache():
+    clear_caches()
+
+
+@bridged
+def PyUnitListUntestedFiles(path):
+    if not path:
+        path = find_project_root()
+    writer = QuickfixWriter()
+    vim.command('call setqflist([], "r")')
+    close_traceback_spill()
+    resolver = CounterpartResolver()
+    untested = resolver.untested_files(path)
+    for source in untested:
+        test_file = resolver.layout.get_test_file(source)
+        writer.add({'filename': _relpath(source, '.'), 'lnum': 1,
+                    'text': 'No test file (expected %s)' % test_file})
+    writer.flush()
+    return len(untested)
+
+
+@bridged
+def PyUnitCheckRunner():
+    runner = get_runner()()
+    if _which(runner.executable):
+        return True
+    vim.command('echohl ErrorMsg | echomsg %s | echohl None' % _vim_literal(
+        "File %s not found. Please install it first." % runner.executable))
+    return False
+
+
+@bridged
+def PyUnitLoadJUnitReport(path):
+    if not path:
+        path = JUnitRunner().report_path()
+    try:
+        summary = load_junit_report(path)
+    except (IOError, OSError, SyntaxError) as e:
+        vim.command('echohl ErrorMsg | echomsg %s | echohl None' %
+                    _vim_literal('Cannot read %s: %s' % (path, e)))
+        return -1
+    parser = MachineOutParser(max_entries=config.max_quickfix_entries)
+    writer = QuickfixWriter()
+    vim.command('call setqflist([], "r")')
+    spill = start_traceback_spill()
+    for result in summary.failures:
+        entry = parser.add(result.filename or '', result.lnum, result.text)
+        if entry is not None:
+            writer.add(entry)
+            if spill is not None:
+                spill.add(writer.count, result.details)
+    writer.flush()
+    vim.command('call setqflist([], "a", %s)' % _vim_literal(
+        {'title': '%s: %s' % (path, summary.describe())}))
+    return len(summary.failures)
+
+
+@bridged
+def PyUnitPreviewTraceback(nr, token):
+    spill = _traceback_spill
+    text = None
+    # The quickfix list may not be ours (anymore)
+    if spill is not None and token == str(spill.token):
+        text = spill.get(int(nr))
+    if text is None:
+        vim.command('echo "No traceback for this entry."')
+        return
+    vim.command('call pyunit#ShowTraceback(%s)' %
+                _vim_literal(text.splitlines()))
+
+
+@bridged
+def PyUnitRunTestCommand(args, stop):
+    return run_tests_to_quickfix(args, bool(int(stop)))
+
+
+@bridged
+def PyUnitStartTestRun(args, stop):
+    output, cmd = start_test_run(args, bool(int(stop)))
+    vim.command('call pyunit#StartTestJob(%s)' % _vim_literal(cmd))
+
+
+@bridged
+def PyUnitFeedTestOutput(lines):
+    if _test_output is not None:
+        _test_output.feed(lines)
+
+
+@bridged
+def PyUnitFinishTestOutput(status):
+    if _test_output is None:
+        return 0
+    return _test_output.finish(int(status))
+
+
+@bridged
+def PyUnitReloadConfig():
+    config.invalidate()
+
+
+@bridged
+def PyUnitNoteWrittenFile(path):
+    note_written_file(path)
+
+
+@bridged
+def PyUnitRunImpactedTests(ref):
+    layout = get_layout()
+    if ref:
+        changed = changed_files_since(ref, layout.project_root)
+    else:
+        changed = set(_written_files)
+    test_files = find_impacted_test_files(changed, layout,
+                                          layout.get_import_graph())
+    if not test_files:
+        vim.command('echo "No tests affected by the changes."')
+        return
+    paths = ' '.join(_shell_quote(_relpath(f, '.')) for f in test_files)
+    vim.command('call pyunit#RunNose(%s)' % _vim_literal(paths))
+
+
+def uncached_test_files(layout, runner):
+    """Returns the test files of the project that have to run, and the number
+    of test files skipped because their passing result is cached.
+
+    """
+    test_files = find_test_files(layout)
+    if not config.result_cache:
+        return test_files, 0
+    to_run, cached = ResultCache(layout, runner).partition(test_files)
+    return to_run, len(cached)
+
+
+def note_cached_files(count, to_run):
+    vim.command('call pyunit#NoteCachedFiles(%d)' % count)
+    if not to_run:
+        # All tests passed, then
+        vim.command('call setqflist([], "r")')
+        close_traceback_spill()
+
+
+@bridged
+def PyUnitRunUncachedTests():
+    layout = get_layout()
+    runner = get_runner()(layout.project_root)
+    to_run, cached = uncached_test_files(layout, runner)
+    if not to_run:
+        note_cached_files(cached, to_run)
+        return 0
+    paths = ' '.join(_shell_quote(_relpath(f, '.')) for f in to_run)
+    vim.command("call pyunit#RunNose(%s, '', %d)" % (_vim_literal(paths),
+                                                    cached))
+
+
+@bridged
+def PyUnitRunShardedTests(stop):
+    layout = get_layout()
+    runner = get_runner()(layout.project_root)
+    to_run, cached = uncached_test_files(layout, runner)
+    note_cached_files(cached, to_run)
+    if not to_run:
+        return 0
+    store = DurationStore(layout.project_root)
+    shards = make_shards(to_run, shard_count(), store.estimator())
+    return run_shards_to_quickfix(shards, bool(int(stop)), runner, store)
+
+
+@bridged
+def PyUnitShowSlowest(count):
+    store = DurationStore(find_project_root())
+    lines = store.report(int(count or 10))
+    vim.command('echo %s' % _vim_literal('\n'.join(lines)))
+
+
+@bridged
+def PyUnitRunInWorker(args, stop):
+    return run_worker_to_quickfix(args, bool(int(stop)))
+
+
+@bridged
+def PyUnitStopWorker():
+    layout = get_layout()
+    WorkerClient(layout.project_root).stop()
+
+
+@bridged
+def PyUnitWatchFile(path):
+    test_file = test_file_to_watch(path)
+    if test_file is not None:
+        vim.command('call pyunit#ScheduleWatchedRun(%s)' %
+                    _vim_literal(_relpath(test_file, '.')))
+
+
+@bridged
+def PyUnitRunNearestTest(path):
+    if not is_test_file(path):
+        return PyUnitRunTestsForFile(path)
+    buf = vim.current.buffer
+    index = buffer_test_index(buf.number, int(vim.eval('b:changedtick')),
+                              buf[:])
+    test_id = find_test_at(index, vim.current.window.cursor[0])
+    if test_id is None:
+        return PyUnitRunTestsForFile(path)
+    selector = '%s:%s' % (_relpath(path, '.'), test_id)
+    vim.command('call pyunit#RunNose(%s)' % _vim_literal(_shell_quote(selector)))
+
+
+@bridged
+def PyUnitUpdateCoverageIndex():
+    layout = get_layout()
+    numfail = update_coverage_index(layout)
+    if numfail is None:
+        vim.command('echo "The coverage index is up to date."')
+    return numfail
+
+
+@bridged
+def PyUnitRunCoveringTests(path):
+    buf = vim.current.buffer
+    lnum = vim.current.window.cursor[0]
+    selectors = tests_covering_line(path, '\n'.join(buf[:]), lnum)
+    if selectors is None:
+        vim.command('echo %s' % _vim_literal(
+            'No coverage recorded for %s, run :PyUnitCoverageIndex first.' %
+            _relpath(path, '.')))
+    elif not selectors:
+        vim.command('echo "No tests cover this code."')
+    else:
+        vim.command('call pyunit#RunNose(%s)' % _vim_literal(
+            ' '.join(_shell_quote(sel) for sel in selectors)))
+
+
+@bridged
+def PyUnitRunTestsForFile(path):
+    if not is_test_file(path):
+        path = get_test_file_for_source_file(path)
+    relpath = _relpath(path, '.')
+    failed = ''
+    if config.failed_first:
+        failed = ' '.join(_shell_quote(sel) for sel in last_failed_selectors(path))
+    vim.command('call pyunit#RunTestsForTestFile(%s, %s)' % (
+        _vim_literal(relpath), _vim_literal(failed)))
@@ -0,0 +1,531 @@
+"
+" The functions behind the commands and mappings of ftplugin/python_pyunit.vim.
+" Vim only loads this file (and the Python side, from pythonx/pyunit/) once
+" one of them is used, so that opening a Python file costs next to nothing.
+"
+
+" The Python side {{{
+if has('python3')
+    let s:python = 'python3'
+    let s:pyeval = 'py3eval'
+else
+    let s:python = 'python'
+    let s:pyeval = 'pyeval'
+endif
+let s:loaded = 0
+
+" Files written before the Python side was loaded, for :PyUnitRunImpacted
+let s:written = []
+
+fun! s:LoadPython() " {{{
+    if s:loaded
+        return
+    endif
+    execute s:python 'import pyunit.core'
+    let s:loaded = 1
+    for path in s:written
+        call s:Call('PyUnitNoteWrittenFile', path)
+    endfor
+    let s:written = []
+endf " }}}
+
+" Calls the named function of pyunit/core.py with the remaining arguments,
+" and returns its result (as a string)
+fun! s:Call(name, ...) " {{{
+    call s:LoadPython()
+    return call(s:pyeval, ['pyunit.core.call_from_vim(' . string(a:name) . ')'])
+endf " }}}
+
+fun! pyunit#Call(name, ...) " {{{
+    return call('s:Call', [a:name] + a:000)
+endf " }}}
+
+fun! pyunit#ReloadConfig() " {{{
+    " Settings are only cached once the Python side is loaded
+    if s:loaded
+        call s:Call('PyUnitReloadConfig')
+    endif
+endf " }}}
+
+fun! pyunit#NoteWrittenFile(path) " {{{
+    if s:loaded
+        call s:Call('PyUnitNoteWrittenFile', a:path)
+    else
+        call add(s:written, a:path)
+    endif
+endf " }}}
+" }}}
+
+" Set while the plugin writes the buffer before a test run, which
+" :PyUnitWatch must not take for an edit of yours
+let s:writing = 0
+
+fun! s:Write(cmd) " {{{
+    let start = reltime()
+    let s:writing = 1
+    try
+        execute a:cmd
+    finally
+        let s:writing = 0
+    endtry
+    call s:Call('PyUnitProfileAdd', 'write', reltimestr(reltime(start)))
+endf " }}}
+
+fun! pyunit#RunTestsForTestFile(path, ...) " {{{
+    " The optional argument holds the tests in this file that failed last time
+    let failed = a:0 ? a:1 : ''
+    call s:Write('silent write')
+    if failed == ''
+        call pyunit#RunNose(a:path)
+    elseif g:PyUnitFailedOnly
+        call pyunit#RunNose(failed)
+    else
+        " Only when they pass now, move on to the rest of the file
+        call pyunit#RunNose(failed, a:path)
+    endif
+endf " }}}
+
+fun! s:HasRunner() " {{{
+    return str2nr(s:Call('PyUnitCheckRunner'))
+endf " }}}
+
+" When given, the first optional argument is run as well, but only if all
+" tests in path pass.  The second is the number of test files that were left
+" out of path because their passing result is cached.
+fun! pyunit#RunNose(path, ...) " {{{
+    let s:next_path = a:0 ? a:1 : ''
+    let s:quiet = 0
+    if !g:PyUnitWorker && !s:HasRunner()
+        return
+    endif
+
+    " a new run always supersedes one that is still going on
+    call pyunit#CancelTests()
+    let s:cached = a:0 > 1 ? a:2 : 0
+
+    " write any changes before continuing
+    if !&readonly
+        call s:Write('update')
+    endif
+
+    if g:PyUnitAsync && !g:PyUnitWorker && s:HasJobs()
+        call s:RunNoseAsync(a:path)
+        return
+    endif
+
+    set lazyredraw   " delay redrawing
+    cclose           " close any existing cwindows
+
+    let numfail = s:RunBlocking(a:path)
+    if numfail == 0 && s:next_path != ''
+        let numfail = s:RunBlocking(s:next_path)
+    endif
+    call s:ShowResults(numfail)
+endf " }}}
+
+fun! s:RunBlocking(path) " {{{
+    if g:PyUnitWorker
+        return str2nr(s:Call('PyUnitRunInWorker', a:path, g:PyUnitStopOnFailure))
+    endif
+    return str2nr(s:Call('PyUnitRunTestCommand', a:path, g:PyUnitStopOnFailure))
+endf " }}}
+
+fun! s:ShowResults(numfail) " {{{
+    let start = reltime()
+    set lazyredraw
+
+    " open cwindow, except after runs that started in the background (by
+    " :PyUnitWatch), which must not move the cursor away from what you're doing
+    let has_errors = a:numfail != 0
+    if has_errors && !s:quiet
+        " first, open the alternate window, too
+        call s:Call('PyUnitSwitchToCounterpartOfFile', @%)
+        call s:OpenQuickfix()
+    endif
+
+    set nolazyredraw
+    redraw!
+    call s:Call('PyUnitProfileAdd', 'quickfix', reltimestr(reltime(start)))
+    call s:Call('PyUnitProfileFinish')
+
+    let cached = s:cached ? " (".s:cached." test files cached)" : ""
+    let s:cached = 0
+    if !has_errors
+        " Show OK status
+        call s:GreenBar()
+        echo ""
+        hi Green ctermfg=green
+        echohl Green
+        echon "All tests passed".cached."."
+        echohl
+    else
+        call s:RedBar()
+        echo ""
+        hi Red ctermfg=red
+        echohl Red
+        if a:numfail < 0
+            echon "Test command failed."
+        elseif a:numfail == 1
+            echon "1 test failed".cached."."
+        else
+            echon a:numfail." tests failed".cached."."
+        endif
+    endif
+endf " }}}
+
+" Number of test files the current run skipped, as they passed before and
+" haven't changed since
+let s:cached = 0
+
+fun! pyunit#NoteCachedFiles(count) " {{{
+    let s:cached = a:count
+endf " }}}
+
+" Asynchronous test runs {{{
+" Each run gets a new generation number, so that output of a job that has
+" been superseded (or cancelled) in the meantime is ignored.
+let s:generation = 0
+let s:quiet = 0
+
+fun! s:HasJobs() " {{{
+    return has('nvim') || (has('job') && has('channel') && has('timers'))
+endf " }}}
+
+fun! s:RunNoseAsync(path) " {{{
+    let s:generation += 1
+    " The incomplete last line of each stream (stdout and stderr are separate
+    " streams in Neovim)
+    let s:partial = {}
+    let s:exit_status = -1
+    let s:closed = 0
+    if !s:quiet
+        cclose
+    endif
+    " This builds the test command and calls pyunit#StartTestJob() with it
+    call s:Call('PyUnitStartTestRun', a:path, g:PyUnitStopOnFailure)
+    if !s:quiet
+        echo "Running tests..."
+    endif
+endf " }}}
+
+fun! pyunit#StartTestJob(cmd) " {{{
+    let start = reltime()
+    let argv = [&shell, &shellcmdflag, a:cmd]
+    if has('nvim')
+        let s:job = jobstart(argv, {
+                    \ 'on_stdout': function('s:OnNvimOutput', [s:generation]),
+                    \ 'on_stderr': function('s:OnNvimOutput', [s:generation]),
+                    \ 'on_exit': function('s:OnNvimExit', [s:generation]),
+                    \ })
+    else
+        let s:job = job_start(argv, {
+                    \ 'in_io': 'null',
+                    \ 'err_io': 'out',
+                    \ 'out_cb': function('s:OnVimOutput', [s:generation]),
+                    \ 'exit_cb': function('s:OnVimExit', [s:generation]),
+                    \ 'close_cb': function('s:OnVimClose', [s:generation]),
+                    \ })
+    endif
+    call s:Call('PyUnitProfileAdd', 'spawn', reltimestr(reltime(start)))
+endf " }}}
+
+" Every run starts by cancelling the previous one, so this also marks the
+" next run as one you started yourself (s:RunWatched marks its own as quiet)
+fun! pyunit#CancelTests() " {{{
+    let s:cached = 0
+    let s:quiet = 0
+    if !exists('s:job')
+        return
+    endif
+    let job = s:job
+    unlet s:job
+    let s:generation += 1
+    if has('nvim')
+        silent! call jobstop(job)
+    elseif job_status(job) == 'run'
+        call job_stop(job)
+    endif
+endf " }}}
+
+fun! s:OnVimOutput(generation, channel, msg) " {{{
+    if a:generation == s:generation
+        call s:Call('PyUnitFeedTestOutput', [a:msg])
+    endif
+endf " }}}
+
+fun! s:OnNvimOutput(generation, job, data, event) " {{{
+    if a:generation != s:generation
+        return
+    endif
+    " Neovim hands us chunks: the first item continues the last line of the
+    " previous chunk, and the last item is an incomplete line (if any)
+    let lines = copy(a:data)
+    let lines[0] = get(s:partial, a:event, '') . lines[0]
+    let s:partial[a:event] = remove(lines, -1)
+    call s:Call('PyUnitFeedTestOutput', lines)
+endf " }}}
+
+" Vim may report the exit of the job before all of its output has been read,
+" so we wait for both the exit and the channel to close
+fun! s:OnVimExit(generation, job, status) " {{{
+    if a:generation != s:generation
+        return
+    endif
+    let s:exit_status = a:status
+    if s:closed
+        call s:OnJobDone()
+    endif
+endf " }}}
+
+fun! s:OnVimClose(generation, channel) " {{{
+    if a:generation != s:generation
+        return
+    endif
+    let s:closed = 1
+    if s:exit_status != -1
+        call s:OnJobDone()
+    endif
+endf " }}}
+
+fun! s:OnNvimExit(generation, job, status, event) " {{{
+    if a:generation != s:generation
+        return
+    endif
+    let s:exit_status = a:status
+    call s:OnJobDone()
+endf " }}}
+
+fun! s:OnJobDone() " {{{
+    let partial = filter(values(s:partial), 'v:val != ""')
+    let s:partial = {}
+    if !empty(partial)
+        call s:Call('PyUnitFeedTestOutput', partial)
+    endif
+    unlet! s:job
+    let numfail = str2nr(s:Call('PyUnitFinishTestOutput', s:exit_status))
+    if numfail == 0 && s:next_path != ''
+        let path = s:next_path
+        let s:next_path = ''
+        call s:RunNoseAsync(path)
+        return
+    endif
+    call s:ShowResults(numfail)
+endf " }}}
+" }}}
+
+" Watch mode {{{
+" Test files to run once the watch delay has passed
+let s:watch_pending = {}
+
+fun! pyunit#Watch(enable) " {{{
+    augroup PyUnitWatch
+        autocmd!
+    augroup END
+    if exists('s:watch_timer')
+        call timer_stop(s:watch_timer)
+        unlet s:watch_timer
+    endif
+    let s:watch_pending = {}
+    if !a:enable
+        echo "Stopped watching for changes."
+        return
+    endif
+    if !has('timers') || (!g:PyUnitWorker && !s:HasJobs())
+        echoerr "PyUnitWatch requires Vim 8 or Neovim."
+        return
+    endif
+    augroup PyUnitWatch
+        autocmd BufWritePost *.py
+                    \ if !s:writing |
+                    \     call s:Call('PyUnitWatchFile', expand('<afile>:p')) |
+                    \ endif
+    augroup END
+    echo "Running the tests of each Python file you write."
+endf " }}}
+
+" Called (from Python) with the test file to run for a file that was written
+fun! pyunit#ScheduleWatchedRun(path) " {{{
+    let s:watch_pending[a:path] = 1
+    " Newer edits make the results of a run in progress worthless
+    if exists('s:job') && s:quiet
+        call pyunit#CancelTests()
+    endif
+    if exists('s:watch_timer')
+        call timer_stop(s:watch_timer)
+    endif
+    let s:watch_timer = timer_start(g:PyUnitWatchDelay, function('s:RunWatched'))
+endf " }}}
+
+fun! s:RunWatched(timer) " {{{
+    unlet! s:watch_timer
+    let paths = map(sort(keys(s:watch_pending)), 'shellescape(v:val)')
+    if empty(paths) || (!g:PyUnitWorker && !s:HasRunner())
+        let s:watch_pending = {}
+        return
+    endif
+    " A run you started yourself is left alone; try again once it's done
+    if exists('s:job') && !s:quiet
+        let s:watch_timer = timer_start(g:PyUnitWatchDelay, function('s:RunWatched'))
+        return
+    endif
+    let s:watch_pending = {}
+    call pyunit#CancelTests()
+    call s:Call('PyUnitProfileStart', 'watch')
+    let s:next_path = ''
+    let s:quiet = 1
+    if g:PyUnitWorker
+        call s:ShowResults(s:RunBlocking(join(paths)))
+    else
+        call s:RunNoseAsync(join(paths))
+    endif
+endf " }}}
+" }}}
+
+" Tracebacks {{{
+" The tracebacks of a quickfix list are found through its context, which
+" older versions of Vim don't have
+fun! pyunit#HasQuickfixContext() " {{{
+    return has('nvim') || has('patch-8.0.1023')
+endf " }}}
+
+fun! s:OpenQuickfix() " {{{
+    execute 'belowright copen'
+    setlocal wrap
+    nnoremap <buffer> <silent> c :cclose<CR>
+    nnoremap <buffer> <silent> q :cclose<CR>
+    nnoremap <buffer> <silent> p :call pyunit#PreviewTraceback(line('.'))<CR>
+    nnoremap <buffer> <silent> <CR> :call pyunit#JumpToFailure(line('.'))<CR>
+endf " }}}
+
+" Shows the full traceback of the given quickfix entry (by default, the
+" current one) in the preview window
+fun! pyunit#PreviewTraceback(nr) " {{{
+    if !pyunit#HasQuickfixContext()
+        echo "Tracebacks need Vim 8.0.1023 or later."
+        return
+    endif
+    let nr = a:nr != '' ? a:nr : get(getqflist({'idx': 0}), 'idx', 1)
+    let context = get(getqflist({'context': 1}), 'context', {})
+    let token = type(context) == type({}) ? get(context, 'pyunit', '') : ''
+    call s:Call('PyUnitPreviewTraceback', nr, token)
+endf " }}}
+
+fun! pyunit#JumpToFailure(nr) " {{{
+    execute a:nr . 'cc'
+    call pyunit#PreviewTraceback(a:nr)
+endf " }}}
+
+fun! pyunit#ShowTraceback(lines) " {{{
+    silent execute 'pedit! ' . fnameescape('[PyUnit traceback]')
+    wincmd P
+    setlocal buftype=nofile bufhidden=wipe noswapfile nobuflisted modifiable
+    silent %delete _
+    call setline(1, a:lines)
+    setlocal nomodifiable nomodified
+    wincmd p
+endf " }}}
+" }}}
+
+fun! s:RedBar() " {{{
+    hi RedBar ctermfg=white ctermbg=red guibg=red
+    echohl RedBar
+    echon repeat(" ", &columns - 1)
+    echohl
+endf " }}}
+
+fun! s:GreenBar() " {{{
+    hi GreenBar ctermfg=white ctermbg=green guibg=green
+    echohl GreenBar
+    echon repeat(" ", &columns - 1)
+    echohl
+endf " }}}
+
+fun! pyunit#SwitchToCounterpart() " {{{
+    call s:Call('PyUnitProfileStart', 'switch')
+    call s:Call('PyUnitSwitchToCounterpartOfFile', @%)
+    call s:Call('PyUnitProfileFinish')
+endf " }}}
+
+fun! pyunit#RunTests() " {{{
+    call s:Call('PyUnitProfileStart', 'run tests')
+    call s:Call('PyUnitRunTestsForFile', @%)
+endf " }}}
+
+fun! pyunit#ShowUntested(path) " {{{
+    let numfiles = str2nr(s:Call('PyUnitListUntestedFiles', a:path))
+    if numfiles > 0
+        execute 'belowright copen'
+    endif
+    echo numfiles." source file(s) without a test file."
+endf " }}}
+
+fun! pyunit#RunAllTests() " {{{
+    call s:Call('PyUnitProfileStart', 'run all tests')
+    call s:Write('silent w')
+    if g:PyUnitShards != 1
+        call s:RunShardedTests()
+    elseif g:PyUnitResultCache && !g:PyUnitWorker
+        call s:RunUncachedTests()
+    else
+        call pyunit#RunNose('')
+    endif
+endf " }}}
+
+" Runs the test files that don't have a cached passing result
+fun! s:RunUncachedTests() " {{{
+    if !s:HasRunner()
+        return
+    endif
+    call pyunit#CancelTests()
+    let numfail = s:Call('PyUnitRunUncachedTests')
+    if numfail != ''
+        call s:ShowResults(str2nr(numfail))
+    endif
+endf " }}}
+
+fun! pyunit#LoadJUnit(path) " {{{
+    let numfail = str2nr(s:Call('PyUnitLoadJUnitReport', a:path))
+    if numfail < 0
+        return
+    endif
+    if numfail > 0
+        call s:OpenQuickfix()
+    endif
+    echo getqflist({'title': 1}).title
+endf " }}}
+
+fun! pyunit#ProfileData() " {{{
+    call s:Call('PyUnitSendProfileData')
+    return s:profile_data
+endf " }}}
+
+fun! pyunit#SetProfileData(data) " {{{
+    let s:profile_data = a:data
+endf " }}}
+
+fun! s:RunShardedTests() " {{{
+    if !s:HasRunner()
+        return
+    endif
+    call pyunit#CancelTests()
+    set lazyredraw
+    cclose
+    echo "Running tests..."
+    let numfail = s:Call('PyUnitRunShardedTests', g:PyUnitStopOnFailure)
+    call s:ShowResults(str2nr(numfail))
+endf " }}}
+
+fun! pyunit#UpdateCoverageIndex() " {{{
+    if !s:HasRunner()
+        return
+    endif
+    call pyunit#CancelTests()
+    set lazyredraw
+    cclose
+    echo "Running tests under coverage..."
+    let numfail = s:Call('PyUnitUpdateCoverageIndex')
+    if numfail != ''
+        call s:ShowResults(str2nr(numfail))
+    endif
+endf " }}}
+
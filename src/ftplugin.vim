@@ -0,0 +1,364 @@
+"
+" Python filetype plugin for unit testing (with nose, pytest, unittest or nose2)
+" Language:     Python (ft=python)
+" Maintainer:   Vincent Driessen <vincent@datafox.nl>
+" Version:      Vim 7.4 or Neovim, with +python3 (or +python)
+" URL:          http://github.com/nvie/vim-pyunit
+"
+" Very inspired by Gary Bernhart's work:
+"     http://bitbucket.org/garybernhardt/dotfiles/src/tip/.vimrc
+"
+" Based on Mike Crute's Vim plugin:
+"     http://code.crute.org/mcrute_dotfiles/file/a19ddffcabe6/.vim/plugin/python_testing.vim
+"
+
+" Only do this when not done yet for this buffer
+if exists("g:loaded_python_unittests_ftplugin")
+    finish
+endif
+let loaded_python_unittests_ftplugin = 1
+
+" Configuration of the test tool {{{
+" The test runner to use: "nose", "pytest", "unittest" or "nose2"
+" (default: nose)
+if !exists("g:PyUnitRunner")
+    let PyUnitRunner = "nose"
+endif
+
+" Set the PyUnitCmd to whatever is your testing tool (default: nosetests).
+" It's only used with the nose runner, and must report in machineout format.
+if !exists("g:PyUnitCmd")
+    let PyUnitCmd = "nosetests -q --with-machineout"
+endif
+
+" The commands of the pytest and nose2 runners, with any options of your own
+" (default: pytest, nose2)
+if !exists("g:PyUnitPytestCmd")
+    let PyUnitPytestCmd = "pytest"
+endif
+
+if !exists("g:PyUnitNose2Cmd")
+    let PyUnitNose2Cmd = "nose2"
+endif
+
+" Set PyUnitShowTests to 1 if you want to show the tests (default: 1)
+if !exists("g:PyUnitShowTests")       " TODO: Use this one!
+    let PyUnitShowTests = 1
+endif
+
+" Set PyUnitAsync to 1 to run the tests in the background (requires Vim 8 or
+" Neovim), so that you can keep editing while the tests run (default: 0)
+if !exists("g:PyUnitAsync")
+    let PyUnitAsync = 0
+endif
+
+" Number of milliseconds :PyUnitWatch waits after a file is written before it
+" runs the tests, so that saving several files in a row gives a single run
+" (default: 300)
+if !exists("g:PyUnitWatchDelay")
+    let PyUnitWatchDelay = 300
+endif
+
+" Maximum number of failures to put in the quickfix list.  Identical
+" failures are only listed once.  (default: 1000)
+if !exists("g:PyUnitMaxQuickfixEntries")
+    let PyUnitMaxQuickfixEntries = 1000
+endif
+
+" Run the tests that failed last time first, when running the tests of a
+" single file.  Only when those pass, the whole file is run.  (default: 1)
+if !exists("g:PyUnitFailedFirst")
+    let PyUnitFailedFirst = 1
+endif
+
+" Set this to 1 to run only the tests that failed last time, if any.
+" (default: 0)
+if !exists("g:PyUnitFailedOnly")
+    let PyUnitFailedOnly = 0
+endif
+
+" Set this to 1 to stop a test run at the first failure.  (default: 0)
+if !exists("g:PyUnitStopOnFailure")
+    let PyUnitStopOnFailure = 0
+endif
+
+" Set PyUnitWorker to 1 to run the tests in a long-lived worker process, which
+" keeps the modules the tests import loaded between runs (default: 0).  The
+" worker runs the tests with unittest (see pythonx/pyunit/worker.py), not
+" PyUnitCmd.
+if !exists("g:PyUnitWorker")
+    let PyUnitWorker = 0
+endif
+
+" The Python interpreter that runs the worker; use the one of your project's
+" virtualenv, if it has one
+if !exists("g:PyUnitWorkerPython")
+    let PyUnitWorkerPython = "python"
+endif
+
+" Modules the worker imports up front, e.g. [ "django", "numpy" ]
+if !exists("g:PyUnitWorkerPreload")
+    let PyUnitWorkerPreload = []
+endif
+
+" Set PyUnitWorkerFork to 1 to have the worker fork a fresh process for every
+" run, instead of reloading changed modules in place.  Unless PyUnitWorkerPreload
+" is set, it preloads everything the project imports from outside of itself,
+" and it restarts when any of that changes on disk.  (default: 0)
+if !exists("g:PyUnitWorkerFork")
+    let PyUnitWorkerFork = 0
+endif
+
+if !exists("g:PyUnitWorkerScript")
+    let PyUnitWorkerScript = expand("<sfile>:p:h:h") . "/pythonx/pyunit/worker.py"
+endif
+
+" Directories (by name, with wildcards) that are never searched for Python
+" files, e.g. for the untested files or the test files of a project.  Hidden
+" directories and virtualenvs are always skipped.
+if !exists("g:PyUnitExcludeDirs")
+    let PyUnitExcludeDirs = ["build", "dist", "*.egg-info", "__pycache__", "node_modules"]
+endif
+
+" Set PyUnitFuzzyCounterparts to 0 to only ever switch to the counterpart the
+" test layout prescribes.  Otherwise, when the source file of a test doesn't
+" exist (or the layout doesn't know the test file of a source file), the file
+" with the expected name whose path resembles the expected path most is used
+" instead.  Missing test files are still offered to be created.  (default: 1)
+if !exists("g:PyUnitFuzzyCounterparts")
+    let PyUnitFuzzyCounterparts = 1
+endif
+
+" Number of parallel test processes used to run all tests.  Set this to 0 to
+" use one process per CPU core.  (default: 1, i.e. a single process)
+if !exists("g:PyUnitShards")
+    let PyUnitShards = 1
+endif
+
+" Set PyUnitResultCache to 1 to have running all tests skip the test files that
+" passed before, as long as neither they nor any of the project files they
+" import have changed since.  Only the files the test layout takes for test
+" files are run then, rather than whatever the runner finds.  (default: 0)
+if !exists("g:PyUnitResultCache")
+    let PyUnitResultCache = 0
+endif
+
+" Number of recent runs of each test file that are kept to compute its
+" average duration (see :PyUnitSlowest)  (default: 10)
+if !exists("g:PyUnitDurationWindow")
+    let PyUnitDurationWindow = 10
+endif
+
+"}}}
+" Configuration for autodetecting project root {{{
+" Configure what files indicate a project root
+if !exists("g:ProjRootIndicators")
+    let ProjRootIndicators = [ ".git", "setup.py", "setup.cfg" ]
+endif
+
+" Scan from the current working directory up until the home dir, instead of
+" the filesystem root.  This has no effect on projects that reside outside the
+" user's home directory.  In those cases there will be scanned up until the
+" filesystem root directory.
+if !exists("g:ProjRootStopAtHomeDir")
+    let ProjRootStopAtHomeDir = 1
+endif
+
+" Directory (relative to the project root) where the plugin keeps its caches,
+" such as the import graph of the project
+if !exists("g:PyUnitCacheDir")
+    let PyUnitCacheDir = ".pyunit"
+endif
+" }}}
+" Configuration for tests organisation {{{
+" Prefix used for all path components of the test file
+if !exists("g:PyUnitTestPrefix")
+    " nosetests scans all files/directories starting with "test_", so this is
+    " a sane default value.  There should not be a need to change this if you
+    " want to use nose.
+    let PyUnitTestPrefix = "test_"
+endif
+
+" Location where the source files live.  When set, this must be the relative
+" directory under the project root.  For example, if you have your project
+" root as follows:
+" - foo/
+" - bar/
+" - tests/
+"
+" And you want the test structure:
+" - tests/test_foo/
+" - tests/test_bar/
+"
+" Then you can leave this at the default value ("").
+"
+" But if you have:
+" - src/
+"   - foo/
+"   - bar/
+" - tests/
+"
+" And you DON'T want:
+" - tests/test_src/test_foo/
+" - tests/test_src/test_bar/
+" but:
+" - tests/test_foo/
+" - tests/test_bar/
+"
+" Then you need to set this value to "src"
+if !exists("g:PyUnitSourceRoot")
+    let PyUnitSourceRoot = ""
+endif
+
+" Relative location under the project root where to look for the test files.
+if !exists("g:PyUnitTestsRoot")
+    let PyUnitTestsRoot = "tests"
+endif
+
+" Tests structure can be one of: flat, follow-hierarchy
+"let PyUnitTestsStructure = "flat"
+if !exists("g:PyUnitTestsStructure")
+    let PyUnitTestsStructure = "follow-hierarchy"
+endif
+" }}}
+" Configuration for editing preferences {{{
+if !exists("g:PyUnitConfirmTestCreation")
+    " Set this to 0 if you want to silently create new test files
+    let PyUnitConfirmTestCreation = 1
+endif
+if !exists("g:PyUnitTestsSplitWindow")
+    " Specifies how the test window should open, relative to the source file
+    " window.  Takes one of the following values: top, bottom, left, right
+    let PyUnitTestsSplitWindow = "right"
+endif
+" }}}
+
+" Functions for your own mappings (see below) {{{
+fun! PyUnitRunTests() " {{{
+    call pyunit#RunTests()
+endf " }}}
+
+fun! PyUnitRunAllTests() " {{{
+    call pyunit#RunAllTests()
+endf " }}}
+
+fun! PyUnitSwitchToCounterpart() " {{{
+    call pyunit#SwitchToCounterpart()
+endf " }}}
+
+" The timings that :PyUnitProfile shows, as a dict
+fun! PyUnitProfileData() " {{{
+    return pyunit#ProfileData()
+endf " }}}
+" }}}
+
+" Commands {{{
+
+" Forget any cached project roots, e.g. after moving indicator files around
+command! PyUnitClearCache call pyunit#Call('PyUnitClearCache')
+
+" List the source files that have no test file yet, for the whole project or
+" just the given directory
+command! -nargs=? -complete=dir PyUnitUntested call pyunit#ShowUntested(<q-args>)
+
+" Re-read the g:PyUnit* and g:ProjRoot* settings (which are otherwise only
+" read once).  Changing them with :let or :unlet on the command line does this
+" automatically.  Scripts that change them can trigger it with
+" :doautocmd User PyUnitConfigChanged
+command! PyUnitReloadConfig call pyunit#Call('PyUnitReloadConfig')
+
+" Until the functions of autoload/pyunit.vim are used, there is nothing to
+" reload, and no reason to load them
+augroup PyUnitConfig
+    autocmd!
+    autocmd User PyUnitConfigChanged
+                \ if exists('*pyunit#ReloadConfig') |
+                \     call pyunit#ReloadConfig() |
+                \ endif
+    " Only commands that assign settings count: this also fires for the
+    " commands of mappings, like the plugin's own
+    if exists('##CmdlineLeave')
+        autocmd CmdlineLeave :
+                    \ if getcmdline() =~# '^\s*\(let\|unl\%[et]\)!\=\s.*\<\([gb]:\)\=\(PyUnit\|ProjRoot\)' &&
+                    \    exists('*pyunit#ReloadConfig') |
+                    \     call pyunit#ReloadConfig() |
+                    \ endif
+    endif
+augroup END
+
+" Run only the tests affected by the changes since the given git ref, or by
+" the Python files written since the last test run if no ref is given
+command! -nargs=? PyUnitRunImpacted
+            \ call pyunit#Call('PyUnitProfileStart', 'run impacted') |
+            \ call pyunit#Call('PyUnitRunImpactedTests', <q-args>)
+
+augroup PyUnitWrittenFiles
+    autocmd!
+    autocmd BufWritePost *.py call pyunit#NoteWrittenFile(expand('<afile>:p'))
+augroup END
+
+" Show the slowest test files (and tests), based on the recorded durations
+command! -nargs=? PyUnitSlowest call pyunit#Call('PyUnitShowSlowest', <q-args>)
+
+" Stop the worker process of the current project (see PyUnitWorker)
+command! PyUnitStopWorker call pyunit#Call('PyUnitStopWorker')
+
+" Run only the test under the cursor (or the whole test file when the cursor
+" isn't inside a test, or when the current file is not a test file)
+command! PyUnitRunNearest
+            \ call pyunit#Call('PyUnitProfileStart', 'run nearest') |
+            \ call pyunit#Call('PyUnitRunNearestTest', @%)
+
+" Load the results in a JUnit XML report (by default the one written by the
+" last pytest or nose2 run) into the quickfix list
+command! -nargs=? -complete=file PyUnitLoadJUnit call pyunit#LoadJUnit(<q-args>)
+
+" Run the tests under coverage.py, to record which tests execute which code.
+" Afterwards, only test files that changed are run again
+command! PyUnitCoverageIndex call pyunit#UpdateCoverageIndex()
+
+" Run the tests that executed the function under the cursor, according to the
+" index built by :PyUnitCoverageIndex
+command! PyUnitRunCovering
+            \ call pyunit#Call('PyUnitProfileStart', 'run covering') |
+            \ call pyunit#Call('PyUnitRunCoveringTests', @%)
+
+" Stop a test run that is running in the background
+command! PyUnitCancel call pyunit#CancelTests()
+
+" Show the full traceback of the current quickfix entry (or of entry N) in the
+" preview window.  In the quickfix window, p does the same for the entry under
+" the cursor, and <CR> jumps to the entry and shows its traceback
+command! -nargs=? PyUnitTraceback call pyunit#PreviewTraceback(<q-args>)
+
+" Show how long the phases of the last switches and test runs took (as
+" percentiles); :PyUnitProfile! forgets them.  PyUnitProfileData() returns the
+" same numbers as a dict
+command! -bang PyUnitProfile call pyunit#Call('PyUnitShowProfile', <bang>0)
+
+" Run the tests of every Python file you write, in the background; use
+" :PyUnitWatch! to stop
+command! -bang PyUnitWatch call pyunit#Watch(<bang>1)
+
+" }}}
+" Keyboard mappings {{{
+
+" Add mappings, unless the user didn't want this.
+" The default mapping is registered under to <F8> by default, unless the user
+" remapped it already (or a mapping exists already for <F8>)
+if !exists("no_plugin_maps") && !exists("no_pyunit_maps")
+    if !hasmapto('PyUnitRunTests(')
+        noremap <silent> <F8> :call PyUnitRunTests()<CR>
+        noremap! <silent> <F8> <Esc>:call PyUnitRunTests()<CR>
+    endif
+    if !hasmapto('PyUnitRunAllTests(')
+        noremap <silent> <S-F8> :call PyUnitRunAllTests()<CR>
+        noremap! <silent> <S-F8> <Esc>:call PyUnitRunAllTests()<CR>
+    endif
+    if !hasmapto('PyUnitSwitchToCounterpart(')
+        noremap <silent> <F9> :call PyUnitSwitchToCounterpart()<CR>
+        noremap! <silent> <F9> <Esc>:call PyUnitSwitchToCounterpart()<CR>
+    endif
+endif
+
+" }}}
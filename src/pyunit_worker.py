@@ -0,0 +1,514 @@
+"""A long-lived test runner for a single project.
+
+The worker keeps the modules it has imported (Django, NumPy, ...) warm between
+test runs.  Before each run, only the project modules that changed on disk (and
+the project modules that refer to them) are thrown away, so that they are
+imported again.  Results are reported in the same format as nose's machineout
+plugin, so the Vim plugin can parse them as usual.  Each failure line is
+followed by a line with a tab and the full traceback of the failure, along with
+the output the test captured, as a JSON string.
+
+Requests are single JSON lines sent over a unix socket:
+
+    {"args": ["tests/test_foo.py", "tests/test_bar.py:TestBar.test_baz"],
+     "stop": false}
+
+Each line of the reply is prefixed with "o " (a line of test output), and the
+final line is "s <status>", where status is 0 if all tests passed.
+
+With --once, the given tests are run right away, without starting a server:
+
+    pyunit_worker.py --once [--junit-xml REPORT] PROJECT_ROOT [TEST...]
+
+With --junit-xml, the results of every test (including the ones that passed)
+are written to a JUnit XML report as well, along with how long each took.
+
+With --fork, the worker never imports project code itself: it only imports the
+preloaded modules, and forks a child for each run, which starts out with
+everything already imported (and shares it copy-on-write).  This is for suites
+where reloading modules in place is not safe.  When any of the preloaded
+modules changes on disk, the worker replies with the single line "r" and
+exits, so that the client starts a fresh one.
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+import traceback
+import unittest
+from optparse import OptionParser
+from xml.etree import ElementTree
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+#
+# Finding and (re)loading the project's modules
+#
+
+def _module_file(module):
+    filename = getattr(module, '__file__', None)
+    if not filename:
+        return None
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    return os.path.abspath(filename)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class ModuleTracker(object):
+    """Keeps track of the modules that belong to the project, so that they can
+    be dropped from sys.modules when they change on disk.  All other modules
+    (the standard library, third-party packages) stay loaded.
+
+    """
+    def __init__(self, project_root, excluded=()):
+        self.project_root = os.path.abspath(project_root)
+        self.excluded = [os.path.abspath(os.path.join(project_root, e))
+                         for e in excluded]
+        self.mtimes = {}
+
+    def is_project_file(self, path):
+        if path is None or not path.startswith(self.project_root + os.sep):
+            return False
+        for excluded in self.excluded:
+            if path.startswith(excluded + os.sep):
+                return False
+        return True
+
+    def project_modules(self):
+        result = {}
+        for name, module in list(sys.modules.items()):
+            if module is None:
+                continue
+            path = _module_file(module)
+            if self.is_project_file(path):
+                result[name] = (module, path)
+        return result
+
+    def snapshot(self):
+        """Remembers the current mtimes of all loaded project modules."""
+        self.mtimes = {}
+        for name, (module, path) in self.project_modules().items():
+            self.mtimes[name] = _mtime(path)
+
+    def changed_modules(self):
+        modules = self.project_modules()
+        return set(name for name, (module, path) in modules.items()
+                   if name not in self.mtimes or
+                      self.mtimes[name] != _mtime(path))
+
+    def _refers_to(self, module, names):
+        for value in list(vars(module).values()):
+            if getattr(value, '__name__', None) in names and \
+               type(value) is type(sys):
+                return True
+            if getattr(value, '__module__', None) in names:
+                return True
+        return False
+
+    def stale_modules(self):
+        """Returns the names of the project modules that changed on disk,
+        plus those that (transitively) refer to any of them.
+
+        """
+        stale = self.changed_modules()
+        modules = self.project_modules()
+        grown = True
+        while grown:
+            grown = False
+            for name, (module, path) in modules.items():
+                if name not in stale and self._refers_to(module, stale):
+                    stale.add(name)
+                    grown = True
+        return stale
+
+    def unload_stale(self):
+        stale = self.stale_modules()
+        for name in stale:
+            sys.modules.pop(name, None)
+            self.mtimes.pop(name, None)
+        return stale
+
+
+def loaded_files():
+    """Returns the mtimes of the files of all loaded modules."""
+    result = {}
+    for module in list(sys.modules.values()):
+        path = _module_file(module) if module is not None else None
+        if path is not None:
+            result[path] = _mtime(path)
+    return result
+
+
+def module_name_for(path):
+    """Returns the dotted module name for the given file, and the directory
+    that must be on sys.path to import it under that name.
+
+    """
+    path = os.path.abspath(path)
+    directory, filename = os.path.split(path)
+    parts = [os.path.splitext(filename)[0]]
+    if parts[0] == '__init__':
+        parts = []
+    while os.path.isfile(os.path.join(directory, '__init__.py')):
+        directory, package = os.path.split(directory)
+        parts.insert(0, package)
+    return '.'.join(parts), directory
+
+
+def import_test_module(path):
+    name, directory = module_name_for(path)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    # Test modules are always imported fresh
+    sys.modules.pop(name, None)
+    __import__(name)
+    return sys.modules[name]
+
+
+#
+# Running tests and reporting in machineout format
+#
+
+class MachineOutResult(unittest.TestResult):
+    """Reports every failure as a "file:line: fail: message" line, pointing at
+    the innermost frame of the traceback that lies within the project, and
+    then its full traceback (see above).
+
+    """
+    def __init__(self, project_root, write):
+        super(MachineOutResult, self).__init__()
+        self.project_root = os.path.abspath(project_root)
+        self.write = write
+
+    def _location(self, tb):
+        location = None
+        for filename, lineno, func, text in traceback.extract_tb(tb):
+            filename = os.path.abspath(filename)
+            if filename.startswith(self.project_root + os.sep):
+                location = (filename, lineno)
+        return location
+
+    def _details(self, test, err):
+        if test is None:
+            return ''.join(traceback.format_exception(*err))
+        # Includes what the test printed, as the output is buffered
+        return self._exc_info_to_string(err, test)
+
+    def _message(self, err):
+        message = traceback.format_exception_only(*err[:2])[-1]
+        return ' '.join(message.strip().splitlines())
+
+    def _report(self, kind, test, err):
+        location = self._location(err[2]) or ('<unknown>', 0)
+        filename = os.path.relpath(location[0], os.getcwd())
+        self.write('%s:%d: %s: %s' % (filename, location[1], kind,
+                                      self._message(err)))
+        self.write('\t' + json.dumps(self._details(test, err)))
+
+    def addFailure(self, test, err):
+        super(MachineOutResult, self).addFailure(test, err)
+        self._report('fail', test, err)
+
+    def addError(self, test, err):
+        super(MachineOutResult, self).addError(test, err)
+        self._report('error', test, err)
+
+
+class JUnitResult(MachineOutResult):
+    """Also keeps a JUnit XML testcase for every test, for write_report().
+    Tests are named by the path of their module relative to the project root
+    (tests.test_foo.TestFoo), which is how the Vim plugin finds their file,
+    whether or not their directory is a package.
+
+    """
+    def __init__(self, project_root, write):
+        super(JUnitResult, self).__init__(project_root, write)
+        self.suite = ElementTree.Element('testsuite', name='unittest')
+        self.case = None
+        self.started = None
+
+    def _testcase(self, test):
+        name = getattr(test, '_testMethodName', None)
+        if name is None:
+            # Errors outside of any test, e.g. in setUpClass()
+            return ElementTree.Element('testcase', classname='',
+                                       name=test and str(test) or 'load')
+        module = type(test).__module__
+        classname = module
+        path = _module_file(sys.modules.get(module))
+        if path is not None and path.startswith(self.project_root + os.sep):
+            path = os.path.relpath(path, self.project_root)
+            classname = os.path.splitext(path)[0].replace(os.sep, '.')
+        case = ElementTree.Element('testcase', name=name, classname='%s.%s' % (
+                classname, type(test).__name__))
+        if path is not None:
+            case.set('file', path)
+        return case
+
+    def startTest(self, test):
+        super(JUnitResult, self).startTest(test)
+        self.case = self._testcase(test)
+        self.started = time.time()
+
+    def stopTest(self, test):
+        super(JUnitResult, self).stopTest(test)
+        self.case.set('time', '%.3f' % (time.time() - self.started))
+        self.suite.append(self.case)
+        self.case = None
+
+    def _add_outcome(self, tag, test, err):
+        case = self.case
+        if case is None:
+            case = self._testcase(test)
+            self.suite.append(case)
+        outcome = ElementTree.SubElement(case, tag,
+                                         message=self._message(err))
+        outcome.text = self._details(test, err)
+
+    def addFailure(self, test, err):
+        super(JUnitResult, self).addFailure(test, err)
+        self._add_outcome('failure', test, err)
+
+    def addError(self, test, err):
+        super(JUnitResult, self).addError(test, err)
+        self._add_outcome('error', test, err)
+
+    def addSkip(self, test, reason):
+        super(JUnitResult, self).addSkip(test, reason)
+        if self.case is not None:
+            ElementTree.SubElement(self.case, 'skipped', message=reason)
+
+    def write_report(self, path):
+        self.suite.set('tests', str(len(self.suite)))
+        root = ElementTree.Element('testsuites')
+        root.append(self.suite)
+        ElementTree.ElementTree(root).write(path, encoding='utf-8')
+
+
+def load_tests(args, project_root):
+    loader = unittest.TestLoader()
+    if not args:
+        return loader.discover(project_root, pattern='test*.py',
+                               top_level_dir=project_root)
+    suite = unittest.TestSuite()
+    for arg in args:
+        path, _, selector = arg.partition(':')
+        module = import_test_module(os.path.join(project_root, path))
+        if selector:
+            suite.addTest(loader.loadTestsFromName(selector, module))
+        else:
+            suite.addTest(loader.loadTestsFromModule(module))
+    return suite
+
+
+def run_tests(args, project_root, write, stop=False, report=None):
+    """Runs the given tests, writing machineout lines through write(), and,
+    if given a report file, a JUnit XML report to it.  Returns 0 if all tests
+    passed, 1 otherwise.
+
+    """
+    # Keep whatever the tests print out of the reply
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    # The result restores the streams it finds after each test, so it must
+    # only be created once they are redirected
+    if report is not None:
+        result = JUnitResult(project_root, write)
+    else:
+        result = MachineOutResult(project_root, write)
+    result.failfast = stop
+    result.buffer = True
+    try:
+        try:
+            load_tests(args, project_root).run(result)
+        except Exception:
+            result.addError(None, sys.exc_info())
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    if report is not None:
+        result.write_report(report)
+    return int(not result.wasSuccessful())
+
+
+def add_to_path(project_root, paths=()):
+    for path in reversed(list(paths) + ['']):
+        sys.path.insert(0, os.path.join(project_root, path))
+
+
+#
+# The server
+#
+
+class Worker(object):
+    def __init__(self, project_root, socket_path, preload=(), paths=(),
+                 idle_timeout=1800, fork=False):
+        self.project_root = os.path.abspath(project_root)
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.fork = fork
+        self.server = None
+        add_to_path(self.project_root, paths)
+        os.chdir(self.project_root)
+        self.preload(preload)
+        self.tracker = ModuleTracker(self.project_root)
+        self.tracker.snapshot()
+        self.preloaded = loaded_files()
+
+    def preload(self, modules):
+        for name in modules:
+            try:
+                __import__(name)
+            except Exception:
+                # A broken preload only means it's not warm; the tests that
+                # need it will report the problem
+                pass
+
+    def preload_changed(self):
+        for path, mtime in self.preloaded.items():
+            if _mtime(path) != mtime:
+                return True
+        return False
+
+    def handle(self, request, write):
+        if request.get('cmd') == 'quit':
+            return 'quit'
+        if self.fork:
+            return self.handle_forked(request, write)
+        self.tracker.unload_stale()
+        status = run_tests(request.get('args', []), self.project_root, write,
+                           request.get('stop', False))
+        self.tracker.snapshot()
+        return status
+
+    def handle_forked(self, request, write):
+        if self.preload_changed():
+            # Make way for the new worker before telling the client to start it
+            self.close()
+            return 'restart'
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.server.close()
+                status = run_tests(request.get('args', []), self.project_root,
+                                   write, request.get('stop', False))
+            finally:
+                os._exit(status)
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        return 1
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(1)
+        server.settimeout(self.idle_timeout)
+        self.server = server
+        return server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def serve(self):
+        server = self.listen()
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                if self.serve_connection(conn) in ('quit', 'restart'):
+                    break
+        finally:
+            self.close()
+
+    def serve_connection(self, conn):
+        conn.settimeout(None)
+        f = conn.makefile('rwb')
+        def write(line):
+            f.write(('o %s\n' % line).encode('utf-8', 'replace'))
+            f.flush()
+        try:
+            try:
+                request = json.loads(f.readline().decode('utf-8'))
+            except ValueError:
+                return None
+            status = self.handle(request, write)
+            if status == 'restart':
+                f.write(b'r\n')
+            elif status != 'quit':
+                f.write(('s %d\n' % status).encode('utf-8'))
+            return status
+        finally:
+            f.close()
+            conn.close()
+
+
+def run_once(project_root, args, paths=(), stop=False, report=None):
+    project_root = os.path.abspath(project_root)
+    add_to_path(project_root, paths)
+    stdout = sys.stdout
+    def write(line):
+        stdout.write(line + '\n')
+        stdout.flush()
+    return run_tests(args, project_root, write, stop, report)
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options] PROJECT_ROOT SOCKET_PATH\n'
+                                '       %prog --once [options] PROJECT_ROOT [TEST...]')
+    parser.add_option('--preload', action='append', default=[],
+                      help='module to import up front (may be repeated)')
+    parser.add_option('--path', action='append', default=[],
+                      help='directory, relative to the project root, to add '
+                           'to sys.path (may be repeated)')
+    parser.add_option('--idle-timeout', type='int', default=1800,
+                      help='seconds of inactivity after which to exit')
+    parser.add_option('--fork', action='store_true', default=False,
+                      help='run each request in a forked child process')
+    parser.add_option('--once', action='store_true', default=False,
+                      help='run the given tests and exit')
+    parser.add_option('--failfast', action='store_true', default=False,
+                      help='with --once, stop at the first failure')
+    parser.add_option('--junit-xml', metavar='REPORT',
+                      help='with --once, also write a JUnit XML report')
+    options, args = parser.parse_args(argv)
+    if options.once:
+        if not args:
+            parser.error('expected a project root')
+        sys.exit(run_once(args[0], args[1:], options.path, options.failfast,
+                          options.junit_xml))
+    if len(args) != 2:
+        parser.error('expected a project root and a socket path')
+    if options.fork and not hasattr(os, 'fork'):
+        parser.error('--fork is not supported on this platform')
+    project_root, socket_path = args
+    Worker(project_root, socket_path, options.preload, options.path,
+           options.idle_timeout, options.fork).serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
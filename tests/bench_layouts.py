@@ -0,0 +1,314 @@
+"""Benchmarks of the hot paths behind switching between source and test files.
+
+Synthetic projects are generated for each test layout (a deep hierarchy with
+--files files in total), and the project root lookup, _relpath(), the layout
+methods and a full counterpart switch are timed on a sample of their files.
+Besides the time per call, the number of filesystem calls (stat, listdir,
+scandir) per call is counted, which is what usually makes the difference on
+network filesystems.
+
+Run from the root of the repository:
+
+    python tests/bench_layouts.py            # compare with the baseline
+    python tests/bench_layouts.py --save     # record a new baseline
+
+The run fails if any benchmark makes more filesystem calls than in the
+baseline.  Timings depend on the machine, so they are only compared when
+given a --tolerance: the run then also fails if any benchmark takes more than
+that many times as long as in the baseline (which is only meaningful for a
+baseline recorded on the same machine).  Baselines are only compared when
+they were recorded with the same --files and --sample.
+
+"""
+# Mock out the vim library, as the tests do
+import sys
+sys.path = ['tests/mocks', 'src'] + sys.path
+import vim
+
+import os
+import json
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import python_unittests as mod
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+
+vimvars = {
+    'g:PyUnitShowTests': '1',
+    'pyunit#HasQuickfixContext()': '1',
+    'g:PyUnitCmd': 'nosetests -q --with-machineout',
+    'g:PyUnitRunner': 'nose',
+    'g:PyUnitPytestCmd': 'pytest',
+    'g:PyUnitNose2Cmd': 'nose2',
+    'g:PyUnitTestPrefix': 'test_',
+    'g:ProjRootIndicators': ['.git', 'setup.py', 'setup.cfg'],
+    'g:ProjRootStopAtHomeDir': '1',
+    'g:PyUnitTestsStructure': 'follow-hierarchy',
+    'g:PyUnitTestsRoot': 'tests',
+    'g:PyUnitSourceRoot': 'src',
+    'g:PyUnitTestsSplitWindow': 'no',
+    'g:PyUnitFuzzyCounterparts': '1',
+    'g:PyUnitConfirmTestCreation': '1',
+    'g:PyUnitMaxQuickfixEntries': '1000',
+    'g:PyUnitCacheDir': '.pyunit',
+    'g:PyUnitShards': '1',
+    'g:PyUnitDurationWindow': '10',
+    'g:PyUnitFailedFirst': '1',
+    'g:PyUnitWorkerPython': sys.executable,
+    'g:PyUnitWorkerScript': 'src/pyunit_worker.py',
+    'g:PyUnitWorkerPreload': [],
+    'g:PyUnitExcludeDirs': ['build', 'dist', '*.egg-info',
+                            '__pycache__', 'node_modules'],
+    'g:PyUnitWorkerFork': 0,
+    'g:PyUnitResultCache': '0',
+    'b:': {},
+}
+
+
+def fake_eval(x):
+    if x.startswith('bufexists('):
+        return '0'
+    return vimvars[x]
+
+vim.eval = fake_eval
+vim.command = lambda cmd: None
+
+
+#
+# Counting filesystem calls
+#
+
+class StatCounter(object):
+    """Wraps the os functions that hit the filesystem, counting the calls."""
+    names = ('stat', 'lstat', 'listdir', 'scandir')
+
+    def __init__(self):
+        self.count = 0
+        self.originals = {}
+
+    def _wrap(self, func):
+        def counted(*args, **kwargs):
+            self.count += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def install(self):
+        for name in self.names:
+            if hasattr(os, name):
+                self.originals[name] = getattr(os, name)
+                setattr(os, name, self._wrap(self.originals[name]))
+
+    def uninstall(self):
+        for name, func in self.originals.items():
+            setattr(os, name, func)
+        self.originals = {}
+
+
+stats = StatCounter()
+
+
+#
+# Synthetic projects
+#
+
+def source_files(count, depth=6, fanout=8):
+    """Returns count source file paths (relative to the source root), spread
+    over a hierarchy of packages depth levels deep.
+
+    """
+    paths = []
+    for i in range(count):
+        parts = []
+        n = i // fanout
+        for level in range(depth):
+            parts.append('pkg%d' % (n % fanout))
+            n //= fanout
+        paths.append(os.path.join(*(parts + ['mod%d.py' % i])))
+    return paths
+
+
+def _touch(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    open(path, 'w').close()
+
+
+def make_project(root, structure, count):
+    """Creates a project with count files, half of them source files and half
+    their test files, laid out according to the given structure.  Returns the
+    (absolute) source files.
+
+    """
+    os.makedirs(root)
+    _touch(os.path.join(root, 'setup.py'))
+    if structure == 'flat':
+        # Flat test names can't be mapped back through nested packages
+        # without underscores, so keep the sources shallow
+        sources = [os.path.join('src', 'mod%d.py' % i)
+                   for i in range(count // 2)]
+    else:
+        sources = [os.path.join('src', p) for p in source_files(count // 2)]
+    layout = mod.get_implementing_class(structure)(root)
+    result = []
+    for source in sources:
+        path = os.path.join(root, source)
+        _touch(path)
+        _touch(layout.absolutify(layout.get_test_file(path)))
+        result.append(path)
+    # Directory listings that changed within the last seconds aren't cached,
+    # which would make the stat counts depend on how fast this ran
+    past = time.time() - 3600
+    for directory, dirnames, filenames in os.walk(root):
+        os.utime(directory, (past, past))
+    return result
+
+
+#
+# Running the benchmarks
+#
+
+def measure(func, args, repeat=3):
+    """Calls func on each of the args, repeat times.  Returns the best time
+    and the number of filesystem calls per call.
+
+    """
+    best = None
+    calls = 0
+    for i in range(repeat):
+        stats.count = 0
+        started = time.time()
+        for arg in args:
+            func(arg)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best, calls = elapsed, stats.count
+    return best / len(args), calls / float(len(args))
+
+
+def run_benchmarks(tmpdir, count, sample):
+    results = {}
+
+    def record(name, func, args, cold=None):
+        if cold is not None:
+            # Start every repetition without cached lookups
+            def run(arg, func=func):
+                cold()
+                return func(arg)
+        else:
+            run = func
+        secs, calls = measure(run, args)
+        results[name] = {'secs': secs, 'stats': calls}
+        print('%-48s %10.2fus %8.2f stats' % (name, secs * 1e6, calls))
+
+    for structure in ('follow-hierarchy', 'nose', 'flat', 'side-by-side'):
+        root = os.path.join(tmpdir, structure)
+        vimvars['g:PyUnitTestsStructure'] = structure
+        vimvars['g:PyUnitSourceRoot'] = structure != 'side-by-side' and 'src' or ''
+        mod.clear_caches()
+        sources = make_project(root, structure, count)
+        os.chdir(root)
+
+        step = max(len(sources) // sample, 1)
+        picked = sources[::step][:sample]
+        layout = mod.get_layout(root)
+        tests = [layout.absolutify(layout.get_test_file(p)) for p in picked]
+
+        prefix = structure + ': '
+        stats.install()
+        try:
+            if structure == 'follow-hierarchy':
+                record('find_project_root (cold)', mod.find_project_root,
+                       picked, cold=mod.clear_caches)
+                record('find_project_root (warm)', mod.find_project_root,
+                       picked)
+                record('_relpath (stdlib)', mod._relpath, picked)
+                record('_relpath (fallback)',
+                       lambda p: mod._relpath(p, '.', False), picked)
+            record(prefix + 'is_test_file', layout.is_test_file,
+                   picked + tests)
+            record(prefix + 'get_test_file', layout.get_test_file, picked)
+            record(prefix + 'get_source_candidates',
+                   layout.get_source_candidates, tests)
+            record(prefix + 'switch to test file',
+                   mod.PyUnitSwitchToCounterpartOfFile, picked)
+            record(prefix + 'switch to source file',
+                   mod.PyUnitSwitchToCounterpartOfFile, tests)
+        finally:
+            stats.uninstall()
+    return results
+
+
+def compare(results, baseline, tolerance=None):
+    """Returns the regressions of the results against the baseline.  Timings
+    are only compared given a tolerance.
+
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['stats'] > base['stats']:
+            regressions.append('%s: %.2f stat calls, was %.2f' % (
+                name, result['stats'], base['stats']))
+        if tolerance is not None and \
+           result['secs'] > base['secs'] * tolerance:
+            regressions.append('%s: %.2fus, was %.2fus' % (
+                name, result['secs'] * 1e6, base['secs'] * 1e6))
+    return regressions
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--files', type='int', default=50000,
+                      help='number of files in each synthetic project')
+    parser.add_option('--sample', type='int', default=500,
+                      help='number of files to time the layouts on')
+    parser.add_option('--tolerance', type='float', default=None,
+                      help='also compare timings: how many times slower than '
+                           'the baseline a benchmark may get')
+    parser.add_option('--save', action='store_true', default=False,
+                      help='record the results as the new baseline')
+    options, args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    tmpdir = os.path.realpath(tempfile.mkdtemp())
+    try:
+        results = run_benchmarks(tmpdir, options.files, options.sample)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    params = {'files': options.files, 'sample': options.sample}
+    if options.save:
+        f = open(BASELINE_PATH, 'w')
+        try:
+            json.dump({'params': params, 'results': results}, f, indent=1,
+                      separators=(',', ': '), sort_keys=True)
+        finally:
+            f.close()
+        return 0
+
+    try:
+        baseline = json.load(open(BASELINE_PATH))
+    except (IOError, ValueError):
+        print('No baseline yet, record one with --save.')
+        return 0
+    if baseline.get('params') != params:
+        print('The baseline was recorded with %s, not comparing.' %
+              baseline.get('params'))
+        return 0
+    regressions = compare(results, baseline['results'], options.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return int(bool(regressions))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
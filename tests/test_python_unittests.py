@@ -3,7 +3,13 @@ import sys
 sys.path = ['tests/mocks'] + sys.path
 import vim
 
-vimvar = {}
+class VimVars(dict):
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        # Vim does this for us when a setting is changed with :let
+        mod.config.invalidate()
+
+vimvar = VimVars()
 
 
 def fake_eval(x):
@@ -11,11 +17,16 @@ def fake_eval(x):
     return vimvar[x]
 
 vim.eval = fake_eval
-vimvar['foo'] = 'bar'
+vimvar.update({'foo': 'bar'})
 
 # Now start loading normally
 import unittest
 import os
+import re
+import json
+import time
+import shutil
+import tempfile
 import python_unittests as mod
 
 
@@ -30,7 +41,11 @@ def setUpVimEnvironment():
     vimvar.clear()
     vimvar.update({
         'g:PyUnitShowTests': '1',
+        'pyunit#HasQuickfixContext()': '1',
         'g:PyUnitCmd': 'nosetests -q --with-machineout',
+        'g:PyUnitRunner': 'nose',
+        'g:PyUnitPytestCmd': 'pytest',
+        'g:PyUnitNose2Cmd': 'nose2',
         'g:PyUnitTestPrefix': 'test_',
         'g:ProjRootIndicators': ['.git', 'setup.py', 'setup.cfg'],
         'g:ProjRootStopAtHomeDir': '1',
@@ -38,7 +53,23 @@ def setUpVimEnvironment():
         'g:PyUnitTestsRoot': 'tests',
         'g:PyUnitSourceRoot': '',
         'g:PyUnitTestsSplitWindow': 'right',
+        'g:PyUnitFuzzyCounterparts': '1',
+        'g:PyUnitConfirmTestCreation': '1',
+        'g:PyUnitMaxQuickfixEntries': '1000',
+        'g:PyUnitCacheDir': '.pyunit',
+        'g:PyUnitShards': '1',
+        'g:PyUnitDurationWindow': '10',
+        'g:PyUnitFailedFirst': '1',
+        'g:PyUnitWorkerPython': sys.executable,
+        'g:PyUnitWorkerScript': os.path.join(proj_root, 'src', 'pyunit_worker.py'),
+        'g:PyUnitWorkerPreload': [],
+        'g:PyUnitExcludeDirs': ['build', 'dist', '*.egg-info',
+                                '__pycache__', 'node_modules'],
+        'g:PyUnitWorkerFork': 0,
+        'g:PyUnitResultCache': '0',
+        'b:': {},
     })
+    mod.clear_caches()
 
 class FileAwareTestCase(unittest.TestCase):
     def assertSameFile(self, x, y):
@@ -46,6 +77,9 @@ class FileAwareTestCase(unittest.TestCase):
 
 
 class TestTestLayout(FileAwareTestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+
     def testBreakDownSimple(self):
         layout = mod.BaseTestLayout()
         self.assertEquals(layout.break_down('foo.py'), ['foo'])
@@ -81,6 +115,78 @@ class TestTestLayout(FileAwareTestCase):
         self.assertEquals(layout.absolutify("/tmp/foo/bar.py"), "/tmp/foo/bar.py")
 
 
+class TestLayoutRegistry(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+        self.roots = []
+        for name in ('one', 'two'):
+            root = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.join(root, 'src'))
+            open(os.path.join(root, 'setup.py'), 'w').close()
+            self.roots.append(root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testLayoutPerRoot(self):
+        one, two = self.roots
+        layout = mod.get_layout(os.path.join(one, 'src', 'foo.py'))
+        self.assertEquals(layout.project_root, one)
+        self.assertTrue(isinstance(layout, mod.FollowHierarchyLayout))
+        self.assertTrue(mod.get_layout(os.path.join(one, 'setup.py')) is layout)
+
+        # The buffer that is current when a root is first seen decides on its
+        # overrides; they don't leak into other roots
+        dict.__setitem__(vimvar, 'b:', {'PyUnitTestsStructure': 'nose',
+                                        'PyUnitSourceRoot': 'src'})
+        other = mod.get_layout(os.path.join(two, 'src', 'foo.py'))
+        self.assertEquals(other.project_root, two)
+        self.assertTrue(isinstance(other, mod.NoseLayout))
+        self.assertEquals(other.source_root, 'src')
+        self.assertEquals(
+                other.get_test_file(os.path.join(two, 'src', 'foo.py')),
+                'tests/test_foo.py')
+        self.assertTrue(mod.get_layout(one) is layout)
+        self.assertEquals(layout.source_root, '')
+        self.assertEquals(mod.NoseRunner(two).command('tests'),
+                          'PYTHONPATH=src nosetests -q --with-machineout tests')
+
+        # Changed settings are picked up by every root
+        vimvar['g:PyUnitTestsRoot'] = 'test'
+        self.assertEquals(mod.get_layout(one).test_root, 'test')
+        self.assertTrue(mod.get_layout(one) is not layout)
+
+    def testCounterpartsInOtherRoot(self):
+        one, two = self.roots
+        vimvar['g:PyUnitFuzzyCounterparts'] = '0'
+        vimvar['g:PyUnitConfirmTestCreation'] = '0'
+        vimvar['g:PyUnitTestsSplitWindow'] = 'no'
+        source = os.path.join(two, 'src', 'pkg', 'mod.py')
+        os.makedirs(os.path.dirname(source))
+        open(source, 'w').close()
+        test_file = os.path.join(two, 'tests', 'test_src', 'test_pkg',
+                                 'test_mod.py')
+        cwd = os.getcwd()
+        os.chdir(one)
+        try:
+            vim.command.reset_mock()
+            mod.PyUnitSwitchToCounterpartOfFile(source)
+            self.assertTrue(os.path.isdir(os.path.dirname(test_file)))
+            self.assertFalse(os.path.exists(os.path.join(one, 'tests')))
+            self.assertEquals(vim.command.call_args_list[0][0][0],
+                              'edit ../two/tests/test_src/test_pkg/test_mod.py')
+
+            self.assertEquals(os.path.abspath(
+                    mod.find_source_file_for_test_file(test_file)), source)
+        finally:
+            os.chdir(cwd)
+
+    def testUnknownStructure(self):
+        dict.__setitem__(vimvar, 'b:', {'PyUnitTestsStructure': 'nope'})
+        self.assertRaises(RuntimeError, mod.get_layout, self.roots[0])
+
+
 class TestSideBySideLayout(FileAwareTestCase):
     def setUp(self):
         setUpVimEnvironment()
@@ -430,6 +536,1267 @@ class TestNoseLayout(FileAwareTestCase):
         self.assertRaises(RuntimeError, layout.get_source_candidates, '_foo.py')
 
 
+class TestDirCache(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root, 'pkg'))
+        open(os.path.join(self.root, 'pkg', 'foo.py'), 'w').close()
+        self.cache = mod.DirCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, f):
+        return os.path.join(self.root, f)
+
+    def set_mtime(self, directory, when):
+        # Whole seconds, so that setting the same mtime again is exact
+        os.utime(directory, (when, when))
+
+    def testExistenceChecks(self):
+        self.assertTrue(self.cache.isfile(self.path('pkg/foo.py')))
+        self.assertFalse(self.cache.isdir(self.path('pkg/foo.py')))
+        self.assertTrue(self.cache.isdir(self.path('pkg')))
+        self.assertTrue(self.cache.exists(self.path('pkg')))
+        self.assertFalse(self.cache.exists(self.path('pkg/bar.py')))
+        self.assertFalse(self.cache.exists(self.path('nope/bar.py')))
+
+    def testListingsAreKeptUntilTheDirectoryChanges(self):
+        pkg = self.path('pkg')
+        self.set_mtime(pkg, 1000000000)
+        self.assertFalse(self.cache.exists(self.path('pkg/bar.py')))
+
+        # Sneak in a file without changing the mtime of the directory
+        open(self.path('pkg/bar.py'), 'w').close()
+        self.set_mtime(pkg, 1000000000)
+        self.assertFalse(self.cache.exists(self.path('pkg/bar.py')))
+
+        self.set_mtime(pkg, 1000000030)
+        self.assertTrue(self.cache.exists(self.path('pkg/bar.py')))
+
+    def testRecentlyChangedDirectoriesAreNotKept(self):
+        self.assertFalse(self.cache.exists(self.path('pkg/bar.py')))
+        self.assertEquals(self.cache.listings, {})
+
+
+class TestFuzzyCounterparts(unittest.TestCase):
+    files = [
+        'setup.py',
+        'app/__init__.py',
+        'app/models/user.py',
+        'app/views/user.py',
+        'tests/test_app/test_views/test_user.py',
+        # Legacy tests that don't follow the layout
+        'tests/models/test_user.py',
+        'tests/test_helpers.py',
+        'lib/helpers.py',
+    ]
+
+    def setUp(self):
+        setUpVimEnvironment()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        for f in self.files:
+            self.write(f)
+        self.layout = mod.FollowHierarchyLayout(project_root=self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, f):
+        return os.path.join(self.root, f)
+
+    def write(self, f):
+        path = self.path(f)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def testPathSimilarity(self):
+        expected = 'app/models/user.py'
+        self.assertTrue(mod.path_similarity(expected, 'app/models/user.py') >
+                        mod.path_similarity(expected, 'old/models/user.py') >
+                        mod.path_similarity(expected, 'app/views/user.py'))
+        self.assertEquals(mod.path_similarity('tests/test_app/test_user.py',
+                                              'app/user.py', 'test_')[0], 2)
+
+    def testFuzzySourceFile(self):
+        find = lambda f: mod.find_fuzzy_counterpart(self.path(f), self.layout)
+        self.assertEquals(find('tests/models/test_user.py'),
+                          self.path('app/models/user.py'))
+        self.assertEquals(find('tests/test_helpers.py'),
+                          self.path('lib/helpers.py'))
+        self.assertEquals(find('app/models/user.py'),
+                          self.path('tests/models/test_user.py'))
+        self.assertEquals(find('setup.py'), None)
+
+    def testMissingTestFileIsCreated(self):
+        # Rather than switching to the legacy tests/models/test_user.py
+        vimvar['g:PyUnitConfirmTestCreation'] = '0'
+        vimvar['g:PyUnitTestsSplitWindow'] = 'no'
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            vim.command.reset_mock()
+            mod.PyUnitSwitchToCounterpartOfFile('app/models/user.py')
+            self.assertEquals(vim.command.call_args_list[0][0][0],
+                              'edit tests/test_app/test_models/test_user.py')
+        finally:
+            os.chdir(cwd)
+
+    def testIndexIsUpdatedIncrementally(self):
+        index = mod.get_filename_index(self.root)
+        self.assertEquals(index.lookup('test_setup.py'), [])
+        self.write('legacy/test_setup.py')
+        self.assertEquals(index.lookup('test_setup.py'),
+                          [self.path('legacy/test_setup.py')])
+        os.remove(self.path('lib/helpers.py'))
+        self.assertEquals(index.lookup('helpers.py'), [])
+
+        # Files written from within Vim are added right away
+        mod.note_written_file(self.path('app/models/test_misc.py'))
+        self.assertTrue(self.path('app/models/test_misc.py') in
+                        index.files['test_misc.py'])
+
+
+class TestCounterpartResolver(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        for f in ['setup.py', 'foo/__init__.py', 'foo/bar.py', 'foo/baz.py',
+                  'qux.py', 'tests/test_foo/test_bar.py', 'tests/test_qux.py']:
+            path = os.path.join(self.root, f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        layout = mod.FollowHierarchyLayout(project_root=self.root)
+        self.resolver = mod.CounterpartResolver(layout)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, f):
+        return os.path.join(self.root, f)
+
+    def testTestFilesFor(self):
+        mapping = self.resolver.test_files_for([self.path('foo/bar.py'),
+                self.path('tests/test_qux.py')])
+        self.assertEquals(mapping, {
+            self.path('foo/bar.py'): self.path('tests/test_foo/test_bar.py')})
+
+    def testSourceFilesFor(self):
+        mapping = self.resolver.source_files_for([
+                self.path('tests/test_foo/test_bar.py'),
+                self.path('tests/test_foo/test_nope.py')])
+        self.assertEquals(mapping, {
+            self.path('tests/test_foo/test_bar.py'): self.path('foo/bar.py'),
+            self.path('tests/test_foo/test_nope.py'): None})
+
+    def testUntestedFiles(self):
+        self.assertEquals(self.resolver.untested_files(self.root),
+                [self.path('foo/baz.py'), self.path('setup.py')])
+
+    def testExcludedDirs(self):
+        for f in ['env/pyvenv.cfg', 'env/lib/site.py', 'conda/conda-meta/x',
+                  'conda/lib/site.py', 'build/lib/foo/bar.py', '.tox/t.py']:
+            path = self.path(f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.assertEquals(self.resolver.untested_files(self.root),
+                [self.path('foo/baz.py'), self.path('setup.py')])
+        self.assertEquals(mod.get_filename_index(self.root).lookup('site.py'),
+                          [])
+
+        vimvar['g:PyUnitExcludeDirs'] = []
+        self.assertTrue(self.path('build/lib/foo/bar.py') in
+                        mod.find_python_files(self.root))
+
+
+class TestImpactedTests(unittest.TestCase):
+    files = {
+        'setup.py': '',
+        'pkg/__init__.py': '',
+        'pkg/core.py': 'import os\n',
+        'pkg/util.py': 'from . import core\n',
+        'app.py': 'from pkg.util import helper\n',
+        'tests/test_pkg/test_core.py': '',
+        'tests/test_pkg/test_util.py': 'import pkg.util\n',
+        'tests/test_app.py': 'import app\n',
+        'tests/test_other.py': 'import unittest\n',
+    }
+
+    def setUp(self):
+        setUpVimEnvironment()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        for f, contents in self.files.items():
+            path = self.path(f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write(contents)
+        self.layout = mod.FollowHierarchyLayout(project_root=self.root)
+        self.graph = mod.ImportGraph(self.root).build()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, f):
+        return os.path.join(self.root, f)
+
+    def testModuleNames(self):
+        self.assertEquals(self.graph.module_names(self.path('pkg/util.py')),
+                ['pkg.util'])
+        self.assertEquals(self.graph.module_names(self.path('pkg/__init__.py')),
+                ['pkg'])
+        graph = mod.ImportGraph(self.root, 'pkg')
+        self.assertEquals(graph.module_names(self.path('pkg/util.py')),
+                ['util', 'pkg.util'])
+
+    def testDependencies(self):
+        self.assertEquals(self.graph.dependencies(self.path('pkg/util.py')),
+                set([self.path('pkg/core.py')]))
+        self.assertEquals(self.graph.dependencies(self.path('app.py')),
+                set([self.path('pkg/util.py')]))
+        self.assertEquals(self.graph.dependencies(self.path('pkg/core.py')),
+                set())
+
+    def testDependents(self):
+        self.assertEquals(self.graph.dependents([self.path('pkg/core.py')]),
+                set([self.path('pkg/util.py'), self.path('app.py'),
+                     self.path('tests/test_pkg/test_util.py'),
+                     self.path('tests/test_app.py')]))
+
+    def testPersistentImportGraph(self):
+        parsed = []
+        orig_parse_imports = mod._parse_imports
+        def counting_parse_imports(path):
+            parsed.append(path)
+            return orig_parse_imports(path)
+        mod._parse_imports = counting_parse_imports
+        try:
+            graph = mod.load_import_graph(self.root)
+            self.assertEquals(len(parsed), len(self.files))
+            self.assertTrue(os.path.isfile(self.path('.pyunit/imports.json')))
+
+            # Reloading from disk doesn't parse anything
+            mod.clear_caches()
+            del parsed[:]
+            graph = mod.load_import_graph(self.root)
+            self.assertEquals(parsed, [])
+            self.assertEquals(graph.dependencies(self.path('app.py')),
+                    set([self.path('pkg/util.py')]))
+
+            # Only changed files are parsed again
+            open(self.path('app.py'), 'w').write('import pkg.core\n')
+            os.remove(self.path('tests/test_other.py'))
+            graph = mod.load_import_graph(self.root)
+            self.assertEquals(parsed, [self.path('app.py')])
+            self.assertEquals(graph.dependencies(self.path('app.py')),
+                    set([self.path('pkg/core.py')]))
+            self.assertFalse(self.path('tests/test_other.py') in graph.imports)
+        finally:
+            mod._parse_imports = orig_parse_imports
+
+    def testLayoutDependentTestFiles(self):
+        self.assertEquals(self.layout.get_dependent_test_files('pkg/util.py'),
+                [self.path('tests/test_app.py'),
+                 self.path('tests/test_pkg/test_util.py')])
+
+    def testImpactedTestFiles(self):
+        impacted = mod.find_impacted_test_files([self.path('pkg/core.py')],
+                self.layout, self.graph)
+        self.assertEquals(impacted, [
+            self.path('tests/test_app.py'),
+            self.path('tests/test_pkg/test_core.py'),
+            self.path('tests/test_pkg/test_util.py')])
+
+        impacted = mod.find_impacted_test_files(
+                [self.path('tests/test_other.py')], self.layout, self.graph)
+        self.assertEquals(impacted, [self.path('tests/test_other.py')])
+
+    def testTestFileToWatch(self):
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            self.assertEquals(mod.test_file_to_watch(self.path('pkg/core.py')),
+                    self.path('tests/test_pkg/test_core.py'))
+            self.assertEquals(mod.test_file_to_watch(self.path('tests/test_app.py')),
+                    self.path('tests/test_app.py'))
+            # No test file (yet)
+            self.assertEquals(mod.test_file_to_watch(self.path('setup.py')), None)
+        finally:
+            os.chdir(cwd)
+
+
+class TestMachineOutParser(unittest.TestCase):
+    def testParseFailuresAndErrors(self):
+        parser = mod.MachineOutParser()
+        self.assertEquals(parser.feed('tests/test_foo.py:12: fail: 1 != 2\n'),
+                {'filename': 'tests/test_foo.py', 'lnum': 12, 'text': '1 != 2'})
+        self.assertEquals(parser.feed('foo.py:3: error: ImportError: bar'),
+                {'filename': 'foo.py', 'lnum': 3, 'text': 'ImportError: bar'})
+        self.assertEquals(parser.failures, 2)
+
+    def testIgnoresOtherOutput(self):
+        parser = mod.MachineOutParser()
+        self.assertEquals(parser.feed('Ran 3 tests in 0.002s'), None)
+        self.assertEquals(parser.feed(''), None)
+        self.assertEquals(parser.failures, 0)
+        self.assertEquals(list(parser.tail), ['Ran 3 tests in 0.002s'])
+
+    def testDeduplicatesRepeatedFailures(self):
+        parser = mod.MachineOutParser()
+        line = 'tests/test_foo.py:5: error: setUp is broken'
+        self.assertNotEquals(parser.feed(line), None)
+        self.assertEquals(parser.feed(line), None)
+        self.assertEquals(parser.failures, 2)
+        self.assertEquals(parser.duplicates, 1)
+
+    def testCapsEntries(self):
+        parser = mod.MachineOutParser(max_entries=2, max_text_length=5)
+        entries = [parser.feed('foo.py:%d: fail: long message' % i)
+                   for i in range(4)]
+        self.assertEquals([e['text'] for e in entries if e], ['long ', 'long '])
+        self.assertEquals(parser.failures, 4)
+        self.assertEquals(len(parser.seen), 2)
+
+
+class TestRunOutput(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        vim.command.reset_mock()
+        # Keep the history of these runs out of our own project root
+        self.cache_dir = tempfile.mkdtemp()
+        vimvar['g:PyUnitCacheDir'] = self.cache_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testChunkedQuickfixUpdates(self):
+        output = mod.start_test_output()
+        output.writer.chunk_size = 2
+        output.writer.interval = 60
+        output.feed(['a.py:%d: fail: x' % i for i in range(5)])
+        self.assertEquals(output.finish(1), 5)
+        # one to clear the list, one to tag it with the traceback spill, two
+        # full chunks and the remainder
+        self.assertEquals(vim.command.call_count, 5)
+
+    def testCrashedCommand(self):
+        vimvar['g:PyUnitCmd'] = 'echo "ImportError: foo"; exit 2'
+        numfail = mod.run_tests_to_quickfix()
+        self.assertEquals(numfail, -1)
+        last = vim.command.call_args[0][0]
+        self.assertTrue('ImportError: foo' in last)
+
+
+class TestTracebackSpill(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        vim.command.reset_mock()
+        self.cache_dir = tempfile.mkdtemp()
+        vimvar['g:PyUnitCacheDir'] = self.cache_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testSpill(self):
+        spill = mod.TracebackSpill(os.path.join(self.cache_dir, 'tracebacks'))
+        spill.add(1, u'Traceback (most recent call last):\n  caf\xe9\n')
+        self.assertEquals(spill.get(1),
+                          u'Traceback (most recent call last):\n  caf\xe9\n')
+        # Reads map what was written after the previous read, too
+        spill.add(3, 'x' * 10000)
+        spill.add(4, '')
+        self.assertEquals(spill.get(3), 'x' * 10000)
+        self.assertEquals(spill.get(2), None)
+        self.assertEquals(spill.get(4), None)
+        self.assertTrue(os.path.getsize(spill.path) < 1000)
+        spill.close()
+
+    def testPreviewTracebacks(self):
+        output = mod.start_test_output()
+        output.feed(['a.py:1: fail: x',
+                     '\t"Traceback 1\\nAssertionError: x\\n"',
+                     'a.py:1: fail: x',
+                     '\t"Traceback of the duplicate"',
+                     'b.py:2: error: y',
+                     '\tnot a traceback',
+                     '\t42',
+                     '\t"Traceback 2"'])
+        self.assertEquals(output.finish(1), 3)
+        tag = vim.command.call_args_list[1][0][0]
+        token = re.search(r'"pyunit": (\d+)', tag).group(1)
+
+        vim.command.reset_mock()
+        mod.PyUnitPreviewTraceback('1', token)
+        vim.command.assert_called_with('call pyunit#ShowTraceback('
+                                       '["Traceback 1", "AssertionError: x"])')
+        mod.PyUnitPreviewTraceback('2', token)
+        vim.command.assert_called_with(
+                'call pyunit#ShowTraceback(["Traceback 2"])')
+        # The quickfix list was replaced by someone else
+        mod.PyUnitPreviewTraceback('1', '')
+        vim.command.assert_called_with(
+                'echo "No traceback for this entry."')
+
+        # Emptying the list keeps its context, but not its tracebacks
+        mod.note_cached_files(2, [])
+        mod.PyUnitPreviewTraceback('1', token)
+        vim.command.assert_called_with(
+                'echo "No traceback for this entry."')
+
+    def testNoQuickfixContext(self):
+        vimvar['pyunit#HasQuickfixContext()'] = '0'
+        self.assertEquals(mod.start_traceback_spill(), None)
+        self.assertFalse(vim.command.called)
+
+
+class TestRunners(unittest.TestCase):
+    test_source = '\n'.join([
+        'import unittest',
+        '',
+        'class TestA(unittest.TestCase):',
+        '    def test_ok(self):',
+        '        pass',
+        '',
+        '    def test_fail(self):',
+        '        self.assertEqual(1, 2)',
+        '',
+        '    def test_error(self):',
+        '        {}["key"]',
+        ''])
+
+    report = '''<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="pytest" tests="5">
+  <testcase classname="tests.test_a.TestA" name="test_ok" time="0.5"/>
+  <testcase classname="tests.test_a.TestA" file="tests/test_a.py" line="6"
+            name="test_fail" time="0.25">
+    <failure message="AssertionError: 1 != 2">self = &lt;TestA&gt;
+
+    def test_fail(self):
+&gt;       self.assertEqual(1, 2)
+E       AssertionError: 1 != 2
+
+tests/test_a.py:8: AssertionError</failure>
+    <system-out>computing...</system-out>
+  </testcase>
+  <testcase classname="tests.test_a.TestA" name="test_error" time="0.125">
+    <error type="KeyError" message="&apos;key&apos;">Traceback (most recent call last):
+  File "%(root)s/tests/test_a.py", line 11, in test_error
+    {}["key"]
+KeyError: &apos;key&apos;</error>
+  </testcase>
+  <testcase classname="tests.test_a.TestA" name="test_other[1]" time="0">
+    <skipped message="not now"/>
+  </testcase>
+  <testcase classname="tests.test_a" name="test_function" time="0">
+    <failure message="broken"/>
+  </testcase>
+</testsuite></testsuites>
+'''
+
+    def setUp(self):
+        setUpVimEnvironment()
+        vim.command.reset_mock()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root, 'tests'))
+        open(os.path.join(self.root, 'setup.py'), 'w').close()
+        open(os.path.join(self.root, 'tests', 'test_a.py'), 'w').write(
+                self.test_source + 'def test_function():\n    pass\n')
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def testCommands(self):
+        args = 'tests/test_a.py:TestA.test_ok tests'
+        self.assertEquals(mod.NoseRunner(self.root).command(args, stop=True),
+                'nosetests -q --with-machineout --stop '
+                'tests/test_a.py:TestA.test_ok tests')
+        self.assertEquals(mod.PytestRunner(self.root).command(args, report='r.xml'),
+                'pytest --junitxml=r.xml -o junit_family=xunit1 '
+                'tests/test_a.py::TestA::test_ok tests')
+        self.assertEquals(mod.Nose2Runner(self.root).command(args, stop=True),
+                'nose2 --fail-fast tests.test_a.TestA.test_ok tests')
+
+        vimvar['g:PyUnitPytestCmd'] = 'py.test -p no:cacheprovider'
+        runner = mod.PytestRunner(self.root)
+        self.assertEquals(runner.command('tests'),
+                'py.test -p no:cacheprovider tests')
+        self.assertEquals(runner.python_command(),
+                '-m pytest -p no:cacheprovider')
+
+        vimvar['g:PyUnitSourceRoot'] = 'src'
+        cmd = mod.UnittestRunner(self.root).command('tests/test_a.py')
+        self.assertTrue(cmd.startswith('PYTHONPATH=src '))
+        self.assertTrue(cmd.endswith(' --once --path src %s %s/tests/test_a.py'
+                                     % (self.root, self.root)))
+        cmd = mod.UnittestRunner(self.root).command('tests', report='r.xml')
+        self.assertTrue(' --junit-xml r.xml ' in cmd)
+
+    def testGetRunner(self):
+        vimvar['g:PyUnitRunner'] = 'pytest'
+        self.assertEquals(mod.get_runner(), mod.PytestRunner)
+        vimvar['g:PyUnitRunner'] = 'doctest'
+        self.assertRaises(RuntimeError, mod.get_runner)
+
+    def testReadJUnitReport(self):
+        report = os.path.join(self.root, 'report.xml')
+        open(report, 'w').write(self.report % {'root': self.root})
+        results = mod.PytestRunner(self.root).read_report(report)
+        test_file = os.path.join(self.root, 'tests', 'test_a.py')
+        self.assertEquals([r[:-1] for r in results], [
+            (test_file, 'TestA.test_ok', 'passed', 0.5, None, 0, ''),
+            (test_file, 'TestA.test_fail', 'failure', 0.25,
+             'tests/test_a.py', 8, 'AssertionError: 1 != 2'),
+            (test_file, 'TestA.test_error', 'error', 0.125,
+             'tests/test_a.py', 11, "'key'"),
+            (test_file, 'TestA.test_other', 'skipped', 0.0, None, 0, ''),
+            # Without a traceback, the failure is put at the test itself
+            (test_file, 'test_function', 'failure', 0.0,
+             'tests/test_a.py', 12, 'broken'),
+        ])
+        # The full tracebacks, and captured output, are kept aside
+        details = [r.details for r in results]
+        self.assertEquals(details[0], '')
+        self.assertTrue(details[1].startswith('self = <TestA>'))
+        self.assertTrue(details[1].endswith('Captured out:\ncomputing...'))
+        self.assertTrue(details[2].startswith('Traceback'))
+        self.assertEquals(details[4], 'broken')
+        self.assertEquals(mod.PytestRunner(self.root).read_report('nope.xml'),
+                          None)
+
+    def testLoadLargeReport(self):
+        report = os.path.join(self.root, 'ci.xml')
+        f = open(report, 'w')
+        f.write('<testsuites><testsuite name="ci">\n')
+        for i in range(2000):
+            f.write('<testcase classname="tests.test_a.TestA" name="test_%d" '
+                    'time="0.001"><system-out>%s</system-out></testcase>\n'
+                    % (i, 'x' * 100))
+        # Tracebacks of the CI server point into its own checkout
+        f.write('<testcase classname="tests.test_a.TestA" name="test_fail">'
+                '<failure message="1 != 2">Traceback (most recent call last):\n'
+                '  File "/ci/build/tests/test_a.py", line 8, in test_fail\n'
+                '  File "/ci/lib/python/unittest/case.py", line 3, in fail\n'
+                'AssertionError: 1 != 2</failure></testcase>\n')
+        f.write('<testcase classname="tests.test_a.TestA" name="test_error">'
+                '<error message="boom"/></testcase>\n')
+        f.write('</testsuite></testsuites>\n')
+        f.close()
+
+        summary = mod.load_junit_report(report, self.root)
+        self.assertEquals(summary.counts, {'passed': 2000, 'failure': 1,
+                                           'error': 1, 'skipped': 0})
+        self.assertEquals([(r.test_id, r.filename, r.lnum)
+                           for r in summary.failures],
+                [('TestA.test_fail', 'tests/test_a.py', 8),
+                 ('TestA.test_error', 'tests/test_a.py', 10)])
+        self.assertEquals(summary.describe(),
+                '2002 tests, 1 failures, 1 errors, 0 skipped in 2.00s')
+
+        self.assertEquals(mod.PyUnitLoadJUnitReport(report), 2)
+        self.assertTrue('2002 tests' in vim.command.call_args[0][0])
+
+    def testIterReportReleasesTestcases(self):
+        report = os.path.join(self.root, 'report.xml')
+        open(report, 'w').write(self.report % {'root': self.root})
+        seen = []
+        orig_read_testcase = mod.JUnitRunner.read_testcase
+        def read_testcase(runner, case):
+            seen.append(case)
+            return orig_read_testcase(runner, case)
+        runner = mod.JUnitRunner(self.root)
+        runner.read_testcase = lambda case: read_testcase(runner, case)
+        self.assertEquals(len(list(runner.iter_report(report))), 5)
+        # Once read, every testcase is emptied
+        self.assertEquals([len(case) for case in seen], [0] * 5)
+
+    def testRunWithReport(self):
+        sample = os.path.join(self.root, 'sample.xml')
+        open(sample, 'w').write(self.report % {'root': self.root})
+
+        class CopyRunner(mod.JUnitRunner):
+            def base_command(self):
+                return 'true'
+
+            def report_options(self, report):
+                return ['&& cp', sample, report, '&& true']
+
+        numfail = mod.run_tests_to_quickfix('tests/test_a.py',
+                                            runner=CopyRunner(self.root))
+        self.assertEquals(numfail, 3)
+        store = mod.DurationStore(self.root)
+        self.assertEquals(store.mean('tests/test_a.py'), 0.875)
+        self.assertEquals(store.mean('tests/test_a.py:TestA.test_fail'), 0.25)
+        self.assertEquals(mod.last_failed_selectors('tests/test_a.py'), [
+            'tests/test_a.py:TestA.test_fail',
+            'tests/test_a.py:TestA.test_error',
+            'tests/test_a.py:test_function'])
+
+        # A run of some of its tests doesn't count for the whole file
+        open(sample, 'w').write(
+                '<testsuite><testcase classname="tests.test_a.TestA" '
+                'name="test_fail" time="0.75"><failure message="x"/>'
+                '</testcase></testsuite>')
+        mod.run_tests_to_quickfix('tests/test_a.py:TestA.test_fail',
+                                  runner=CopyRunner(self.root))
+        store = mod.DurationStore(self.root)
+        self.assertEquals(store.mean('tests/test_a.py'), 0.875)
+        self.assertEquals(store.mean('tests/test_a.py:TestA.test_fail'), 0.5)
+
+    def testProfileRun(self):
+        vimvar['g:PyUnitRunner'] = 'unittest'
+        mod.profiler.start('run tests')
+        mod.run_tests_to_quickfix('tests/test_a.py')
+        mod.profiler.finish()
+        phases = mod.profiler.invocations[-1]['phases']
+        for phase in ('config', 'spawn', 'tests', 'parse', 'quickfix'):
+            self.assertTrue(phase in phases, phase)
+
+    def testUnittestRunner(self):
+        open(os.path.join(self.root, 'tests', 'test_a.py'), 'w').write(
+                self.test_source)
+        vimvar['g:PyUnitRunner'] = 'unittest'
+        numfail = mod.run_tests_to_quickfix('tests/test_a.py')
+        self.assertEquals(numfail, 2)
+        entries = ''.join(c[0][0] for c in vim.command.call_args_list)
+        self.assertTrue('"lnum": 8' in entries)
+        self.assertTrue('"lnum": 11' in entries)
+        # The report has every test, even though tests/ isn't a package
+        store = mod.DurationStore(self.root)
+        self.assertTrue(store.mean('tests/test_a.py:TestA.test_ok') is not None)
+        self.assertEquals(mod.last_failed_selectors('tests/test_a.py'), [
+            'tests/test_a.py:TestA.test_error',
+            'tests/test_a.py:TestA.test_fail'])
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = mod.Profiler(size=3)
+        self.now = 100.0
+        self.orig_time = mod.time.time
+        mod.time.time = lambda: self.now
+
+    def tearDown(self):
+        mod.time.time = self.orig_time
+
+    def testVimLiteralFloats(self):
+        # Vim rejects floats without a "." (like 5e-06) with E15
+        self.assertEquals(mod._vim_literal(5e-06), '5.0e-06')
+        self.assertEquals(mod._vim_literal(0.25), '0.25')
+        self.assertEquals(mod._vim_literal(2.0), '2.0')
+        self.assertEquals(mod._vim_literal({'a': [1, 1e-07, u'x"y']}),
+                          '{"a": [1, 1.0e-07, "x\\"y"]}')
+
+    def testTimed(self):
+        profiler = self.profiler
+        @profiler.timed('walk')
+        def walk(n):
+            self.now += 1
+            if n:
+                walk(n - 1)
+
+        walk(2)  # not part of an invocation
+        profiler.start('switch')
+        walk(2)
+        profiler.add('write', 0.5)
+        profiler.finish()
+        self.assertEquals(list(profiler.invocations), [
+            {'name': 'switch', 'secs': 3.0,
+             # Recursive calls are only counted once
+             'phases': {'walk': 3.0, 'write': 0.5}}])
+        self.assertEquals(walk.__name__, 'walk')
+
+    def testRingBuffer(self):
+        for i in range(5):
+            self.profiler.start('run')
+            self.now += i
+            self.profiler.finish()
+        # A cancelled invocation is dropped
+        self.profiler.start('run')
+        self.profiler.start('switch')
+        self.profiler.finish()
+        self.assertEquals([i['secs'] for i in self.profiler.invocations],
+                          [3.0, 4.0, 0.0])
+
+    def testSummary(self):
+        profiler = self.profiler = mod.Profiler(size=10)
+        for i in range(1, 11):
+            profiler.start('run')
+            profiler.add('tests', i / 10.0)
+            self.now += i
+            profiler.finish()
+        summary = self.profiler.summary()
+        self.assertEquals(summary['run']['count'], 10)
+        self.assertEquals(summary['run']['total'],
+                          {'p50': 5.0, 'p90': 9.0, 'p99': 10.0, 'max': 10.0})
+        self.assertEquals(summary['run']['phases']['tests']['p50'], 0.5)
+
+        report = self.profiler.report()
+        self.assertTrue(report[0].startswith('run (10) '))
+        self.assertTrue(report[1].startswith('  total '))
+        self.assertTrue('5000.0ms' in report[1])
+        self.assertEquals(mod.Profiler().report(), ['Nothing recorded yet.'])
+
+    def testPercentiles(self):
+        self.assertEquals(mod.percentiles([3]),
+                          {'p50': 3, 'p90': 3, 'p99': 3, 'max': 3})
+        self.assertEquals(mod.percentiles(range(100, 0, -1))['p90'], 90)
+
+
+class TestCoverageIndex(unittest.TestCase):
+    source = '\n'.join([
+        'def add(a, b):',                  # 1
+        '    return a + b',                # 2
+        '',                                # 3
+        'class Calc(object):',             # 4
+        '    def mul(self, a, b):',        # 5
+        '        return a * b',            # 6
+        ''])
+
+    def setUp(self):
+        setUpVimEnvironment()
+        vim.command.reset_mock()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root, 'tests'))
+        open(os.path.join(self.root, 'setup.py'), 'w').close()
+        self.source_file = os.path.join(self.root, 'calc.py')
+        open(self.source_file, 'w').write(self.source)
+        for name in ('test_add', 'test_calc', 'test_other'):
+            open(os.path.join(self.root, 'tests', name + '.py'), 'w').write(
+                    'def test_it():\n    pass\n')
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def numbits(self, lines):
+        bits = bytearray(max(lines) // 8 + 1)
+        for lnum in lines:
+            bits[lnum // 8] |= 1 << (lnum % 8)
+        return bytes(bits)
+
+    def writeCoverageData(self, path, measured):
+        """Writes the parts of a coverage.py data file that are read back."""
+        import sqlite3
+        conn = sqlite3.connect(path)
+        conn.executescript(
+                'CREATE TABLE file (id integer primary key, path text);'
+                'CREATE TABLE context (id integer primary key, context text);'
+                'CREATE TABLE line_bits (file_id integer, '
+                '                        context_id integer, numbits blob);')
+        conn.execute('INSERT INTO context (id, context) VALUES (1, "")')
+        for source, context, lines in measured:
+            conn.execute('INSERT OR IGNORE INTO file (path) VALUES (?)',
+                         (source,))
+            conn.execute('INSERT INTO context (context) VALUES (?)', (context,))
+            conn.execute('INSERT INTO line_bits SELECT file.id, context.id, ? '
+                         'FROM file, context WHERE file.path = ? AND '
+                         'context.context = ?',
+                         (sqlite3.Binary(self.numbits(lines)), source, context))
+        conn.commit()
+        conn.close()
+
+    def testNumbits(self):
+        lines = [1, 2, 3, 7, 8, 20]
+        self.assertEquals(mod.numbits_to_lines(self.numbits(lines)), lines)
+        self.assertEquals(mod.line_ranges(lines), [[1, 3], [7, 8], [20, 20]])
+        self.assertEquals(mod.line_ranges([]), [])
+
+    def testCoverageContextTest(self):
+        test_file = os.path.join(self.root, 'tests', 'test_add.py')
+        self.assertEquals(mod.coverage_context_test(
+                'tests.test_add.TestAdd.test_it', self.root),
+                (test_file, 'TestAdd.test_it'))
+        self.assertEquals(mod.coverage_context_test(
+                'tests/test_add.py::TestAdd::test_it|run', self.root),
+                (test_file, 'TestAdd.test_it'))
+        self.assertEquals(mod.coverage_context_test('calc.add', self.root),
+                          (self.source_file, 'add'))
+        self.assertEquals(mod.coverage_context_test('nope.test', self.root),
+                          (None, None))
+        # Modules of test directories that aren't packages have no prefix
+        self.assertEquals(mod.coverage_context_test(
+                'test_add.TestAdd.test_it', self.root),
+                (test_file, 'TestAdd.test_it'))
+
+    def testIndexDefinitions(self):
+        index = mod.index_definitions(self.source)
+        self.assertEquals([(first, name) for first, last, name in index],
+                [(1, 'add'), (4, 'Calc'), (5, 'Calc.mul')])
+        # Whether trailing blank lines count depends on the Python version
+        self.assertTrue(index[0][1] in (2, 3))
+        self.assertEquals(index[2][1], 6)
+
+    def testUpdateCoverageIndex(self):
+        sample = os.path.join(self.root, 'sample.db')
+        args_file = os.path.join(self.root, 'args')
+        self.writeCoverageData(sample, [
+            (self.source_file, 'tests.test_add.test_it', [1, 2]),
+            (self.source_file, 'tests.test_calc.test_it', [4, 5, 6]),
+            (self.source_file, 'tests.test_calc.TestCalc.test_add', [2]),
+        ])
+
+        class FakeCoverageRunner(mod.NoseRunner):
+            def coverage_command(self, rcfile):
+                return 'cp %s %s && echo >%s' % (
+                        sample, mod.cache_path(self.project_root,
+                                               'coverage.db'), args_file)
+
+        layout = mod.get_implementing_class()()
+        runner = FakeCoverageRunner(self.root)
+        self.assertEquals(mod.update_coverage_index(layout, runner), 0)
+        self.assertEquals(open(args_file).read().strip(), '')
+        self.assertEquals(mod.tests_covering_line(self.source_file,
+                                                  self.source, 2),
+                ['tests/test_add.py:test_it',
+                 'tests/test_calc.py:TestCalc.test_add'])
+        self.assertEquals(mod.tests_covering_line(self.source_file,
+                                                  self.source, 6),
+                ['tests/test_calc.py:test_it'])
+        self.assertEquals(mod.tests_covering_line('tests/test_add.py', '', 1),
+                          None)
+
+        # Nothing changed, so nothing runs
+        self.assertEquals(mod.update_coverage_index(layout, runner), None)
+
+        # Only the changed test file runs again, and replaces its own tests
+        os.remove(os.path.join(self.root, 'tests', 'test_add.py'))
+        test_calc = os.path.join(self.root, 'tests', 'test_calc.py')
+        open(test_calc, 'a').write('# changed\n')
+        os.remove(sample)
+        self.writeCoverageData(sample, [
+            (self.source_file, 'tests.test_calc.test_it', [5, 6]),
+        ])
+        self.assertEquals(mod.update_coverage_index(layout, runner), 0)
+        self.assertEquals(open(args_file).read().strip(), 'tests/test_calc.py')
+        self.assertEquals(mod.tests_covering_line(self.source_file,
+                                                  self.source, 2), [])
+        self.assertEquals(mod.tests_covering_line(self.source_file,
+                                                  self.source, 5),
+                ['tests/test_calc.py:test_it'])
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        vim.command.reset_mock()
+        self.cache_dir = tempfile.mkdtemp()
+        vimvar['g:PyUnitCacheDir'] = self.cache_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testMakeShardsBalancesCost(self):
+        costs = {'a': 10, 'b': 7, 'c': 5, 'd': 3, 'e': 2, 'f': 1}
+        shards = mod.make_shards(list(costs), 2, cost=costs.get)
+        self.assertEquals(shards, [['a', 'd', 'f'], ['b', 'c', 'e']])
+        self.assertEquals([sum(costs[p] for p in s) for s in shards], [14, 14])
+
+    def testMakeShardsWithFewFiles(self):
+        self.assertEquals(mod.make_shards(['a'], 4, cost=len), [['a']])
+        self.assertEquals(mod.make_shards([], 4, cost=len), [])
+
+    def testShardCount(self):
+        vimvar['g:PyUnitShards'] = '3'
+        self.assertEquals(mod.shard_count(), 3)
+        vimvar['g:PyUnitShards'] = '0'
+        self.assertTrue(mod.shard_count() >= 1)
+
+    def testRunShardsMergesResults(self):
+        vimvar['g:PyUnitCmd'] = 'printf "%s:1: fail: oops\\n"'
+        numfail = mod.run_shards_to_quickfix([['a.py'], ['b.py', 'c.py']])
+        self.assertEquals(numfail, 3)
+        entries = ''.join(c[0][0] for c in vim.command.call_args_list)
+        for f in ['a.py', 'b.py', 'c.py']:
+            self.assertTrue('"filename": "%s"' % f in entries)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        vim.command.reset_mock()
+        vimvar['g:PyUnitResultCache'] = '1'
+        vimvar['g:PyUnitCmd'] = 'true'
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root, 'tests'))
+        self.files = {
+            'setup.py': '',
+            'util.py': 'X = 1\n',
+            'calc.py': 'import util\n',
+            'tests/__init__.py': '',
+            'tests/test_calc.py': 'import calc\n',
+            'tests/test_other.py': 'import os\n',
+        }
+        for name, contents in self.files.items():
+            self.write(name, contents)
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, contents, age=3600):
+        # Files changed within the last seconds aren't trusted by their stat
+        open(self.path(name), 'w').write(contents)
+        past = int(time.time()) - age
+        os.utime(self.path(name), (past, past))
+
+    def runAll(self):
+        """Runs PyUnitRunUncachedTests, and returns the paths it ran (or
+        None) and the number of test files it reported cached.
+
+        """
+        vim.command.reset_mock()
+        mod.PyUnitRunUncachedTests()
+        ran = None
+        cached = None
+        for call in vim.command.call_args_list:
+            cmd = call[0][0]
+            match = re.match(r'call pyunit#RunNose\("(.*)", .*, (\d+)\)', cmd)
+            if match:
+                ran, cached = match.group(1), int(match.group(2))
+                mod.run_tests_to_quickfix(ran)
+            match = re.match(r'call pyunit#NoteCachedFiles\((\d+)\)', cmd)
+            if match:
+                cached = int(match.group(1))
+        return ran, cached
+
+    def testFileHashes(self):
+        hashes = mod.FileHashes(self.root)
+        digest = hashes.digest(self.path('util.py'))
+        self.assertEquals(hashes.digest(self.path('nope.py')), None)
+        hashes.save()
+
+        # Same size and mtime: the file isn't read again
+        mtime = int(os.stat(self.path('util.py')).st_mtime)
+        open(self.path('util.py'), 'w').write('X = 2\n')
+        os.utime(self.path('util.py'), (mtime, mtime))
+        hashes = mod.FileHashes(self.root)
+        self.assertEquals(hashes.digest(self.path('util.py')), digest)
+
+        # Recently changed files are hashed, but their hashes aren't kept
+        self.write('util.py', 'X = 3\n', age=0)
+        changed = hashes.digest(self.path('util.py'))
+        self.assertNotEquals(changed, digest)
+        self.assertEquals(hashes.hashes['util.py'][2], digest)
+
+    def testKeysFollowImports(self):
+        runner = mod.NoseRunner(self.root)
+        layout = mod.get_layout(self.root)
+        test_calc = self.path('tests/test_calc.py')
+        test_other = self.path('tests/test_other.py')
+        inputs = mod.ResultCache(layout, runner).inputs(test_calc)
+        self.assertEquals(sorted(mod._relpath(p, self.root) for p in inputs),
+                          ['calc.py', 'tests/__init__.py',
+                           'tests/test_calc.py', 'util.py'])
+        keys = mod.ResultCache(layout, runner).keys([test_calc, test_other])
+
+        self.write('util.py', 'X = 2\n', age=1800)
+        mod.clear_caches()
+        changed = mod.ResultCache(layout, runner).keys([test_calc, test_other])
+        self.assertNotEquals(changed[test_calc], keys[test_calc])
+        self.assertEquals(changed[test_other], keys[test_other])
+
+        vimvar['g:PyUnitCmd'] = 'nosetests -v'
+        changed = mod.ResultCache(layout, runner).keys([test_other])
+        self.assertNotEquals(changed[test_other], keys[test_other])
+
+    def testFailedTestFiles(self):
+        graph = mod.get_layout(self.root).get_import_graph()
+        test_calc = self.path('tests/test_calc.py')
+        test_other = self.path('tests/test_other.py')
+        run = [test_calc, test_other]
+        self.assertEquals(mod.failed_test_files(run, [], graph), set())
+        self.assertEquals(mod.failed_test_files(
+                run, [('tests/test_other.py', 1)], graph), set([test_other]))
+        self.assertEquals(mod.failed_test_files(
+                run, [('util.py', 1)], graph), set([test_calc]))
+        self.assertEquals(mod.failed_test_files(
+                run, [('/usr/lib/python/os.py', 1)], graph), set(run))
+
+    def testRunAllSkipsCachedPasses(self):
+        vimvar['g:PyUnitCmd'] = 'cat failures.txt #'
+        open('failures.txt', 'w').write('calc.py:1: fail: oops\n')
+        self.assertEquals(self.runAll(),
+                          ('tests/test_calc.py tests/test_other.py', 0))
+
+        # Only the test file that failed runs again
+        open('failures.txt', 'w').write('')
+        self.assertEquals(self.runAll(), ('tests/test_calc.py', 1))
+
+        # Everything passed, and nothing changed
+        self.assertEquals(self.runAll(), (None, 2))
+
+        # A change to an imported file invalidates its importers only
+        self.write('util.py', 'X = 2\n', age=1800)
+        self.assertEquals(self.runAll(), ('tests/test_calc.py', 1))
+
+        vimvar['g:PyUnitResultCache'] = '0'
+        self.assertEquals(self.runAll(),
+                          ('tests/test_calc.py tests/test_other.py', 0))
+
+
+class TestDurationStore(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.store = mod.DurationStore(self.root, window=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testRecordAndReload(self):
+        self.store.record({'tests/test_a.py': 2.0, 'tests/test_b.py': 1.0}, 1)
+        self.store.record({'tests/test_a.py': 4.0}, 2)
+        store = mod.DurationStore(self.root, window=3)
+        self.assertEquals(store.mean('tests/test_a.py'), 3.0)
+        self.assertEquals(store.mean('tests/test_b.py'), 1.0)
+        self.assertEquals(store.mean('tests/test_c.py'), None)
+        self.assertEquals(store.trend('tests/test_a.py'), 1.0)
+        self.assertEquals(store.trend('tests/test_b.py'), None)
+
+    def testRollingWindow(self):
+        for i in range(5):
+            self.store.record({'tests/test_a.py': float(i)}, i)
+        self.assertEquals(list(self.store.samples['tests/test_a.py']),
+                [(2, 2.0), (3, 3.0), (4, 4.0)])
+        self.store.compact()
+        lines = open(self.store.path).readlines()
+        self.assertEquals(len(lines), 3)
+        self.assertEquals(mod.DurationStore(self.root, window=3).mean(
+                'tests/test_a.py'), 3.0)
+
+    def testSlowest(self):
+        self.store.record({'tests/test_a.py': 1.0, 'tests/test_b.py': 3.0,
+                           'tests/test_b.py:TestB.test_x': 2.5}, 1)
+        self.assertEquals(self.store.slowest(1),
+                [(3.0, 'tests/test_b.py')])
+        self.assertEquals(self.store.slowest(5, tests=True),
+                [(2.5, 'tests/test_b.py:TestB.test_x')])
+        report = self.store.report(5)
+        self.assertTrue(report[0].startswith('Slowest test files'))
+        self.assertTrue('tests/test_b.py:TestB.test_x' in report[-1])
+
+    def testEstimatorUsesHistory(self):
+        known = os.path.join(self.root, 'test_known.py')
+        unknown = os.path.join(self.root, 'test_unknown.py')
+        open(known, 'w').write('x' * 100)
+        open(unknown, 'w').write('x' * 50)
+        self.store.record({'test_known.py': 10.0})
+        cost = self.store.estimator()
+        self.assertEquals(cost(known), 10.0)
+        self.assertEquals(cost(unknown), 5.0)
+
+    def testApportionDuration(self):
+        costs = {'a': 3.0, 'b': 1.0}
+        self.assertEquals(mod.apportion_duration(['a', 'b'], 8, costs.get),
+                {'a': 6.0, 'b': 2.0})
+        self.assertEquals(mod.apportion_duration(['a', 'b'], 8, lambda p: 0),
+                {'a': 4.0, 'b': 4.0})
+
+    def testRecordDurations(self):
+        path = os.path.join(self.root, 'tests', 'test_a.py')
+        mod.record_durations([path], 1.5, self.store)
+        self.assertEquals(self.store.mean('tests/test_a.py'), 1.5)
+
+
+class TestFailures(unittest.TestCase):
+    source = '\n'.join([
+        'import unittest',                 # 1
+        '',                                # 2
+        'class TestFoo(unittest.TestCase):',
+        '    def setUp(self):',            # 4
+        '        pass',                    # 5
+        '',                                # 6
+        '    @decorated',                  # 7
+        '    def test_one(self):',         # 8
+        '        self.fail()',             # 9
+        '',                                # 10
+        '    def test_two(self):',         # 11
+        '        pass',                    # 12
+        '',                                # 13
+        'def test_function():',            # 14
+        '    assert False',                # 15
+        '',                                # 16
+        'def helper():',                   # 17
+        '    pass',                        # 18
+    ])
+
+    def setUp(self):
+        setUpVimEnvironment()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.test_file = os.path.join(self.root, 'tests', 'test_foo.py')
+        os.makedirs(os.path.dirname(self.test_file))
+        open(self.test_file, 'w').write(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testIndexTests(self):
+        index = mod.index_tests(self.source)
+        self.assertEquals([test_id for first, last, test_id in index],
+                ['TestFoo', 'TestFoo.test_one', 'TestFoo.test_two',
+                 'test_function'])
+        self.assertEquals(index[1][0], 7)
+
+    def testBufferTestIndex(self):
+        lines = self.source.splitlines()
+        index = mod.buffer_test_index(3, 10, lines)
+        self.assertEquals(mod.find_test_at(index, 12), 'TestFoo.test_two')
+
+        # Unchanged buffers aren't parsed again
+        self.assertTrue(mod.buffer_test_index(3, 10, []) is index)
+        self.assertEquals(mod.buffer_test_index(3, 11, lines[:10]),
+                [(3, 9, 'TestFoo'), (7, 9, 'TestFoo.test_one')])
+
+    def testFindTestAt(self):
+        index = mod.index_tests(self.source)
+        self.assertEquals(mod.find_test_at(index, 1), None)
+        self.assertEquals(mod.find_test_at(index, 5), 'TestFoo')
+        self.assertEquals(mod.find_test_at(index, 7), 'TestFoo.test_one')
+        self.assertEquals(mod.find_test_at(index, 9), 'TestFoo.test_one')
+        self.assertEquals(mod.find_test_at(index, 12), 'TestFoo.test_two')
+        self.assertEquals(mod.find_test_at(index, 15), 'test_function')
+        self.assertEquals(mod.find_test_at(index, 18), None)
+
+    def testFailureStore(self):
+        failed_ids = mod._failed_test_ids([(self.test_file, 9),
+                (self.test_file, 15), (self.test_file, 9)])
+        self.assertEquals(failed_ids,
+                {self.test_file: ['TestFoo.test_one', 'test_function']})
+
+        store = mod.FailureStore(self.root)
+        store.update(failed_ids, [])
+        store = mod.FailureStore(self.root)
+        self.assertEquals(store.get(self.test_file),
+                ['TestFoo.test_one', 'test_function'])
+
+        # A passing run of the file forgets its failures
+        store.update({}, [self.test_file])
+        self.assertEquals(mod.FailureStore(self.root).get(self.test_file), [])
+
+    def testFailuresInCodeUnderTest(self):
+        # The worker reports the innermost frame, which isn't in the test
+        open(os.path.join(self.root, 'setup.py'), 'w').close()
+        traceback = ('Traceback (most recent call last):\n'
+                     '  File "%s", line 9, in test_one\n'
+                     '  File "%s/foo.py", line 2, in foo\n'
+                     'ValueError\n' % (self.test_file, self.root))
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            output = mod.start_test_output()
+            output.feed(['foo.py:2: error: ValueError',
+                         '\t' + json.dumps(traceback)])
+            self.assertEquals(output.finish(1), 1)
+        finally:
+            os.chdir(cwd)
+        self.assertEquals(mod.FailureStore(self.root).get(self.test_file),
+                          ['TestFoo.test_one'])
+
+    def testTestFilesInArgs(self):
+        args = "%s '%s:TestFoo.test_one' nonexisting.py" % (
+                self.test_file, self.test_file)
+        self.assertEquals(mod.test_files_in_args(args), [self.test_file])
+        self.assertEquals(mod.test_files_in_args(args, selectors=True),
+                [self.test_file])
+        self.assertEquals(mod.test_files_in_args(
+                '%s:TestFoo' % self.test_file), [])
+
+
+class TestWorkerClient(unittest.TestCase):
+    def setUp(self):
+        setUpVimEnvironment()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root, 'tests'))
+        open(os.path.join(self.root, 'tests', 'test_foo.py'), 'w').write(
+                'import unittest\n'
+                'class TestFoo(unittest.TestCase):\n'
+                '    def test_ok(self):\n'
+                '        pass\n'
+                '    def test_fail(self):\n'
+                '        self.assertEqual(1, 2)\n')
+        self.client = mod.WorkerClient(self.root)
+
+    def tearDown(self):
+        self.client.stop()
+        shutil.rmtree(self.root)
+
+    def testResultsFromProjectRoot(self):
+        cwd = os.getcwd()
+        os.chdir(os.path.join(self.root, 'tests'))
+        try:
+            self.assertEquals(mod._worker_line_from_root(
+                    "tests/test_foo.py:6: fail: 'a//b' != 'a/../c'", self.root),
+                    "test_foo.py:6: fail: 'a//b' != 'a/../c'")
+            self.assertEquals(mod._worker_line_from_root(
+                    '/elsewhere/x.py:1: error: oops', self.root),
+                    '/elsewhere/x.py:1: error: oops')
+            traceback = '\t"tests/test_foo.py:6: fail: nested\\n"'
+            self.assertEquals(mod._worker_line_from_root(traceback, self.root),
+                              traceback)
+        finally:
+            os.chdir(cwd)
+
+    def testCommand(self):
+        vimvar['g:PyUnitWorkerPreload'] = ['django']
+        self.client.source_root = 'src'
+        self.assertEquals(self.client.command()[2:], ['--preload', 'django',
+                '--path', 'src', self.root, self.client.socket_path])
+
+    def testRun(self):
+        result = list(self.client.run(['tests/test_foo.py']))
+        self.assertEquals(len(result), 3)
+        self.assertEquals(result[0],
+                'tests/test_foo.py:6: fail: AssertionError: 1 != 2')
+        self.assertTrue(result[1].startswith('\t"Traceback'))
+        self.assertEquals(result[2], 1)
+
+        # The second run is served by the same (already running) worker
+        result = list(self.client.run(['tests/test_foo.py:TestFoo.test_ok']))
+        self.assertEquals(result, [0])
+
+    def testForkingPreloadsExternalModules(self):
+        vimvar['g:PyUnitWorkerFork'] = 1
+        open(os.path.join(self.root, 'tests', 'helpers.py'), 'w').write(
+                'from __future__ import with_statement\n'
+                'import os.path\n'
+                'from . import test_foo\n')
+        command = self.client.command()
+        self.assertEquals(command[2:7], ['--fork', '--preload', 'os',
+                                         '--preload', 'unittest'])
+
+    def testForkingRestartsOnChangedPreload(self):
+        vimvar['g:PyUnitWorkerFork'] = 1
+        vimvar['g:PyUnitWorkerPreload'] = ['helpers']
+        helpers = os.path.join(self.root, 'helpers.py')
+        open(helpers, 'w').write('VALUE = 1\n')
+        open(os.path.join(self.root, 'tests', 'test_bar.py'), 'w').write(
+                'import unittest, helpers\n'
+                'class TestBar(unittest.TestCase):\n'
+                '    def test_value(self):\n'
+                '        self.assertEqual(helpers.VALUE, 1)\n')
+        self.assertEquals(list(self.client.run(['tests/test_bar.py'])), [0])
+
+        open(helpers, 'w').write('VALUE = 2\n')
+        st = os.stat(helpers)
+        os.utime(helpers, (st.st_atime, st.st_mtime + 10))
+        result = list(self.client.run(['tests/test_bar.py']))
+        self.assertEquals(result[0],
+                'tests/test_bar.py:4: fail: AssertionError: 2 != 1')
+        self.assertEquals(result[-1], 1)
+
+
 class TestPlugin(FileAwareTestCase):
     def setUp(self):
         setUpVimEnvironment()
@@ -449,6 +1816,52 @@ class TestPlugin(FileAwareTestCase):
     def test_find_project_root(self):
         self.assertEquals(mod.find_project_root(currfile), proj_root)
 
+    def test_find_project_root_caches_visited_dirs(self):
+        tmpdir = os.path.realpath(tempfile.mkdtemp())
+        try:
+            open(os.path.join(tmpdir, 'setup.py'), 'w').close()
+            os.makedirs(os.path.join(tmpdir, 'foo', 'bar'))
+            os.makedirs(os.path.join(tmpdir, 'foo', 'qux'))
+
+            deep = os.path.join(tmpdir, 'foo', 'bar')
+            self.assertEquals(mod.find_project_root(deep), tmpdir)
+            self.assertEquals(mod._project_roots[os.path.join(tmpdir, 'foo')][0],
+                    tmpdir)
+
+            # Siblings resolve from the cache of their parent
+            sibling = os.path.join(tmpdir, 'foo', 'qux')
+            self.assertEquals(mod.find_project_root(sibling), tmpdir)
+            self.assertTrue(sibling in mod._project_roots)
+
+            # Asking again takes neither a realpath() nor a walk
+            realpath = os.path.realpath
+            os.path.realpath = None
+            try:
+                self.assertEquals(mod.find_project_root(sibling), tmpdir)
+            finally:
+                os.path.realpath = realpath
+
+            mod.clear_caches()
+            self.assertEquals(mod._project_roots, {})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_find_project_root_invalidates_on_indicator_change(self):
+        tmpdir = os.path.realpath(tempfile.mkdtemp())
+        try:
+            inner = os.path.join(tmpdir, 'inner')
+            os.makedirs(os.path.join(inner, 'pkg'))
+            open(os.path.join(tmpdir, 'setup.py'), 'w').close()
+            open(os.path.join(inner, 'setup.cfg'), 'w').close()
+
+            pkg = os.path.join(inner, 'pkg')
+            self.assertEquals(mod.find_project_root(pkg), inner)
+
+            os.remove(os.path.join(inner, 'setup.cfg'))
+            self.assertEquals(mod.find_project_root(pkg), tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_relpath(self):
         # Nice and simple
         self.assertEquals(
@@ -518,15 +1931,61 @@ class TestPlugin(FileAwareTestCase):
                 'misc/mytests/test_foo_bar.py')
 
     def test_get_source_file_for_test_file(self):
+        vimvar['g:PyUnitFuzzyCounterparts'] = '0'
         self.assertRaises(Exception,
                 mod.find_source_file_for_test_file, currfile)
 
+        # Without a source root, it is found only by its name
+        vimvar['g:PyUnitFuzzyCounterparts'] = '1'
+        self.assertSameFile(mod.find_source_file_for_test_file(currfile),
+                os.path.realpath('src/python_unittests.py'))
+
         vimvar['g:PyUnitSourceRoot'] = 'src'
         self.assertSameFile(
                 mod.find_source_file_for_test_file('tests/test_python_unittests.py'),
                 os.path.realpath('src/python_unittests.py'))
 
 
+    def test_call_from_vim(self):
+        def add(a, b):
+            return int(a) + int(b)
+        def nothing():
+            return None
+        def check():
+            return True
+        for func in (add, nothing, check):
+            mod.bridged(func)
+        try:
+            vimvar['a:000'] = ['1', '2']
+            self.assertEquals(mod.call_from_vim('add'), '3')
+            vimvar['a:000'] = []
+            self.assertEquals(mod.call_from_vim('nothing'), '')
+            self.assertEquals(mod.call_from_vim('check'), '1')
+        finally:
+            for func in (add, nothing, check):
+                del mod._vim_functions[func.__name__]
+
+    def test_config_is_read_once(self):
+        reads = []
+        def counting_eval(x):
+            reads.append(x)
+            return vimvar[x]
+        vim.eval = counting_eval
+        try:
+            mod.config.invalidate()
+            self.assertEquals(mod.config.prefix, 'test_')
+            self.assertEquals(mod.config.stop_at_home_dir, 1)
+            mod.FollowHierarchyLayout()
+            mod.get_implementing_class()
+            self.assertEquals(len(reads), len(mod.Config.settings))
+
+            dict.__setitem__(vimvar, 'g:PyUnitTestPrefix', '_')
+            self.assertEquals(mod.config.prefix, 'test_')
+            mod.PyUnitReloadConfig()
+            self.assertEquals(mod.config.prefix, '_')
+        finally:
+            vim.eval = fake_eval
+
     def test_vim_split_cmd(self):
         self.assertEquals(mod._vim_split_cmd(), 'vert rightb')
         self.assertEquals(mod._vim_split_cmd(True), 'vert lefta')
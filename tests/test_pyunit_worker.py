@@ -0,0 +1,126 @@
+import os
+import json
+import sys
+import shutil
+import tempfile
+import unittest
+
+import pyunit_worker as worker
+
+
+class ProjectTestCase(unittest.TestCase):
+    files = {}
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        for f, contents in self.files.items():
+            self.write(f, contents)
+        self.old_path = sys.path[:]
+        self.old_modules = set(sys.modules)
+        sys.path.insert(0, self.root)
+
+    def tearDown(self):
+        sys.path[:] = self.old_path
+        for name in set(sys.modules) - self.old_modules:
+            del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def path(self, f):
+        return os.path.join(self.root, f)
+
+    def write(self, f, contents):
+        path = self.path(f)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(contents)
+
+
+class TestModuleTracker(ProjectTestCase):
+    files = {
+        'wpkg/__init__.py': '',
+        'wpkg/base.py': 'def helper():\n    return 1\n',
+        'wpkg/user.py': 'from wpkg.base import helper\n',
+        'wpkg/other.py': 'import os\n',
+    }
+
+    def testStaleModules(self):
+        import wpkg.user
+        import wpkg.other
+        tracker = worker.ModuleTracker(self.root)
+        tracker.snapshot()
+        self.assertEquals(tracker.stale_modules(), set())
+
+        # The package refers to its (changed) submodule as well
+        st = os.stat(self.path('wpkg/base.py'))
+        os.utime(self.path('wpkg/base.py'), (st.st_atime, st.st_mtime + 10))
+        self.assertEquals(tracker.stale_modules(),
+                set(['wpkg', 'wpkg.base', 'wpkg.user']))
+
+        tracker.unload_stale()
+        self.assertFalse('wpkg.base' in sys.modules)
+        self.assertTrue('wpkg.other' in sys.modules)
+        self.assertTrue('os' in sys.modules)
+
+    def testModuleNameFor(self):
+        self.assertEquals(worker.module_name_for(self.path('wpkg/user.py')),
+                ('wpkg.user', self.root))
+        self.assertEquals(worker.module_name_for(self.path('wpkg/__init__.py')),
+                ('wpkg', self.root))
+
+
+class TestRunTests(ProjectTestCase):
+    files = {
+        'wtests/test_things.py': '\n'.join([
+            'import unittest',
+            'class TestThings(unittest.TestCase):',
+            '    def test_ok(self):',
+            '        print("noise")',
+            '    def test_fail(self):',
+            '        self.assertTrue(False)',
+            '    def test_error(self):',
+            '        {}["key"]',
+            '']),
+    }
+
+    def run_worker(self, args, stop=False):
+        lines = []
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            status = worker.run_tests(args, self.root, lines.append, stop)
+        finally:
+            os.chdir(cwd)
+        return status, lines
+
+    def testMachineOutput(self):
+        status, lines = self.run_worker(['wtests/test_things.py'])
+        self.assertEquals(status, 1)
+        self.assertEquals(sorted(l for l in lines if not l.startswith('\t')), [
+            "wtests/test_things.py:6: fail: AssertionError: False is not true",
+            "wtests/test_things.py:8: error: KeyError: 'key'",
+        ])
+
+    def testTracebacks(self):
+        self.write('wtests/test_output.py', '\n'.join([
+            'import unittest',
+            'class TestOutput(unittest.TestCase):',
+            '    def test_fail(self):',
+            '        print("some context")',
+            '        self.assertTrue(False)',
+            '']))
+        status, lines = self.run_worker(['wtests/test_output.py'])
+        self.assertEquals(len(lines), 2)
+        self.assertTrue(lines[1].startswith('\t'))
+        details = json.loads(lines[1][1:])
+        self.assertTrue(details.startswith('Traceback'))
+        self.assertTrue('self.assertTrue(False)' in details)
+        self.assertTrue('some context' in details)
+
+    def testSelector(self):
+        status, lines = self.run_worker(['wtests/test_things.py:TestThings.test_ok'])
+        self.assertEquals((status, lines), (0, []))
+
+    def testStopAtFirstFailure(self):
+        status, lines = self.run_worker(['wtests/test_things.py'], stop=True)
+        # The failure, and its traceback
+        self.assertEquals(len(lines), 2)